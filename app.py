@@ -52,6 +52,16 @@ app.config["MAIL_DEFAULT_SENDER"] = os.environ.get("MAIL_DEFAULT_SENDER", "")
 app.config["CACHE_TYPE"] = "simple"
 app.config["CACHE_DEFAULT_TIMEOUT"] = 300
 
+# Parquet snapshots for offline analytics
+app.config["SNAPSHOT_DIR"] = os.environ.get("SNAPSHOT_DIR", os.path.join(app.instance_path, "snapshots"))
+
+# Background report jobs
+app.config["REPORT_ARTIFACT_DIR"] = os.environ.get("REPORT_ARTIFACT_DIR", os.path.join(app.instance_path, "report_artifacts"))
+app.config["REPORT_WORKERS"] = int(os.environ.get("REPORT_WORKERS", "2"))
+
+# Live event streams held open per worker; the remaining threads keep serving requests
+app.config["SSE_MAX_STREAMS"] = int(os.environ.get("SSE_MAX_STREAMS", "8"))
+
 # Initialize extensions
 db.init_app(app)
 Session(app)
@@ -79,6 +89,7 @@ from routes.reports import reports_bp
 from routes.settings import settings_bp
 from routes.accounting import accounting_bp
 from routes.dian import dian_bp
+from routes.events import events_bp
 from auth import auth_bp
 
 app.register_blueprint(auth_bp)
@@ -93,6 +104,7 @@ app.register_blueprint(reports_bp, url_prefix='/reports')
 app.register_blueprint(settings_bp, url_prefix='/settings')
 app.register_blueprint(accounting_bp, url_prefix='/accounting')
 app.register_blueprint(dian_bp, url_prefix='/dian')
+app.register_blueprint(events_bp, url_prefix='/events')
 
 with app.app_context():
     # Import models to ensure they're registered
@@ -100,6 +112,12 @@ with app.app_context():
     import models_dian
     db.create_all()
     
+    from utils.schema_migrations import run_migrations
+    run_migrations()
+    
+    from utils.product_search import ensure_search_indexes
+    ensure_search_indexes()
+    
     # Create default admin user if none exists
     from werkzeug.security import generate_password_hash
     from datetime import date
@@ -189,6 +207,9 @@ with app.app_context():
                         db.session.flush()
                         accounts_map[acc_data['code']] = account.id
             
+            from utils.account_tree import rebuild_paths
+            rebuild_paths()
+            
             # Crear período contable actual
             current_date = date.today()
             if not models.AccountingPeriod.query.first():
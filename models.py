@@ -2,6 +2,13 @@ from app import db
 from datetime import datetime
 from sqlalchemy import Index, text
 from flask_login import UserMixin
+import unicodedata
+
+def fold_search_text(*parts):
+    """Texto en minúsculas y sin tildes para búsquedas (Camión -> camion)"""
+    text_value = ' '.join(str(part) for part in parts if part)
+    decomposed = unicodedata.normalize('NFKD', text_value.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -87,6 +94,10 @@ class Product(db.Model):
     track_serial = db.Column(db.Boolean, default=False)  # Rastrea serial/IMEI
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Nombre, SKU y código de barras normalizados; indexado con pg_trgm o FTS5
+    search_text = db.Column(db.Text)
     
     # Relationships
     category = db.relationship('Category', backref='products')
@@ -94,11 +105,15 @@ class Product(db.Model):
     group = db.relationship('ProductGroup', backref='products')
     line = db.relationship('ProductLine', backref='products')
     
+    def update_search_text(self):
+        """Actualiza el campo search_text a partir de nombre, SKU y código de barras"""
+        self.search_text = fold_search_text(self.name, self.sku, self.barcode)
+    
     # Indexes for performance
     __table_args__ = (
-        Index('idx_product_search', 'name', 'sku', 'barcode'),
         Index('idx_product_category', 'category_id'),
         Index('idx_product_brand', 'brand_id'),
+        Index('idx_product_updated', 'updated_at'),
     )
 
 class Inventory(db.Model):
@@ -230,6 +245,8 @@ class Sale(db.Model):
     
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    rolled_up = db.Column(db.Boolean, default=False)  # Incluida en las tablas de resumen diario
+    posted = db.Column(db.Boolean, default=False)  # Contabilizada por la integración (u omitida por período cerrado)
     
     customer = db.relationship('Customer', backref='sales')
     warehouse = db.relationship('Warehouse', backref='sales')
@@ -239,6 +256,9 @@ class Sale(db.Model):
         Index('idx_sale_date', 'created_at'),
         Index('idx_sale_customer', 'customer_id'),
         Index('idx_sale_warehouse', 'warehouse_id'),
+        Index('idx_sale_open_items', 'payment_method', 'payment_status', 'customer_id'),
+        Index('idx_sale_rolled_up', 'rolled_up', 'id'),
+        Index('idx_sale_posted', 'posted', 'id'),
     )
 
 class SaleDetail(db.Model):
@@ -254,10 +274,18 @@ class SaleDetail(db.Model):
     discount_percent = db.Column(db.Numeric(5, 2), default=0)
     discount_amount = db.Column(db.Numeric(10, 2), default=0)
     total = db.Column(db.Numeric(12, 2), nullable=False)
+    # Costo unitario del producto al momento de la venta y margen bruto de la línea (total - cantidad * costo)
+    unit_cost = db.Column(db.Numeric(10, 2))
+    gross_margin = db.Column(db.Numeric(12, 2))
     
     sale = db.relationship('Sale', backref='details')
     product = db.relationship('Product', backref='sale_details')
     serial = db.relationship('SerialNumber', backref='sale_details')
+    
+    __table_args__ = (
+        Index('idx_sale_detail_sale', 'sale_id'),
+        Index('idx_sale_detail_product', 'product_id'),
+    )
 
 class Purchase(db.Model):
     __tablename__ = 'purchases'
@@ -275,6 +303,7 @@ class Purchase(db.Model):
     payment_status = db.Column(db.String(20), default='pending')
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    posted = db.Column(db.Boolean, default=False)  # Contabilizada por la integración (u omitida por período cerrado)
     
     supplier = db.relationship('Customer', backref='purchases')
     warehouse = db.relationship('Warehouse', backref='purchases')
@@ -283,6 +312,7 @@ class Purchase(db.Model):
     __table_args__ = (
         Index('idx_purchase_date', 'created_at'),
         Index('idx_purchase_supplier', 'supplier_id'),
+        Index('idx_purchase_posted', 'posted', 'id'),
     )
 
 class PurchaseDetail(db.Model):
@@ -319,6 +349,214 @@ class Setting(db.Model):
     description = db.Column(db.Text)
     category = db.Column(db.String(50))
 
+class DataVersion(db.Model):
+    """Versión de datos por dominio (catalog, sales, inventory...) para invalidar cachés"""
+    __tablename__ = 'data_versions'
+    
+    domain = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DashboardMetric(db.Model):
+    """Contadores del dashboard mantenidos al escribir (ventas del día y del mes, totales, stock bajo)"""
+    __tablename__ = 'dashboard_metrics'
+    
+    metric = db.Column(db.String(40), primary_key=True)
+    period = db.Column(db.String(10), primary_key=True, default='')  # '' global, AAAA-MM-DD día, AAAA-MM mes
+    warehouse_id = db.Column(db.Integer, primary_key=True, default=0)  # 0 = todas las bodegas
+    value = db.Column(db.Numeric(16, 2), nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PriceRuleJob(db.Model):
+    """Historial de actualizaciones masivas de precios"""
+    __tablename__ = 'price_rule_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200))
+    rule = db.Column(db.Text, nullable=False)  # JSON con filtros y fórmulas
+    affected_rows = db.Column(db.Integer, default=0)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User', backref='price_rule_jobs')
+
+class SalesDailyTotal(db.Model):
+    """Resumen diario de ventas (encabezados) por bodega y segmento de cliente"""
+    __tablename__ = 'sales_daily_totals'
+
+    day = db.Column(db.Date, primary_key=True)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), primary_key=True)
+    customer_segment = db.Column(db.Integer, primary_key=True)  # 0 sin cliente, 1-4 nivel de precio
+
+    sales_count = db.Column(db.Integer, default=0)
+    subtotal = db.Column(db.Numeric(14, 2), default=0)
+    tax_amount = db.Column(db.Numeric(14, 2), default=0)
+    discount_amount = db.Column(db.Numeric(14, 2), default=0)
+    total = db.Column(db.Numeric(14, 2), default=0)
+
+class SalesDailyProduct(db.Model):
+    """Hechos diarios de venta por bodega, producto y segmento de cliente"""
+    __tablename__ = 'sales_daily_products'
+
+    day = db.Column(db.Date, primary_key=True)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    customer_segment = db.Column(db.Integer, primary_key=True)
+
+    quantity = db.Column(db.Numeric(14, 3), default=0)
+    revenue = db.Column(db.Numeric(14, 2), default=0)
+    cost = db.Column(db.Numeric(14, 2), default=0)  # Costo de lo vendido con el costo de cada venta
+    lines_count = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        Index('idx_sales_daily_product', 'product_id', 'day'),
+    )
+
+class CustomerStats(db.Model):
+    """Estadísticas de compra por cliente, actualizadas con cada venta, y puntajes RFM"""
+    __tablename__ = 'customer_stats'
+
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), primary_key=True)
+    orders_count = db.Column(db.Integer, default=0)
+    total_spent = db.Column(db.Numeric(14, 2), default=0)
+    avg_ticket = db.Column(db.Numeric(14, 2), default=0)
+    first_order_at = db.Column(db.DateTime)
+    last_order_at = db.Column(db.DateTime)
+
+    # Quintiles 1-5 (5 = más reciente / más frecuente / mayor valor), recalculados por el job de puntaje
+    recency_score = db.Column(db.Integer)
+    frequency_score = db.Column(db.Integer)
+    monetary_score = db.Column(db.Integer)
+    rfm_segment = db.Column(db.String(20))
+    scored_at = db.Column(db.DateTime)
+
+    customer = db.relationship('Customer', backref=db.backref('stats', uselist=False))
+
+    __table_args__ = (
+        Index('idx_customer_stats_spent', 'total_spent'),
+        Index('idx_customer_stats_orders', 'orders_count'),
+        Index('idx_customer_stats_last_order', 'last_order_at'),
+        Index('idx_customer_stats_segment', 'rfm_segment', 'total_spent'),
+    )
+
+class StockCount(db.Model):
+    """Sesión de conteo físico de inventario; al aplicarse es el movimiento de ajuste"""
+    __tablename__ = 'stock_counts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), nullable=False)
+    description = db.Column(db.String(200))
+    status = db.Column(db.String(20), default='open')  # open, applied, cancelled
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    applied_at = db.Column(db.DateTime)
+    applied_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    adjusted_items = db.Column(db.Integer, default=0)
+    adjustment_value = db.Column(db.Numeric(14, 2), default=0)
+
+    warehouse = db.relationship('Warehouse')
+    user = db.relationship('User', foreign_keys=[user_id])
+
+    __table_args__ = (
+        Index('idx_stock_count_status', 'status'),
+    )
+
+class StockCountLine(db.Model):
+    """Cantidades contadas por producto (staging de los lotes de escaneo)"""
+    __tablename__ = 'stock_count_lines'
+
+    id = db.Column(db.Integer, primary_key=True)
+    count_id = db.Column(db.Integer, db.ForeignKey('stock_counts.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    system_quantity = db.Column(db.Numeric(10, 3), default=0)  # Existencia al primer escaneo
+    counted_quantity = db.Column(db.Numeric(10, 3), default=0)
+    unit_cost = db.Column(db.Numeric(10, 2), default=0)
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('count_id', 'product_id'),
+    )
+
+class ReorderSuggestion(db.Model):
+    """Sugerencias de reposición por producto y bodega, calculadas por el job nocturno"""
+    __tablename__ = 'reorder_suggestions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), nullable=False)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('customers.id'))  # Proveedor de la última compra
+
+    avg_daily_demand = db.Column(db.Numeric(12, 4), default=0)
+    demand_std = db.Column(db.Numeric(12, 4), default=0)
+    quantity_on_hand = db.Column(db.Numeric(10, 3), default=0)
+    days_of_cover = db.Column(db.Numeric(10, 1))  # Nulo si no hay demanda
+    reorder_point = db.Column(db.Numeric(10, 3), default=0)
+    suggested_quantity = db.Column(db.Numeric(10, 3), default=0)
+    unit_cost = db.Column(db.Numeric(10, 2), default=0)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    product = db.relationship('Product')
+    warehouse = db.relationship('Warehouse')
+    supplier = db.relationship('Customer')
+
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'warehouse_id'),
+        Index('idx_reorder_supplier', 'supplier_id'),
+        Index('idx_reorder_warehouse', 'warehouse_id'),
+    )
+
+class ProductClassification(db.Model):
+    """Clasificación ABC (Pareto) por producto y bodega según ingresos y margen"""
+    __tablename__ = 'product_classifications'
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), nullable=False)
+
+    revenue = db.Column(db.Numeric(14, 2), default=0)
+    margin = db.Column(db.Numeric(14, 2), default=0)
+    revenue_share = db.Column(db.Numeric(7, 4), default=0)  # Participación acumulada hasta este producto
+    margin_share = db.Column(db.Numeric(7, 4), default=0)
+    revenue_class = db.Column(db.String(1), nullable=False)  # A, B, C
+    margin_class = db.Column(db.String(1), nullable=False)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    product = db.relationship('Product')
+    warehouse = db.relationship('Warehouse')
+
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'warehouse_id'),
+        Index('idx_product_class_revenue', 'warehouse_id', 'revenue_class'),
+        Index('idx_product_class_margin', 'warehouse_id', 'margin_class'),
+    )
+
+class ReportJob(db.Model):
+    """Reporte pesado generado en segundo plano; el resultado se guarda comprimido"""
+    __tablename__ = 'report_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    report_type = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text)  # JSON con los parámetros normalizados
+    cache_key = db.Column(db.String(64), nullable=False)  # Hash de tipo + parámetros + versión de datos
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    progress = db.Column(db.Integer, default=0)  # 0-100
+    row_count = db.Column(db.Integer, default=0)
+    artifact_path = db.Column(db.String(500))
+    artifact_size = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    user = db.relationship('User')
+
+    __table_args__ = (
+        Index('idx_report_job_key', 'cache_key', 'status'),
+        Index('idx_report_job_status', 'status', 'created_at'),
+    )
+
 # ===== MODELOS CONTABLES - SISTEMA DE PARTIDA DOBLE =====
 
 class ChartOfAccounts(db.Model):
@@ -332,6 +570,7 @@ class ChartOfAccounts(db.Model):
     account_type = db.Column(db.String(20), nullable=False)  # ACTIVO, PASIVO, PATRIMONIO, INGRESO, GASTO
     account_subtype = db.Column(db.String(50))  # CORRIENTE, NO_CORRIENTE, etc.
     parent_id = db.Column(db.Integer, db.ForeignKey('chart_of_accounts.id'))  # Cuenta padre
+    path = db.Column(db.String(255), index=True)  # Ruta materializada de ids: /1/5/23/
     level = db.Column(db.Integer, nullable=False, default=1)  # Nivel jerárquico
     is_detail_account = db.Column(db.Boolean, default=True)  # Si acepta movimientos
     normal_balance = db.Column(db.String(10), nullable=False)  # DEBIT o CREDIT
@@ -377,6 +616,10 @@ class JournalEntry(db.Model):
     # Relaciones
     period = db.relationship('AccountingPeriod', backref='journal_entries')
     
+    __table_args__ = (
+        Index('idx_journal_entry_date', 'status', 'entry_date'),
+    )
+    
     def __repr__(self):
         return f'<JournalEntry {self.entry_number}>'
 
@@ -432,3 +675,27 @@ class AccountBalance(db.Model):
         Index('idx_balance_account', 'account_id'),
         Index('idx_balance_period', 'period_id'),
     )
+
+class ThirdPartyBalance(db.Model):
+    """Saldos por Tercero y Cuenta - Auxiliar de terceros"""
+    __tablename__ = 'third_party_balances'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('chart_of_accounts.id'), nullable=False)
+    third_party_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    
+    # Saldos acumulados de los asientos contabilizados
+    debit_total = db.Column(db.Numeric(15, 2), default=0)   # Total débitos
+    credit_total = db.Column(db.Numeric(15, 2), default=0)  # Total créditos
+    balance = db.Column(db.Numeric(15, 2), default=0)       # Débitos - créditos
+    
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relaciones
+    account = db.relationship('ChartOfAccounts', backref='third_party_balances')
+    third_party = db.relationship('Customer', backref='account_balances')
+    
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'third_party_id'),
+        Index('idx_third_party_balance_party', 'third_party_id'),
+    )
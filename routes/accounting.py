@@ -1,12 +1,20 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, send_file
 from models import (db, ChartOfAccounts, AccountingPeriod, JournalEntry, JournalEntryDetail, 
-                   Customer, Setting)
+                   Customer, Setting, AccountBalance, ThirdPartyBalance)
+from auth import login_required, admin_required
 from utils.pagination import paginate_query
+from utils import (account_balances, account_tree, journal_posting, period_close, general_ledger,
+                   receivables_aging, financial_statements)
+from utils.cache import cached_report
+from utils.export import stream_rows, csv_response, write_xlsx
+from utils.pdf_generator import write_report_pdf
 from sqlalchemy import text, desc, and_, or_
 from datetime import datetime, date
 import calendar
+import io
 from decimal import Decimal
 import logging
+import click
 
 accounting_bp = Blueprint('accounting', __name__)
 
@@ -105,6 +113,8 @@ def add_account():
             )
             
             db.session.add(account)
+            db.session.flush()
+            account_tree.assign_path(account)
             db.session.commit()
             flash('Cuenta contable creada exitosamente', 'success')
             return redirect(url_for('accounting.chart_of_accounts'))
@@ -122,7 +132,27 @@ def add_account():
 def periods():
     """Gestión de períodos contables"""
     periods = AccountingPeriod.query.order_by(desc(AccountingPeriod.year), desc(AccountingPeriod.month)).all()
-    return render_template('accounting/periods.html', periods=periods)
+    accounts = ChartOfAccounts.query.filter_by(is_active=True, is_detail_account=True).order_by(ChartOfAccounts.code).all()
+    return render_template('accounting/periods.html',
+                         periods=periods,
+                         accounts=accounts,
+                         result_account_code=period_close.get_result_account_code())
+
+@accounting_bp.route('/periods/<int:id>/close', methods=['POST'])
+@admin_required
+def close_period(id):
+    """Cerrar período: asiento de cierre, saldos iniciales del siguiente período y bloqueo"""
+    try:
+        period = AccountingPeriod.query.get_or_404(id)
+        data = request.get_json(silent=True) or {}
+        entry = period_close.close_period(period, data.get('result_account_code', ''))
+        message = f'Período {period.name} cerrado exitosamente'
+        if entry:
+            message += f' (asiento de cierre {entry.entry_number})'
+        return jsonify({'success': True, 'message': message})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)})
 
 @accounting_bp.route('/periods/new', methods=['GET', 'POST'])
 def create_period():
@@ -139,6 +169,9 @@ def create_period():
             )
             
             db.session.add(period)
+            db.session.flush()
+            # Opening balances of the new period from the entries already posted
+            account_balances.rebuild_period_balances(period)
             db.session.commit()
             flash('Período contable creado exitosamente', 'success')
             return redirect(url_for('accounting.periods'))
@@ -291,10 +324,82 @@ def view_journal_entry(id):
     entry = JournalEntry.query.get_or_404(id)
     return render_template('accounting/view_journal_entry.html', entry=entry)
 
+@accounting_bp.route('/journal_entries/<int:id>/post', methods=['POST'])
+@login_required
+def post_journal_entry(id):
+    """Contabilizar asiento y actualizar saldos"""
+    try:
+        entry = JournalEntry.query.get_or_404(id)
+        account_balances.post_entry(entry)
+        db.session.commit()
+        return jsonify({'success': True, 'status': entry.status})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)})
+
+@accounting_bp.route('/journal_entries/<int:id>/reverse', methods=['POST'])
+@login_required
+def reverse_journal_entry(id):
+    """Anular asiento contabilizado y revertir saldos"""
+    try:
+        entry = JournalEntry.query.get_or_404(id)
+        account_balances.reverse_entry(entry)
+        db.session.commit()
+        return jsonify({'success': True, 'status': entry.status})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)})
+
+@accounting_bp.route('/integration', methods=['GET', 'POST'])
+@admin_required
+def integration():
+    """Cuentas y modo de la contabilización automática de ventas y compras"""
+    if request.method == 'POST':
+        try:
+            journal_posting.save_configuration(
+                request.form.get('mode', 'document'),
+                {name: request.form.get(f'account_{name}', '') for name in journal_posting.MAPPINGS},
+                request.form.get('start_date')
+            )
+            db.session.commit()
+            flash('Integración contable actualizada exitosamente', 'success')
+            return redirect(url_for('accounting.integration'))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al guardar integración: {str(e)}', 'error')
+    
+    accounts = ChartOfAccounts.query.filter_by(is_active=True, is_detail_account=True).order_by(ChartOfAccounts.code).all()
+    
+    return render_template('accounting/integration.html',
+                         mappings=journal_posting.MAPPINGS,
+                         modes=journal_posting.MODES,
+                         codes=journal_posting.get_mapping_codes(),
+                         mode=journal_posting.get_mode(),
+                         start_date=journal_posting.get_start_date(),
+                         pending=journal_posting.pending_counts(),
+                         accounts=accounts)
+
+@accounting_bp.route('/integration/run', methods=['POST'])
+@admin_required
+def run_integration():
+    """Contabilizar ventas y compras pendientes"""
+    try:
+        result = journal_posting.post_pending_documents()
+        flash(f"Contabilizadas {result['sales']['documents']} ventas y {result['purchases']['documents']} compras "
+              f"en {result['sales']['entries'] + result['purchases']['entries']} asientos", 'success')
+        skipped = result['sales']['skipped'] + result['purchases']['skipped']
+        if skipped:
+            flash(f"{len(skipped)} documentos con fecha en períodos cerrados no se contabilizaron: "
+                  f"{', '.join(skipped[:20])}{'...' if len(skipped) > 20 else ''}", 'warning')
+    except Exception as e:
+        flash(f'Error al contabilizar documentos: {str(e)}', 'error')
+    return redirect(url_for('accounting.integration'))
+
 @accounting_bp.route('/trial_balance')
 def trial_balance():
     """Balance de comprobación"""
     period_id = request.args.get('period_id', '')
+    max_level = request.args.get('level', type=int)
     
     # Si no hay período seleccionado, usar el más reciente
     if not period_id:
@@ -304,51 +409,229 @@ def trial_balance():
     
     # Consulta para balance de comprobación
     trial_balance_data = []
+    totals = dict.fromkeys(('opening_balance', 'total_debit', 'total_credit', 'balance'), Decimal('0'))
     
     if period_id:
         period = AccountingPeriod.query.get(period_id)
         if period:
-            # Obtener balances por cuenta
-            query = db.session.query(
-                ChartOfAccounts.code,
-                ChartOfAccounts.name,
-                ChartOfAccounts.account_type,
-                ChartOfAccounts.normal_balance,
-                db.func.sum(JournalEntryDetail.debit_amount).label('total_debit'),
-                db.func.sum(JournalEntryDetail.credit_amount).label('total_credit')
-            ).join(JournalEntryDetail).join(JournalEntry)\
-            .filter(and_(
-                JournalEntry.entry_date >= period.start_date,
-                JournalEntry.entry_date <= period.end_date,
-                ChartOfAccounts.is_active == True
-            ))\
-            .group_by(ChartOfAccounts.id)\
-            .order_by(ChartOfAccounts.code)
-            
-            results = query.all()
+            # Saldos mantenidos al contabilizar, sumados a todos los niveles en una pasada
+            balances = AccountBalance.query.filter_by(period_id=period.id).all()
+            tree = account_tree.get_account_tree()
+            rolled = account_tree.rollup(tree, balances)
             
-            for row in results:
-                total_debit = row.total_debit or Decimal('0')
-                total_credit = row.total_credit or Decimal('0')
-                balance = total_debit - total_credit
-                
+            for account in tree.ordered:
+                row = rolled.get(account.id)
+                if not row or not account.is_active or not any(row.values()):
+                    continue
+                if max_level and account.depth > max_level:
+                    continue
                 trial_balance_data.append({
-                    'code': row.code,
-                    'name': row.name,
-                    'account_type': row.account_type,
-                    'normal_balance': row.normal_balance,
-                    'total_debit': total_debit,
-                    'total_credit': total_credit,
-                    'balance': balance
+                    'code': account.code,
+                    'name': account.name,
+                    'account_type': account.account_type,
+                    'normal_balance': account.normal_balance,
+                    'depth': account.depth,
+                    'is_detail_account': account.is_detail_account,
+                    'opening_balance': row['opening_balance'],
+                    'total_debit': row['debit_total'],
+                    'total_credit': row['credit_total'],
+                    'balance': row['closing_balance']
                 })
+            
+            # Totales desde las cuentas con saldo propio, sin contar dos veces los niveles
+            for balance in balances:
+                totals['opening_balance'] += balance.opening_balance or 0
+                totals['total_debit'] += balance.debit_total or 0
+                totals['total_credit'] += balance.credit_total or 0
+                totals['balance'] += balance.closing_balance or 0
     
     # Períodos disponibles
     periods = AccountingPeriod.query.order_by(desc(AccountingPeriod.year), desc(AccountingPeriod.month)).all()
     
     return render_template('accounting/trial_balance.html',
                          trial_balance_data=trial_balance_data,
+                         totals=totals,
+                         periods=periods,
+                         selected_period_id=period_id,
+                         max_level=max_level)
+
+@accounting_bp.route('/general_ledger')
+@login_required
+def general_ledger_view():
+    """Libro mayor por cuenta o rango de cuentas, con saldo acumulado"""
+    page = {'rows': [], 'next': None}
+    filters = None
+    try:
+        filters = general_ledger.parse_filters(request.args)
+        page = general_ledger.ledger_page(filters, request.args.get('after'))
+    except ValueError as e:
+        flash(str(e), 'error')
+    
+    accounts = ChartOfAccounts.query.filter_by(is_active=True).order_by(ChartOfAccounts.code).all()
+    
+    return render_template('accounting/general_ledger.html',
+                         rows=page['rows'],
+                         next_cursor=page['next'],
+                         filters=filters,
+                         accounts=accounts)
+
+@accounting_bp.route('/general_ledger/export')
+@login_required
+def export_general_ledger():
+    """Exportar libro mayor a CSV, leído desde un cursor del servidor"""
+    try:
+        filters = general_ledger.parse_filters(request.args)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('accounting.general_ledger_view'))
+    
+    query, params = general_ledger.export_query(filters)
+    partitions = general_ledger.export_rows(filters, stream_rows(query, params))
+    filename = f"libro_mayor_{filters['start'].isoformat()}_{filters['end'].isoformat()}.csv"
+    return csv_response(filename, general_ledger.EXPORT_HEADER, partitions, lambda row: row)
+
+@accounting_bp.route('/third_party_balances')
+@login_required
+def third_party_balances():
+    """Auxiliar de terceros: saldo por tercero y cuenta"""
+    account_id = request.args.get('account_id', type=int)
+    search = request.args.get('search', '').strip()
+    
+    query = db.session.query(ThirdPartyBalance, Customer, ChartOfAccounts)\
+        .join(Customer, Customer.id == ThirdPartyBalance.third_party_id)\
+        .join(ChartOfAccounts, ChartOfAccounts.id == ThirdPartyBalance.account_id)\
+        .filter(ThirdPartyBalance.balance != 0)
+    if account_id:
+        query = query.filter(ThirdPartyBalance.account_id == account_id)
+    if search:
+        query = query.filter(or_(Customer.full_name.ilike(f'%{search}%'),
+                                 Customer.document_number.ilike(f'%{search}%')))
+    
+    balances, pagination = paginate_query(query.order_by(ChartOfAccounts.code, desc(ThirdPartyBalance.balance)), per_page=50)
+    
+    accounts = ChartOfAccounts.query.filter(
+        ChartOfAccounts.id.in_(db.session.query(ThirdPartyBalance.account_id).distinct())
+    ).order_by(ChartOfAccounts.code).all()
+    
+    return render_template('accounting/third_party_balances.html',
+                         balances=balances,
+                         pagination=pagination,
+                         accounts=accounts,
+                         account_id=account_id,
+                         search=search)
+
+def _aging_totals(as_of):
+    # Recent credit sales and payments show up within the minute; the 'sales'
+    # version moves with every rollup batch and would keep this cold
+    return cached_report('receivables_aging_totals', {'as_of': as_of.isoformat()},
+                         ('customers', 'accounting'),
+                         lambda: receivables_aging.aging_totals(as_of), timeout=60)
+
+def _aging_cutoff():
+    try:
+        return datetime.strptime(request.args['as_of'], '%Y-%m-%d').date() if request.args.get('as_of') else date.today()
+    except ValueError:
+        flash('Fecha de corte no válida', 'error')
+        return date.today()
+
+@accounting_bp.route('/receivables_aging')
+@login_required
+def receivables_aging_view():
+    """Cartera por edades: ventas a crédito pendientes por cliente"""
+    as_of = _aging_cutoff()
+    search = request.args.get('search', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 50
+    
+    report = receivables_aging.aging_report(as_of, search, page, per_page)
+    
+    total_pages = max((report['customers'] + per_page - 1) // per_page, 1)
+    pagination = {
+        'page': page,
+        'total': report['customers'],
+        'total_pages': total_pages,
+        'has_prev': page > 1,
+        'has_next': page < total_pages,
+        'prev_num': page - 1,
+        'next_num': page + 1,
+        'pages': list(range(max(1, page - 2), min(total_pages + 1, page + 3))),
+    }
+    
+    return render_template('accounting/receivables_aging.html',
+                         rows=report['rows'],
+                         totals=_aging_totals(as_of),
+                         buckets=receivables_aging.BUCKETS,
+                         pagination=pagination,
+                         as_of=as_of,
+                         search=request.args.get('search', ''))
+
+@accounting_bp.route('/receivables_aging/export')
+@login_required
+def export_receivables_aging():
+    """Exportar cartera por edades a CSV"""
+    as_of = _aging_cutoff()
+    report = receivables_aging.aging_report(as_of)
+    buckets = receivables_aging.BUCKETS
+    header = (['Cliente', 'Documento', 'Teléfono', 'Días Crédito', 'Facturas', 'Con Abono'] + list(buckets.values())
+              + ['Total Facturas', 'Máx. Días Vencido', 'Saldo Contable'])
+    
+    def format_row(row):
+        return ([row['name'], row['document_number'], row['phone'], row['credit_days'], row['open_items'],
+                 row['partial_items']]
+                + [row[field] for field in buckets]
+                + [row['total'], row['max_overdue'], '' if row['ledger_balance'] is None else row['ledger_balance']])
+    
+    return csv_response(f'cartera_edades_{as_of.isoformat()}.csv', header, [report['rows']], format_row)
+
+STATEMENT_FORMATS = {
+    'pdf': {'writer': write_report_pdf, 'mimetype': 'application/pdf'},
+    'xlsx': {'writer': write_xlsx,
+             'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+}
+
+@accounting_bp.route('/financial_statements')
+@login_required
+def financial_statements_view():
+    """Estados financieros comparativos: situación financiera y resultados"""
+    statement = request.args.get('statement', 'balance_sheet')
+    if statement not in financial_statements.STATEMENTS:
+        statement = 'balance_sheet'
+    max_level = request.args.get('level', type=int)
+    output = request.args.get('format', 'html')
+    
+    period_ids = request.args.getlist('period_id', type=int)
+    if period_ids:
+        found = {period.id: period for period in AccountingPeriod.query.filter(AccountingPeriod.id.in_(period_ids)).all()}
+        selected = [found[period_id] for period_id in period_ids if period_id in found]
+    else:
+        selected = financial_statements.default_periods()
+    
+    report = financial_statements.generate(statement, selected, max_level) if selected else None
+    
+    if report and output in STATEMENT_FORMATS:
+        header, rows = financial_statements.export_table(report)
+        buffer = io.BytesIO()
+        try:
+            STATEMENT_FORMATS[output]['writer'](buffer, report['title'], header, rows)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('accounting.financial_statements_view', statement=statement,
+                                    period_id=[period.id for period in selected]))
+        buffer.seek(0)
+        return send_file(buffer,
+                         mimetype=STATEMENT_FORMATS[output]['mimetype'],
+                         as_attachment=True,
+                         download_name=f"{statement}_{'_'.join(str(period.id) for period in selected)}.{output}")
+    
+    periods = AccountingPeriod.query.order_by(desc(AccountingPeriod.start_date), AccountingPeriod.end_date).all()
+    
+    return render_template('accounting/financial_statements.html',
+                         report=report,
+                         statement=statement,
+                         statements=financial_statements.STATEMENTS,
                          periods=periods,
-                         selected_period_id=period_id)
+                         selected_ids=[period.id for period in selected],
+                         max_level=max_level)
 
 @accounting_bp.route('/api/accounts/search')
 def api_search_accounts():
@@ -391,4 +674,42 @@ def api_search_third_parties():
         'name': party.full_name or '',
         'document': party.document_number or '',
         'display': f"{party.full_name or 'Sin nombre'} ({party.document_number or 'Sin documento'})"
-    } for party in third_parties])
\ No newline at end of file
+    } for party in third_parties])
+
+@accounting_bp.cli.command('rebuild-balances')
+def rebuild_balances_command():
+    """Recompute the account balances of every period and the third-party balances from the posted journal entries"""
+    periods = account_balances.rebuild_account_balances()
+    click.echo(f'Saldos recalculados para {periods} períodos')
+
+@accounting_bp.cli.command('close-period')
+@click.argument('period_id', type=int)
+@click.option('--result-account', default=None, help='Código de la cuenta de resultado del ejercicio')
+def close_period_command(period_id, result_account):
+    """Close an accounting period and carry its balances to the next one"""
+    period = AccountingPeriod.query.get(period_id)
+    if period is None:
+        raise click.ClickException(f'No existe el período {period_id}')
+    entry = period_close.close_period(period, result_account or period_close.get_result_account_code())
+    click.echo(f'Período {period.name} cerrado' + (f', asiento de cierre {entry.entry_number}' if entry else ''))
+
+@accounting_bp.cli.command('rebuild-tree')
+def rebuild_tree_command():
+    """Recompute the materialized paths of the chart of accounts from parent_id"""
+    try:
+        accounts = account_tree.rebuild_paths()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    click.echo(f'Rutas recalculadas para {accounts} cuentas')
+
+@accounting_bp.cli.command('post-documents')
+@click.option('--batch-size', default=journal_posting.BATCH_SIZE, show_default=True, help='Documentos por transacción')
+def post_documents_command(batch_size):
+    """Post the journal entries of the sales and purchases not yet in the ledger"""
+    result = journal_posting.post_pending_documents(batch_size)
+    for source, counts in result.items():
+        click.echo(f"{source}: {counts['documents']} documentos, {counts['entries']} asientos")
+        if counts['skipped']:
+            click.echo(f"  omitidos por período cerrado: {', '.join(counts['skipped'])}")
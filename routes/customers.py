@@ -2,6 +2,8 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash
 from auth import login_required
 from models import Customer, Department, City, db
 from utils.pagination import paginate_query
+from utils.cache import bump_data_version
+from utils import dashboard_metrics
 from sqlalchemy import or_
 
 customers_bp = Blueprint('customers', __name__)
@@ -67,6 +69,8 @@ def new_customer():
             customer.update_full_name()
             
             db.session.add(customer)
+            dashboard_metrics.increment(dashboard_metrics.customer_metric(customer))
+            bump_data_version('customers')
             db.session.commit()
             
             flash('Cliente creado exitosamente', 'success')
@@ -86,6 +90,7 @@ def edit_customer(id):
     
     if request.method == 'POST':
         try:
+            previous_metric = dashboard_metrics.customer_metric(customer)
             customer.type = request.form['type']
             customer.document_type = request.form.get('document_type')
             customer.document_number = request.form.get('document_number')
@@ -108,6 +113,12 @@ def edit_customer(id):
             # Actualizar nombre completo
             customer.update_full_name()
             
+            # Moving between clients and suppliers changes both counters
+            if customer.is_active and dashboard_metrics.customer_metric(customer) != previous_metric:
+                dashboard_metrics.increment(previous_metric, -1)
+                dashboard_metrics.increment(dashboard_metrics.customer_metric(customer))
+            
+            bump_data_version('customers')
             db.session.commit()
             
             flash('Cliente actualizado exitosamente', 'success')
@@ -127,6 +138,8 @@ def toggle_status(id):
     customer.is_active = not customer.is_active
     
     try:
+        dashboard_metrics.increment(dashboard_metrics.customer_metric(customer), 1 if customer.is_active else -1)
+        bump_data_version('customers')
         db.session.commit()
         status = 'activado' if customer.is_active else 'desactivado'
         flash(f'Cliente {status} exitosamente', 'success')
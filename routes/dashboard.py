@@ -1,82 +1,92 @@
-from flask import Blueprint, render_template, session
+from flask import Blueprint, render_template, jsonify, abort
 from auth import login_required, get_current_user
-from models import Product, Sale, Purchase, Customer, Inventory, db
-from sqlalchemy import func, text
-from datetime import datetime, timedelta
-from app import cache
+from models import Sale, db
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload
+from datetime import datetime
+from utils import sales_rollup, dashboard_metrics
+from utils.cache import cached_report
+import click
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+LOW_STOCK_SQL = text("""
+    SELECT p.name, p.sku, i.quantity, i.min_stock, w.name as warehouse
+    FROM products p
+    JOIN inventory i ON p.id = i.product_id
+    JOIN warehouses w ON i.warehouse_id = w.id
+    WHERE i.quantity <= i.min_stock AND i.min_stock > 0
+    ORDER BY (i.quantity / NULLIF(i.min_stock, 0)) ASC
+    LIMIT 10
+""")
+
+def _low_stock(today):
+    return {'low_stock': db.session.execute(LOW_STOCK_SQL).fetchall()}
+
+def _recent_sales(today):
+    return {'recent_sales': Sale.query.options(joinedload(Sale.customer))
+            .order_by(Sale.created_at.desc()).limit(5).all()}
+
+def _top_products(today):
+    return {'top_products': [
+        {'name': row.product_name, 'sku': row.sku,
+         'total_sold': row.total_quantity, 'total_revenue': row.total_revenue}
+        for row in sales_rollup.top_products(today.replace(day=1), today)
+    ]}
+
+# Each widget is a fragment loaded by the page on its own, cached until one of
+# its domains changes or its timeout (seconds) runs out
+WIDGETS = {
+    'low_stock': {'builder': _low_stock, 'domains': ('inventory', 'catalog'), 'timeout': 300},
+    'recent_sales': {'builder': _recent_sales, 'domains': ('sales', 'customers'), 'timeout': 120},
+    'top_products': {'builder': _top_products, 'domains': ('sales', 'catalog'), 'timeout': 900},
+}
+
 @dashboard_bp.route('/dashboard')
 @login_required
 def index():
     user = get_current_user()
-    
-    # Cache key based on user and current hour for fresh data
-    cache_key = f"dashboard_stats_{user.id}_{datetime.now().hour}"
-    
-    @cache.memoize(timeout=300)  # 5 minutes cache
-    def get_dashboard_stats():
-        today = datetime.now().date()
-        month_start = today.replace(day=1)
-        
-        # Basic counts
-        total_products = Product.query.filter_by(is_active=True).count()
-        total_customers = Customer.query.filter_by(is_active=True, type='client').count()
-        total_suppliers = Customer.query.filter_by(is_active=True, type='supplier').count()
-        
-        # Sales stats
-        today_sales = db.session.query(func.sum(Sale.total)).filter(
-            func.date(Sale.created_at) == today
-        ).scalar() or 0
-        
-        month_sales = db.session.query(func.sum(Sale.total)).filter(
-            Sale.created_at >= month_start
-        ).scalar() or 0
-        
-        # Low stock products
-        low_stock_query = text("""
-            SELECT p.name, p.sku, i.quantity, i.min_stock, w.name as warehouse
-            FROM products p
-            JOIN inventory i ON p.id = i.product_id
-            JOIN warehouses w ON i.warehouse_id = w.id
-            WHERE i.quantity <= i.min_stock AND i.min_stock > 0
-            ORDER BY (i.quantity / NULLIF(i.min_stock, 0)) ASC
-            LIMIT 10
-        """)
-        
-        low_stock = db.session.execute(low_stock_query).fetchall()
-        
-        # Recent sales
-        recent_sales = Sale.query.join(Customer).order_by(Sale.created_at.desc()).limit(5).all()
-        
-        # Top selling products this month
-        top_products_query = text("""
-            SELECT p.name, p.sku, SUM(sd.quantity) as total_sold, SUM(sd.total) as total_revenue
-            FROM products p
-            JOIN sale_details sd ON p.id = sd.product_id
-            JOIN sales s ON sd.sale_id = s.id
-            WHERE s.created_at >= :month_start
-            GROUP BY p.id, p.name, p.sku
-            ORDER BY total_sold DESC
-            LIMIT 10
-        """)
-        
-        top_products = db.session.execute(top_products_query, {"month_start": month_start}).fetchall()
-        
-        return {
-            'total_products': total_products,
-            'total_customers': total_customers,
-            'total_suppliers': total_suppliers,
-            'today_sales': today_sales,
-            'month_sales': month_sales,
-            'low_stock': low_stock,
-            'recent_sales': recent_sales,
-            'top_products': top_products
-        }
-    
-    stats = get_dashboard_stats()
-    
-    return render_template('dashboard.html', 
+
+    # Only the counters are read here: one keyed read, the widgets load afterwards
+    metrics = dashboard_metrics.dashboard_metrics()
+
+    return render_template('dashboard.html',
                          user=user,
-                         **stats)
+                         widgets=WIDGETS,
+                         **metrics)
+
+@dashboard_bp.route('/dashboard/widgets/<name>')
+@login_required
+def widget(name):
+    """Rendered HTML of one dashboard widget"""
+    config = WIDGETS.get(name)
+    if config is None:
+        abort(404)
+
+    today = datetime.now().date()
+    return cached_report(
+        f'dashboard_widget_{name}', {'today': today.isoformat()}, config['domains'],
+        lambda: render_template(f'dashboard/{name}.html', **config['builder'](today)),
+        timeout=config['timeout']
+    )
+
+@dashboard_bp.route('/dashboard/live')
+@login_required
+def live():
+    """Counters of the live dashboard, refreshed on pushed events"""
+    metrics = dashboard_metrics.dashboard_metrics()
+    return jsonify({
+        'total_products': metrics['total_products'],
+        'total_customers': metrics['total_customers'],
+        'today_sales': float(metrics['today_sales']),
+        'today_count': metrics['today_count'],
+        'month_sales': float(metrics['month_sales']),
+        'month_count': metrics['month_count'],
+        'low_stock_count': metrics['low_stock_count']
+    })
+
+@dashboard_bp.cli.command('rebuild-metrics')
+def rebuild_metrics_command():
+    """Recompute the dashboard counters from products, customers, inventory and the sales rollups"""
+    dashboard_metrics.rebuild_metrics()
+    click.echo('Indicadores del dashboard recalculados')
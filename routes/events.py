@@ -0,0 +1,29 @@
+from flask import Blueprint, Response, request, current_app
+from auth import login_required
+from utils.events import broker, ensure_listener, sse_stream, streaming_available
+
+events_bp = Blueprint('events', __name__)
+
+@events_bp.route('/stream')
+@login_required
+def stream():
+    """Server-sent events for the dashboard and POS, optionally for one warehouse"""
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    
+    # 204 tells EventSource not to reconnect; the page polls instead
+    if not streaming_available(request.environ):
+        return Response(status=204)
+    subscriber = broker.subscribe(current_app.config['SSE_MAX_STREAMS'])
+    if subscriber is None:
+        return Response(status=204)
+    ensure_listener(current_app._get_current_object())
+
+    def accept(message):
+        event_warehouse = message['data'].get('warehouse_id')
+        return not warehouse_id or event_warehouse is None or event_warehouse == warehouse_id
+
+    return Response(
+        sse_stream(subscriber, accept),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
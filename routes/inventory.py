@@ -1,9 +1,17 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
-from auth import login_required, get_current_user
-from models import Product, Category, Brand, ProductGroup, ProductLine, Warehouse, Inventory, SerialNumber, db
+from auth import login_required, admin_required, get_current_user
+from models import Product, Category, Brand, ProductGroup, ProductLine, Warehouse, Inventory, SerialNumber, PriceRuleJob, StockCount, db
 from utils.pagination import paginate_query
-from sqlalchemy import or_, text
+from utils.product_import import read_rows, import_products
+from utils.price_rules import parse_rule, preview_price_rule, apply_price_rule, PRICE_FIELDS, BASE_FIELDS
+from utils.cache import bump_data_version
+from utils import dashboard_metrics
+from utils.stock_count import record_scans, variance_query, count_summary, apply_count
+from utils.product_search import apply_product_search, search_products as run_product_search, product_to_dict, rebuild_search_index
+from utils.abc_classification import compute_abc_classification, product_ids_in_class, classes_for_products, CLASSES, WINDOW_DAYS as ABC_WINDOW_DAYS
+from sqlalchemy import text
 from app import cache
+import click
 import json
 
 inventory_bp = Blueprint('inventory', __name__)
@@ -16,18 +24,14 @@ def index():
     category_id = request.args.get('category_id', type=int)
     brand_id = request.args.get('brand_id', type=int)
     warehouse_id = request.args.get('warehouse_id', type=int)
+    abc_class = request.args.get('abc_class') if request.args.get('abc_class') in CLASSES else None
     
     # Build query with filters
     query = db.session.query(Product).filter_by(is_active=True)
     
     if search:
-        query = query.filter(
-            or_(
-                Product.name.ilike(f'%{search}%'),
-                Product.sku.ilike(f'%{search}%'),
-                Product.barcode.ilike(f'%{search}%')
-            )
-        )
+        # Ranked in SQL so the filters below and pagination see every match
+        query = apply_product_search(query, search)
     
     if category_id:
         query = query.filter_by(category_id=category_id)
@@ -35,6 +39,9 @@ def index():
     if brand_id:
         query = query.filter_by(brand_id=brand_id)
     
+    if abc_class:
+        query = query.filter(Product.id.in_(product_ids_in_class(abc_class, warehouse_id)))
+    
     # Get filter options
     categories = Category.query.filter_by(is_active=True).all()
     brands = Brand.query.filter_by(is_active=True).all()
@@ -61,6 +68,7 @@ def index():
         inventory_data = db.session.execute(inventory_query).fetchall()
     
     inventory_dict = {row.product_id: row.total_quantity for row in inventory_data}
+    abc_dict = classes_for_products([product.id for product in products], warehouse_id)
     
     return render_template('inventory/index.html',
                          products=products,
@@ -69,6 +77,9 @@ def index():
                          brands=brands,
                          warehouses=warehouses,
                          inventory_dict=inventory_dict,
+                         abc_dict=abc_dict,
+                         abc_classes=CLASSES,
+                         abc_class=abc_class,
                          search=search,
                          category_id=category_id,
                          brand_id=brand_id,
@@ -97,6 +108,7 @@ def new_product():
                 is_service=bool(request.form.get('is_service')),
                 track_serial=bool(request.form.get('track_serial'))
             )
+            product.update_search_text()
             
             db.session.add(product)
             db.session.flush()  # Get the product ID
@@ -112,7 +124,11 @@ def new_product():
                     max_stock=float(request.form.get('max_stock', 0))
                 )
                 db.session.add(inventory)
+                dashboard_metrics.track_low_stock(inventory, was_low=False)
             
+            dashboard_metrics.increment('products')
+            bump_data_version('catalog')
+            bump_data_version('inventory')
             db.session.commit()
             cache.clear()  # Clear cache after changes
             flash('Producto creado exitosamente', 'success')
@@ -133,6 +149,111 @@ def new_product():
                          groups=groups,
                          lines=lines)
 
+@inventory_bp.route('/product/import', methods=['GET', 'POST'])
+@login_required
+def import_products_file():
+    """Bulk product upsert by SKU from a CSV or XLSX catalog"""
+    result = None
+    
+    if request.method == 'POST':
+        file = request.files.get('import_file')
+        if not file or file.filename == '':
+            flash('No se seleccionó archivo', 'error')
+            return redirect(url_for('inventory.import_products_file'))
+        
+        try:
+            result = import_products(
+                read_rows(file.stream, file.filename),
+                create_missing=bool(request.form.get('create_missing'))
+            )
+            cache.clear()  # Single invalidation for the whole import
+            
+            if result['errors']:
+                flash(f"Importación finalizada con {len(result['errors'])} filas con errores", 'warning')
+            else:
+                flash('Importación finalizada exitosamente', 'success')
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al importar productos: {str(e)}', 'error')
+    
+    return render_template('inventory/import.html', result=result)
+
+@inventory_bp.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--create-missing', is_flag=True, help='Crear categorías, marcas, grupos y líneas inexistentes')
+def import_products_command(path, create_missing):
+    """Import a supplier catalog from the command line"""
+    with open(path, 'rb') as stream:
+        result = import_products(read_rows(stream, path), create_missing=create_missing)
+    cache.clear()
+    
+    click.echo(f"Procesadas: {result['processed']}  Nuevas: {result['inserted']}  "
+               f"Actualizadas: {result['updated']}  Errores: {len(result['errors'])}")
+    for error in result['errors']:
+        click.echo(f"  Fila {error['row']} ({error['sku']}): {error['error']}")
+
+@inventory_bp.route('/price_rules', methods=['GET', 'POST'])
+@admin_required
+def price_rules():
+    """Mass price update by category, brand, group or line"""
+    summary = None
+    
+    if request.method == 'POST':
+        try:
+            rule = parse_rule(request.form)
+            
+            if request.form.get('action') == 'apply':
+                job = apply_price_rule(rule, user_id=get_current_user().id)
+                flash(f'Precios actualizados en {job.affected_rows} productos', 'success')
+                return redirect(url_for('inventory.price_rules'))
+            
+            summary = preview_price_rule(rule)
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error en la regla de precios: {str(e)}', 'error')
+    
+    categories = Category.query.filter_by(is_active=True).all()
+    brands = Brand.query.filter_by(is_active=True).all()
+    groups = ProductGroup.query.filter_by(is_active=True).all()
+    lines = ProductLine.query.filter_by(is_active=True).all()
+    recent_jobs = PriceRuleJob.query.order_by(PriceRuleJob.created_at.desc()).limit(10).all()
+    
+    return render_template('inventory/price_rules.html',
+                         summary=summary,
+                         form=request.form,
+                         price_fields=PRICE_FIELDS,
+                         base_fields=BASE_FIELDS,
+                         categories=categories,
+                         brands=brands,
+                         groups=groups,
+                         lines=lines,
+                         recent_jobs=recent_jobs)
+
+@inventory_bp.route('/abc/compute', methods=['POST'])
+@admin_required
+def compute_abc():
+    try:
+        result = compute_abc_classification()
+        classes = result['classes']
+        flash(f"Clasificación ABC actualizada: {classes['A']} A, {classes['B']} B, {classes['C']} C", 'success')
+    except Exception as e:
+        flash(f'Error al calcular la clasificación ABC: {str(e)}', 'error')
+    return redirect(url_for('inventory.index'))
+
+@inventory_bp.cli.command('classify-abc')
+@click.option('--window', default=ABC_WINDOW_DAYS, show_default=True, help='Días de historial de ventas')
+def classify_abc_command(window):
+    """Nightly job: classify products A/B/C by revenue and margin per warehouse"""
+    result = compute_abc_classification(window_days=window)
+    classes = result['classes']
+    click.echo(f"Productos clasificados: {result['rows']}  A: {classes['A']}  B: {classes['B']}  C: {classes['C']}")
+
+@inventory_bp.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Recompute product search text and rebuild the search index"""
+    total = rebuild_search_index()
+    click.echo(f'Productos indexados: {total}')
+
 @inventory_bp.route('/product/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_product(id):
@@ -156,7 +277,9 @@ def edit_product(id):
             product.line_id = int(request.form['line_id']) if request.form.get('line_id') else None
             product.is_service = bool(request.form.get('is_service'))
             product.track_serial = bool(request.form.get('track_serial'))
+            product.update_search_text()
             
+            bump_data_version('catalog')
             db.session.commit()
             cache.clear()
             flash('Producto actualizado exitosamente', 'success')
@@ -203,38 +326,7 @@ def search_products():
     if len(search) < 2:
         return jsonify([])
     
-    # Search products with inventory
-    query = text("""
-        SELECT p.id, p.sku, p.name, p.barcode, p.price1, p.price2, p.price3, p.price4,
-               COALESCE(i.quantity, 0) as quantity, p.track_serial
-        FROM products p
-        LEFT JOIN inventory i ON p.id = i.product_id 
-        WHERE p.is_active = true 
-        AND (p.name ILIKE :search OR p.sku ILIKE :search OR p.barcode ILIKE :search)
-        AND (:warehouse_id IS NULL OR i.warehouse_id = :warehouse_id OR i.warehouse_id IS NULL)
-        ORDER BY p.name
-        LIMIT 20
-    """)
-    
-    results = db.session.execute(query, {
-        "search": f"%{search}%",
-        "warehouse_id": warehouse_id
-    }).fetchall()
-    
-    products = []
-    for row in results:
-        products.append({
-            'id': row.id,
-            'sku': row.sku,
-            'name': row.name,
-            'barcode': row.barcode,
-            'price1': float(row.price1 or 0),
-            'price2': float(row.price2 or 0),
-            'price3': float(row.price3 or 0),
-            'price4': float(row.price4 or 0),
-            'quantity': float(row.quantity or 0),
-            'track_serial': row.track_serial
-        })
+    products = [product_to_dict(row) for row in run_product_search(search, warehouse_id)]
     
     return jsonify(products)
 
@@ -259,6 +351,7 @@ def create_category():
             description=request.form.get('description')
         )
         db.session.add(category)
+        bump_data_version('catalog')
         db.session.commit()
         cache.clear()
         flash('Categoría creada exitosamente', 'success')
@@ -274,6 +367,7 @@ def edit_category(id):
     try:
         category.name = request.form['name']
         category.description = request.form.get('description')
+        bump_data_version('catalog')
         db.session.commit()
         cache.clear()
         flash('Categoría actualizada exitosamente', 'success')
@@ -304,6 +398,7 @@ def create_brand():
             description=request.form.get('description')
         )
         db.session.add(brand)
+        bump_data_version('catalog')
         db.session.commit()
         cache.clear()
         flash('Marca creada exitosamente', 'success')
@@ -319,6 +414,7 @@ def edit_brand(id):
     try:
         brand.name = request.form['name']
         brand.description = request.form.get('description')
+        bump_data_version('catalog')
         db.session.commit()
         cache.clear()
         flash('Marca actualizada exitosamente', 'success')
@@ -386,3 +482,93 @@ def stock_levels():
                          stock_data=stock_data,
                          warehouses=warehouses,
                          selected_warehouse=warehouse_id)
+
+@inventory_bp.route('/counts', methods=['GET', 'POST'])
+@login_required
+def stock_counts():
+    """Physical count sessions"""
+    if request.method == 'POST':
+        try:
+            count = StockCount(
+                warehouse_id=int(request.form['warehouse_id']),
+                description=request.form.get('description', '').strip() or None,
+                user_id=get_current_user().id
+            )
+            db.session.add(count)
+            db.session.commit()
+            flash('Conteo iniciado', 'success')
+            return redirect(url_for('inventory.stock_count', id=count.id))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error al iniciar conteo: {str(e)}', 'error')
+    
+    query = StockCount.query.order_by(StockCount.created_at.desc())
+    counts, pagination = paginate_query(query)
+    warehouses = Warehouse.query.filter_by(is_active=True).all()
+    
+    return render_template('inventory/counts.html',
+                         counts=counts,
+                         pagination=pagination,
+                         warehouses=warehouses)
+
+@inventory_bp.route('/counts/<int:id>')
+@login_required
+def stock_count(id):
+    count = StockCount.query.get_or_404(id)
+    show_all = request.args.get('all') == '1'
+    
+    lines, pagination = paginate_query(variance_query(count.id, only_differences=not show_all), per_page=50)
+    summary = count_summary(count.id)
+    
+    return render_template('inventory/count.html',
+                         count=count,
+                         lines=lines,
+                         pagination=pagination,
+                         summary=summary,
+                         show_all=show_all)
+
+@inventory_bp.route('/counts/<int:id>/scan', methods=['POST'])
+@login_required
+def stock_count_scan(id):
+    """Receive a batch of scans: {"scans": ["7701234", {"code": "SKU1", "quantity": 12}, ...]}"""
+    count = StockCount.query.get_or_404(id)
+    
+    try:
+        data = request.get_json() or {}
+        result = record_scans(count, data.get('scans', []))
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)})
+
+@inventory_bp.route('/counts/<int:id>/apply', methods=['POST'])
+@admin_required
+def apply_stock_count(id):
+    count = StockCount.query.get_or_404(id)
+    
+    try:
+        summary = apply_count(count, get_current_user().id, zero_missing=bool(request.form.get('zero_missing')))
+        cache.clear()
+        flash(f"Conteo aplicado: {summary['surplus_items'] + summary['shortage_items']} productos ajustados", 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al aplicar conteo: {str(e)}', 'error')
+    
+    return redirect(url_for('inventory.stock_count', id=id))
+
+@inventory_bp.route('/counts/<int:id>/cancel', methods=['POST'])
+@login_required
+def cancel_stock_count(id):
+    count = StockCount.query.get_or_404(id)
+    
+    try:
+        if count.status != 'open':
+            raise ValueError('El conteo no está abierto')
+        count.status = 'cancelled'
+        db.session.commit()
+        flash('Conteo cancelado', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al cancelar conteo: {str(e)}', 'error')
+    
+    return redirect(url_for('inventory.stock_counts'))
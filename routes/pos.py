@@ -1,12 +1,21 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, current_app
 from auth import login_required, get_current_user
 from models import Sale, SaleDetail, Customer, Product, Warehouse, Inventory, SerialNumber, db
 from utils.pdf_generator import generate_invoice_pdf
-from datetime import datetime
+from utils.cache import get_data_version
+from utils.product_search import find_exact_product, search_products, product_to_dict
+from utils.sales_rollup import schedule_rollup
+from utils import dashboard_metrics
+from utils.sale_costs import current_costs, capture_cost
+from datetime import datetime, timedelta
 import json
 
 pos_bp = Blueprint('pos', __name__)
 
+# Products are stamped before their transaction commits; re-send this much of the
+# previous window so rows committed late with an earlier updated_at are not missed
+CATALOG_SYNC_OVERLAP = timedelta(minutes=5)
+
 @pos_bp.route('/')
 @login_required
 def index():
@@ -48,10 +57,8 @@ def search_product():
     if len(search) < 1:
         return jsonify({'products': []})
     
-    # Try exact barcode match first
-    product = db.session.query(Product)\
-                .filter(Product.barcode == search, Product.is_active == True)\
-                .first()
+    # Try exact barcode or SKU match first
+    product = find_exact_product(search)
     
     if product:
         # Get inventory for this product
@@ -78,41 +85,52 @@ def search_product():
             }]
         })
     
-    # Search by name or SKU
-    from sqlalchemy import text
-    query = text("""
-        SELECT p.id, p.sku, p.name, p.barcode, p.price1, p.price2, p.price3, p.price4,
-               COALESCE(i.quantity, 0) as quantity, p.track_serial
-        FROM products p
-        LEFT JOIN inventory i ON p.id = i.product_id AND i.warehouse_id = :warehouse_id
-        WHERE p.is_active = true 
-        AND (p.name ILIKE :search OR p.sku ILIKE :search)
-        ORDER BY p.name
-        LIMIT 10
-    """)
-    
-    results = db.session.execute(query, {
-        "search": f"%{search}%",
-        "warehouse_id": warehouse_id
-    }).fetchall()
+    # Ranked search by name, SKU prefix or barcode
+    products = [product_to_dict(row, exact_match=False)
+                for row in search_products(search, warehouse_id, limit=10)]
+    
+    return jsonify({'products': products})
+
+@pos_bp.route('/catalog_changes')
+@login_required
+def catalog_changes():
+    """Products changed since the catalog version known by the terminal"""
+    version = request.args.get('version', type=int)
+    since = request.args.get('since')
+    product_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.isdigit()]
+    
+    server_time = datetime.utcnow()
+    current_version = get_data_version('catalog')
     
     products = []
-    for row in results:
-        products.append({
-            'id': row.id,
-            'sku': row.sku,
-            'name': row.name,
-            'barcode': row.barcode,
-            'price1': float(row.price1 or 0),
-            'price2': float(row.price2 or 0),
-            'price3': float(row.price3 or 0),
-            'price4': float(row.price4 or 0),
-            'quantity': float(row.quantity or 0),
-            'track_serial': row.track_serial,
-            'exact_match': False
-        })
+    if since and version is not None and version != current_version:
+        try:
+            changed_since = datetime.fromisoformat(since) - CATALOG_SYNC_OVERLAP
+        except (ValueError, OverflowError):
+            # Malformed or truncated since from a till: re-send its cart products in full;
+            # the fresh since in the response gets it back on track
+            changed_since = None
+        query = Product.query
+        if changed_since:
+            query = query.filter(Product.updated_at >= changed_since)
+        if product_ids:
+            query = query.filter(Product.id.in_(product_ids))
+        changed = query.all() if changed_since or product_ids else []
+        products = [{
+            'id': product.id,
+            'name': product.name,
+            'price1': float(product.price1 or 0),
+            'price2': float(product.price2 or 0),
+            'price3': float(product.price3 or 0),
+            'price4': float(product.price4 or 0),
+            'is_active': product.is_active
+        } for product in changed]
     
-    return jsonify({'products': products})
+    return jsonify({
+        'version': current_version,
+        'since': server_time.isoformat(),
+        'products': products
+    })
 
 @pos_bp.route('/process_sale', methods=['POST'])
 @login_required
@@ -138,6 +156,8 @@ def process_sale():
             warehouse_id=warehouse_id,
             user_id=user.id,
             payment_method=data.get('payment_method', 'cash'),
+            # Credit sales stay open (receivable) until they are paid
+            payment_status='pending' if data.get('payment_method') == 'credit' else 'paid',
             subtotal=float(data['subtotal']),
             tax_amount=float(data.get('tax_amount', 0)),
             discount_amount=float(data.get('discount_amount', 0)),
@@ -148,6 +168,7 @@ def process_sale():
         db.session.flush()
         
         # Process sale details
+        costs = current_costs([int(item['product_id']) for item in data['items']])
         for item in data['items']:
             detail = SaleDetail(
                 sale_id=sale.id,
@@ -158,6 +179,7 @@ def process_sale():
                 discount_amount=float(item.get('discount_amount', 0)),
                 total=float(item['total'])
             )
+            capture_cost(detail, costs.get(int(item['product_id'])))
             
             db.session.add(detail)
             
@@ -168,8 +190,10 @@ def process_sale():
             ).first()
             
             if inventory:
+                was_low = dashboard_metrics.is_low_stock(inventory)
                 inventory.quantity -= float(item['quantity'])
                 inventory.last_updated = datetime.utcnow()
+                dashboard_metrics.track_low_stock(inventory, was_low)
             
             # Handle serial numbers if provided
             if 'serial_id' in item and item['serial_id']:
@@ -178,7 +202,10 @@ def process_sale():
                     serial.status = 'sold'
                     detail.serial_id = serial.id
         
+        dashboard_metrics.publish_sale(sale)
         db.session.commit()
+        # Daily rollups, sales counters and the sales/inventory versions follow in the background
+        schedule_rollup(current_app._get_current_object())
         
         return jsonify({
             'success': True,
@@ -1,8 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
-from auth import login_required, get_current_user
-from models import Purchase, PurchaseDetail, Customer, Product, Warehouse, Inventory, db
+from auth import login_required, admin_required, get_current_user
+from models import Purchase, PurchaseDetail, Customer, Product, Warehouse, Inventory, ReorderSuggestion, db
 from utils.pagination import paginate_query
+from utils.cache import bump_data_version
+from utils import dashboard_metrics
+from utils.reorder import compute_reorder_suggestions, suggestions_by_supplier, WINDOW_DAYS, LEAD_TIME_DAYS, REVIEW_DAYS
 from datetime import datetime
+import click
 import json
 
 purchases_bp = Blueprint('purchases', __name__)
@@ -86,8 +90,10 @@ def new_purchase():
                 ).first()
                 
                 if inventory:
+                    was_low = dashboard_metrics.is_low_stock(inventory)
                     inventory.quantity += float(item['quantity'])
                     inventory.last_updated = datetime.utcnow()
+                    dashboard_metrics.track_low_stock(inventory, was_low)
                 else:
                     # Create inventory record if it doesn't exist
                     inventory = Inventory(
@@ -111,6 +117,8 @@ def new_purchase():
             purchase.tax_amount = subtotal * tax_rate
             purchase.total = subtotal + purchase.tax_amount
             
+            bump_data_version('catalog')  # Product costs changed
+            bump_data_version('inventory')
             db.session.commit()
             
             flash('Compra registrada exitosamente', 'success')
@@ -127,6 +135,51 @@ def new_purchase():
                          suppliers=suppliers,
                          warehouses=warehouses)
 
+@purchases_bp.route('/reorder')
+@login_required
+def reorder_suggestions():
+    """Suggested purchases by supplier, read from the nightly reorder job"""
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    supplier_id = request.args.get('supplier_id', type=int)
+    
+    groups = suggestions_by_supplier(warehouse_id=warehouse_id, supplier_id=supplier_id)
+    last_run = db.session.query(db.func.max(ReorderSuggestion.computed_at)).scalar()
+    
+    suppliers = Customer.query.filter_by(type='supplier', is_active=True).all()
+    warehouses = Warehouse.query.filter_by(is_active=True).all()
+    
+    return render_template('purchases/reorder.html',
+                         groups=groups,
+                         last_run=last_run,
+                         suppliers=suppliers,
+                         warehouses=warehouses,
+                         warehouse_id=warehouse_id,
+                         supplier_id=supplier_id,
+                         window_days=WINDOW_DAYS,
+                         lead_time_days=LEAD_TIME_DAYS,
+                         review_days=REVIEW_DAYS)
+
+@purchases_bp.route('/reorder/compute', methods=['POST'])
+@admin_required
+def compute_reorder():
+    try:
+        result = compute_reorder_suggestions()
+        flash(f"Sugerencias recalculadas: {result['suggested']} productos por reponer", 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al calcular sugerencias de compra: {str(e)}', 'error')
+    
+    return redirect(url_for('purchases.reorder_suggestions'))
+
+@purchases_bp.cli.command('compute-reorder')
+@click.option('--window', default=WINDOW_DAYS, show_default=True, help='Días de historial de ventas')
+@click.option('--lead-time', default=LEAD_TIME_DAYS, show_default=True, help='Días de entrega del proveedor')
+@click.option('--review', default=REVIEW_DAYS, show_default=True, help='Días entre pedidos')
+def compute_reorder_command(window, lead_time, review):
+    """Nightly job: recompute reorder suggestions from sales velocity"""
+    result = compute_reorder_suggestions(window_days=window, lead_time_days=lead_time, review_days=review)
+    click.echo(f"Productos analizados: {result['rows']}  Por reponer: {result['suggested']}")
+
 @purchases_bp.route('/<int:id>')
 @login_required
 def view_purchase(id):
@@ -1,10 +1,21 @@
-from flask import Blueprint, render_template, request, jsonify, make_response
-from auth import login_required, get_current_user
-from models import Sale, Purchase, Product, Customer, Inventory, SaleDetail, PurchaseDetail, db
-from sqlalchemy import func, text, extract
+from flask import Blueprint, render_template, request, jsonify, abort, flash, redirect, url_for, send_file
+from auth import login_required, admin_required, get_current_user
+from models import Sale, ReportJob, db
+from sqlalchemy import func, text
 from datetime import datetime, timedelta
+from decimal import Decimal
+import click
 import json
 from utils.pagination import paginate_query
+from utils import sales_rollup
+from utils.export import stream_rows, csv_response
+from utils import snapshots
+from utils import report_jobs
+from utils.cache import cached_report
+from utils.parallel import run_parallel
+from utils.abc_classification import CLASSES as ABC_CLASSES
+from utils.sale_costs import backfill_sale_costs
+from utils.customer_stats import customer_stats_query, score_customers, rebuild_customer_stats, RFM_SEGMENTS
 
 reports_bp = Blueprint('reports', __name__)
 
@@ -20,6 +31,7 @@ def sales_report():
     end_date = request.args.get('end_date')
     customer_id = request.args.get('customer_id', type=int)
     warehouse_id = request.args.get('warehouse_id', type=int)
+    segment = request.args.get('segment', type=int)
     report_type = request.args.get('type', 'summary')
     
     # Default date range (last 30 days)
@@ -50,73 +62,142 @@ def sales_report():
                              customer_id=customer_id,
                              warehouse_id=warehouse_id)
     
-    # Summary report
-    summary = db.session.query(
-        func.count(Sale.id).label('total_sales'),
-        func.sum(Sale.subtotal).label('total_subtotal'),
-        func.sum(Sale.tax_amount).label('total_tax'),
-        func.sum(Sale.discount_amount).label('total_discount'),
-        func.sum(Sale.total).label('total_amount')
-    ).filter(
-        Sale.created_at >= datetime.strptime(start_date, '%Y-%m-%d'),
-        Sale.created_at <= datetime.strptime(end_date + ' 23:59:59', '%Y-%m-%d %H:%M:%S')
-    )
+    # Summary report: daily rollups unless a single customer is requested
+    period_start = datetime.strptime(start_date, '%Y-%m-%d').date()
+    period_end = datetime.strptime(end_date, '%Y-%m-%d').date()
+    
+    report_params = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'customer_id': customer_id,
+        'warehouse_id': warehouse_id,
+        'segment': segment
+    }
+    
+    from models import Customer, Warehouse
+    
+    # Independent queries run concurrently, each on its own session
+    tasks = {
+        'customers': lambda: Customer.query.filter_by(type='client', is_active=True).all(),
+        'warehouses': lambda: Warehouse.query.filter_by(is_active=True).all()
+    }
     
     if customer_id:
-        summary = summary.filter_by(customer_id=customer_id)
+        tasks['customer_summary'] = lambda: cached_report(
+            'sales_customer', report_params, ('sales', 'catalog'),
+            lambda: _customer_sales_summary(base_query.with_session(db.session()), customer_id,
+                                            start_date, end_date, warehouse_id)
+        )
+    else:
+        tasks['summary'] = lambda: cached_report(
+            'sales_summary', report_params, ('sales',),
+            lambda: sales_rollup.sales_summary(period_start, period_end, warehouse_id, segment)
+        )
+        tasks['daily_sales'] = lambda: cached_report(
+            'sales_daily', report_params, ('sales',),
+            lambda: sales_rollup.daily_sales(period_start, period_end, warehouse_id, segment)
+        )
+        
+        top_products = None
+        if request.args.get('source') == 'snapshot' and segment is None:
+            try:
+                top_products = snapshots.top_products_from_snapshot(start_date, end_date, warehouse_id)
+            except ValueError as e:
+                flash(str(e), 'warning')
+        
+        if top_products is None:
+            tasks['top_products'] = lambda: cached_report(
+                'sales_top_products', report_params, ('sales', 'catalog'),
+                lambda: sales_rollup.top_products(period_start, period_end, warehouse_id, segment)
+            )
     
-    if warehouse_id:
-        summary = summary.filter_by(warehouse_id=warehouse_id)
+    results = run_parallel(**tasks)
+    customers = results['customers']
+    warehouses = results['warehouses']
     
-    summary_data = summary.first()
+    if customer_id:
+        summary_data, daily_sales, top_products = results['customer_summary']
+    else:
+        summary_data = results['summary']
+        daily_sales = results['daily_sales']
+        top_products = results.get('top_products', top_products)
+    
+    return render_template('reports/sales_summary.html',
+                         summary=summary_data,
+                         daily_sales=daily_sales,
+                         top_products=top_products,
+                         customers=customers,
+                         warehouses=warehouses,
+                         start_date=start_date,
+                         end_date=end_date,
+                         customer_id=customer_id,
+                         warehouse_id=warehouse_id,
+                         segment=segment,
+                         segments=sales_rollup.SEGMENT_LABELS)
+
+def _customer_sales_summary(base_query, customer_id, start_date, end_date, warehouse_id):
+    """Summary for a single customer, read from sales (the rollups are kept by segment)"""
+    row = base_query.with_entities(
+        func.count(Sale.id),
+        func.coalesce(func.sum(Sale.subtotal), 0),
+        func.coalesce(func.sum(Sale.tax_amount), 0),
+        func.coalesce(func.sum(Sale.discount_amount), 0),
+        func.coalesce(func.sum(Sale.total), 0)
+    ).one()
+    
+    count = int(row[0] or 0)
+    total = Decimal(str(row[4] or 0))
+    summary = {
+        'total_transactions': count,
+        'total_subtotal': Decimal(str(row[1] or 0)),
+        'total_tax': Decimal(str(row[2] or 0)),
+        'total_discount': Decimal(str(row[3] or 0)),
+        'total_sales': total,
+        'avg_sale': total / count if count else Decimal('0')
+    }
+    
+    params = {
+        "start_date": start_date,
+        "end_date": end_date + ' 23:59:59',
+        "customer_id": customer_id,
+        "warehouse_id": warehouse_id
+    }
     
-    # Daily sales chart data
     daily_sales_query = text("""
         SELECT DATE(created_at) as sale_date, 
                COUNT(*) as sales_count,
                SUM(total) as daily_total
         FROM sales 
         WHERE created_at >= :start_date AND created_at <= :end_date
+        AND customer_id = :customer_id
+        AND (:warehouse_id IS NULL OR warehouse_id = :warehouse_id)
         GROUP BY DATE(created_at)
         ORDER BY sale_date
     """)
     
-    daily_sales = db.session.execute(daily_sales_query, {
-        "start_date": start_date,
-        "end_date": end_date + ' 23:59:59'
-    }).fetchall()
+    daily_sales = [
+        {'sale_date': datetime.strptime(str(day)[:10], '%Y-%m-%d').date(),
+         'sales_count': sales_count,
+         'daily_total': float(daily_total or 0)}
+        for day, sales_count, daily_total in db.session.execute(daily_sales_query, params)
+    ]
     
-    # Top selling products
     top_products_query = text("""
-        SELECT p.name, p.sku, SUM(sd.quantity) as total_sold, SUM(sd.total) as total_revenue
+        SELECT p.name as product_name, p.sku, SUM(sd.quantity) as total_quantity, SUM(sd.total) as total_revenue
         FROM products p
         JOIN sale_details sd ON p.id = sd.product_id
         JOIN sales s ON sd.sale_id = s.id
         WHERE s.created_at >= :start_date AND s.created_at <= :end_date
+        AND s.customer_id = :customer_id
+        AND (:warehouse_id IS NULL OR s.warehouse_id = :warehouse_id)
         GROUP BY p.id, p.name, p.sku
-        ORDER BY total_sold DESC
+        ORDER BY total_quantity DESC
         LIMIT 10
     """)
     
-    top_products = db.session.execute(top_products_query, {
-        "start_date": start_date,
-        "end_date": end_date + ' 23:59:59'
-    }).fetchall()
+    top_products = db.session.execute(top_products_query, params).fetchall()
     
-    from models import Customer, Warehouse
-    customers = Customer.query.filter_by(type='client', is_active=True).all()
-    warehouses = Warehouse.query.filter_by(is_active=True).all()
-    
-    return render_template('reports/sales_summary.html',
-                         summary=summary_data,
-                         daily_sales=daily_sales,
-                         top_products=top_products,
-                         customers=customers,
-                         warehouses=warehouses,
-                         start_date=start_date,
-                         end_date=end_date,
-                         customer_id=customer_id,
-                         warehouse_id=warehouse_id)
+    return summary, daily_sales, top_products
 
 @reports_bp.route('/inventory_report')
 @login_required
@@ -124,31 +205,21 @@ def inventory_report():
     warehouse_id = request.args.get('warehouse_id', type=int)
     category_id = request.args.get('category_id', type=int)
     show_zero = request.args.get('show_zero', type=bool)
+    abc_class = request.args.get('abc_class') if request.args.get('abc_class') in ABC_CLASSES else None
     
-    # Build inventory query
-    query = text("""
-        SELECT p.id, p.sku, p.name, p.cost, p.price1, 
-               c.name as category_name, b.name as brand_name,
-               w.name as warehouse_name,
-               i.quantity, i.min_stock, i.max_stock,
-               (i.quantity * p.cost) as inventory_value
-        FROM products p
-        LEFT JOIN categories c ON p.category_id = c.id
-        LEFT JOIN brands b ON p.brand_id = b.id
-        JOIN inventory i ON p.id = i.product_id
-        JOIN warehouses w ON i.warehouse_id = w.id
-        WHERE p.is_active = true
-        AND (:warehouse_id IS NULL OR i.warehouse_id = :warehouse_id)
-        AND (:category_id IS NULL OR p.category_id = :category_id)
-        AND (:show_zero OR i.quantity > 0)
-        ORDER BY p.name
-    """)
+    query = text(report_jobs.INVENTORY_SQL)
     
-    inventory_data = db.session.execute(query, {
+    report_params = {
         "warehouse_id": warehouse_id,
         "category_id": category_id,
-        "show_zero": show_zero
-    }).fetchall()
+        "show_zero": show_zero,
+        "abc_class": abc_class
+    }
+    
+    inventory_data = cached_report(
+        'inventory', report_params, ('inventory', 'catalog', 'classification'),
+        lambda: db.session.execute(query, report_params).fetchall()
+    )
     
     # Calculate totals
     total_value = sum(float(row.inventory_value or 0) for row in inventory_data)
@@ -166,33 +237,50 @@ def inventory_report():
                          warehouses=warehouses,
                          warehouse_id=warehouse_id,
                          category_id=category_id,
-                         show_zero=show_zero)
+                         show_zero=show_zero,
+                         abc_class=abc_class,
+                         abc_classes=ABC_CLASSES)
 
 @reports_bp.route('/customer_report')
 @login_required
 def customer_report():
     customer_type = request.args.get('type', 'client')
     
-    # Customer summary
-    customer_stats_query = text("""
-        SELECT c.id, c.full_name as name, c.email, c.phone,
-               COUNT(s.id) as total_orders,
-               COALESCE(SUM(s.total), 0) as total_spent,
-               MAX(s.created_at) as last_order_date
-        FROM customers c
-        LEFT JOIN sales s ON c.id = s.customer_id
-        WHERE c.type = :customer_type AND c.is_active = true
-        GROUP BY c.id, c.full_name, c.email, c.phone
-        ORDER BY total_spent DESC
-    """)
-    
-    customer_stats = db.session.execute(customer_stats_query, {
-        "customer_type": customer_type
-    }).fetchall()
+    if request.args.get('source') == 'snapshot':
+        try:
+            return render_template('reports/customers.html',
+                                 customer_stats=snapshots.customers_from_snapshot(customer_type),
+                                 customer_type=customer_type)
+        except ValueError as e:
+            flash(str(e), 'warning')
+    
+    # Customer summary from the maintained stats table
+    segment = request.args.get('segment') or None
+    sort = request.args.get('sort', 'spent')
+    direction = request.args.get('direction', 'desc')
+    
+    customer_stats, pagination = paginate_query(
+        customer_stats_query(customer_type, segment, sort, direction), per_page=50
+    )
     
     return render_template('reports/customers.html',
                          customer_stats=customer_stats,
-                         customer_type=customer_type)
+                         pagination=pagination,
+                         customer_type=customer_type,
+                         segment=segment,
+                         segments=RFM_SEGMENTS,
+                         sort=sort,
+                         direction=direction)
+
+@reports_bp.route('/customer_report/score', methods=['POST'])
+@admin_required
+def score_customer_report():
+    try:
+        scored = score_customers()
+        flash(f'Segmentación actualizada: {scored} clientes', 'success')
+    except Exception as e:
+        flash(f'Error al calcular la segmentación: {str(e)}', 'error')
+    return redirect(url_for('reports.customer_report'))
 
 @reports_bp.route('/profit_report')
 @login_required
@@ -205,33 +293,22 @@ def profit_report():
     if not end_date:
         end_date = datetime.now().strftime('%Y-%m-%d')
     
-    # Profit analysis by product
-    profit_query = text("""
-        SELECT p.name, p.sku,
-               SUM(sd.quantity) as total_sold,
-               AVG(p.cost) as avg_cost,
-               AVG(sd.unit_price) as avg_sell_price,
-               SUM(sd.total) as total_revenue,
-               SUM(sd.quantity * p.cost) as total_cost,
-               (SUM(sd.total) - SUM(sd.quantity * p.cost)) as gross_profit,
-               CASE 
-                   WHEN SUM(sd.total) > 0 THEN 
-                       ((SUM(sd.total) - SUM(sd.quantity * p.cost)) / SUM(sd.total)) * 100
-                   ELSE 0 
-               END as profit_margin
-        FROM products p
-        JOIN sale_details sd ON p.id = sd.product_id
-        JOIN sales s ON sd.sale_id = s.id
-        WHERE s.created_at >= :start_date AND s.created_at <= :end_date
-        GROUP BY p.id, p.name, p.sku
-        HAVING SUM(sd.quantity) > 0
-        ORDER BY gross_profit DESC
-    """)
-    
-    profit_data = db.session.execute(profit_query, {
-        "start_date": start_date,
-        "end_date": end_date + ' 23:59:59'
-    }).fetchall()
+    # Profit analysis by product, from the Parquet snapshots when requested
+    profit_data = None
+    if request.args.get('source') == 'snapshot':
+        try:
+            profit_data = snapshots.profit_from_snapshot(start_date, end_date)
+        except ValueError as e:
+            flash(str(e), 'warning')
+    
+    if profit_data is None:
+        profit_data = cached_report(
+            'profit', {'start_date': start_date, 'end_date': end_date}, ('sales', 'catalog'),
+            lambda: sales_rollup.profit_by_product(
+                datetime.strptime(start_date, '%Y-%m-%d').date(),
+                datetime.strptime(end_date, '%Y-%m-%d').date()
+            )
+        )
     
     # Overall profit summary
     total_revenue = sum(float(row.total_revenue) for row in profit_data)
@@ -251,12 +328,7 @@ def profit_report():
 @reports_bp.route('/export/<report_type>')
 @login_required
 def export_report(report_type):
-    """Export reports to CSV"""
-    import csv
-    import io
-    
-    output = io.StringIO()
-    
+    """Export reports to CSV, streamed from a server-side cursor"""
     if report_type == 'inventory':
         # Export inventory report
         warehouse_id = request.args.get('warehouse_id', type=int)
@@ -275,17 +347,16 @@ def export_report(report_type):
             ORDER BY p.name
         """)
         
-        data = db.session.execute(query, {"warehouse_id": warehouse_id}).fetchall()
-        
-        writer = csv.writer(output)
-        writer.writerow(['SKU', 'Nombre', 'Costo', 'Precio', 'Categoría', 'Marca', 'Bodega', 'Cantidad', 'Stock Min', 'Stock Max'])
+        header = ['SKU', 'Nombre', 'Costo', 'Precio', 'Categoría', 'Marca', 'Bodega', 'Cantidad', 'Stock Min', 'Stock Max']
         
-        for row in data:
-            writer.writerow([
+        def format_row(row):
+            return [
                 row.sku, row.name, row.cost, row.price1,
                 row.category or '', row.brand or '', row.warehouse,
                 row.quantity, row.min_stock, row.max_stock
-            ])
+            ]
+        
+        partitions = stream_rows(query, {"warehouse_id": warehouse_id})
     
     elif report_type == 'sales':
         # Export sales report
@@ -303,25 +374,123 @@ def export_report(report_type):
             ORDER BY s.created_at DESC
         """)
         
-        data = db.session.execute(query, {
-            "start_date": start_date,
-            "end_date": end_date + ' 23:59:59'
-        }).fetchall()
-        
-        writer = csv.writer(output)
-        writer.writerow(['Factura', 'Fecha', 'Cliente', 'Subtotal', 'Impuesto', 'Descuento', 'Total', 'Método Pago', 'Bodega'])
+        header = ['Factura', 'Fecha', 'Cliente', 'Subtotal', 'Impuesto', 'Descuento', 'Total', 'Método Pago', 'Bodega']
         
-        for row in data:
-            writer.writerow([
+        def format_row(row):
+            return [
                 row.invoice_number, row.created_at, row.customer or 'Cliente General',
                 row.subtotal, row.tax_amount, row.discount_amount, row.total,
                 row.payment_method, row.warehouse
-            ])
-    
-    output.seek(0)
+            ]
+        
+        partitions = stream_rows(query, {
+            "start_date": start_date,
+            "end_date": end_date + ' 23:59:59'
+        })
     
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv'
-    response.headers['Content-Disposition'] = f'attachment; filename={report_type}_report.csv'
+    else:
+        abort(404)
     
-    return response
+    return csv_response(f'{report_type}_report.csv', header, partitions, format_row)
+
+@reports_bp.route('/jobs', methods=['GET', 'POST'])
+@login_required
+def report_jobs_list():
+    """Queue a report in the background, or list the user's report jobs"""
+    user = get_current_user()
+    
+    if request.method == 'POST':
+        try:
+            job = report_jobs.submit_job(request.form.get('report_type'), request.form.to_dict(), user.id)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('reports.report_jobs_list'))
+        
+        if job.status == 'done':
+            flash('El reporte ya estaba generado con los datos actuales', 'info')
+        return redirect(url_for('reports.report_job', id=job.id))
+    
+    query = ReportJob.query
+    if user.role != 'admin':
+        query = query.filter_by(user_id=user.id)
+    jobs, pagination = paginate_query(query.order_by(ReportJob.created_at.desc()))
+    
+    return render_template('reports/jobs.html',
+                         jobs=jobs,
+                         pagination=pagination,
+                         reports=report_jobs.REPORTS,
+                         formats=report_jobs.FORMATS,
+                         job_format=report_jobs.job_format)
+
+def _get_user_job(id):
+    """Report job owned by the current user (any job for admins); 404 otherwise"""
+    user = get_current_user()
+    job = ReportJob.query.get_or_404(id)
+    if user.role != 'admin' and job.user_id != user.id:
+        abort(404)
+    return job
+
+@reports_bp.route('/jobs/<int:id>')
+@login_required
+def report_job(id):
+    job = _get_user_job(id)
+    return render_template('reports/job.html',
+                         job=job,
+                         params=json.loads(job.params or '{}'),
+                         report=report_jobs.REPORTS.get(job.report_type, {}),
+                         output=report_jobs.FORMATS[report_jobs.job_format(job)])
+
+@reports_bp.route('/jobs/<int:id>/status')
+@login_required
+def report_job_status(id):
+    job = _get_user_job(id)
+    return jsonify(report_jobs.job_status(job))
+
+@reports_bp.route('/jobs/<int:id>/download')
+@login_required
+def download_report_job(id):
+    job = _get_user_job(id)
+    if job.status != 'done' or not job.artifact_path:
+        abort(404)
+    
+    output = report_jobs.FORMATS[report_jobs.job_format(job)]
+    return send_file(job.artifact_path,
+                     mimetype=output['mimetype'],
+                     as_attachment=True,
+                     download_name=f"{job.report_type}_report_{job.id}.{output['extension']}")
+
+@reports_bp.cli.command('rollup-sales')
+@click.option('--rebuild', is_flag=True, help='Reconstruir los resúmenes desde todas las ventas')
+def rollup_sales_command(rebuild):
+    """Catch-up job: add sales not yet in the daily rollups"""
+    processed = sales_rollup.rebuild_rollups() if rebuild else sales_rollup.catch_up_rollups()
+    click.echo(f'Ventas procesadas: {processed}')
+
+@reports_bp.cli.command('backfill-sale-costs')
+def backfill_sale_costs_command():
+    """Fill the cost at sale time of old sale lines and rebuild the rollups that sum it"""
+    updated = backfill_sale_costs()
+    click.echo(f'Líneas de venta con costo: {updated}')
+    if updated:
+        processed = sales_rollup.rebuild_rollups()
+        click.echo(f'Ventas procesadas: {processed}')
+
+@reports_bp.cli.command('customer-stats')
+@click.option('--rebuild', is_flag=True, help='Recalcular los totales por cliente desde las ventas')
+def customer_stats_command(rebuild):
+    """Nightly job: recompute RFM scores and segments of the customer stats"""
+    scored = rebuild_customer_stats() if rebuild else score_customers()
+    click.echo(f'Clientes segmentados: {scored}')
+
+@reports_bp.cli.command('snapshot')
+@click.option('--full', is_flag=True, help='Borrar y regenerar todos los snapshots')
+def snapshot_command(full):
+    """Export sales, details, products, inventory and customers to Parquet"""
+    result = snapshots.export_snapshots(full=full)
+    click.echo(f"Ventas exportadas: {result['sales']} ({result['from'] or 'inicio'} - {result['to']})")
+
+@reports_bp.cli.command('run-jobs')
+def run_jobs_command():
+    """Run queued background reports in this process"""
+    processed = report_jobs.run_pending_jobs()
+    click.echo(f'Reportes generados: {processed}')
@@ -1,9 +1,12 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app
 from auth import login_required, get_current_user
 from models import Sale, SaleDetail, Customer, Product, Warehouse, Inventory, SerialNumber, db
 from utils.pagination import paginate_query
 from utils.pdf_generator import generate_invoice_pdf
 from utils.email_service import send_invoice_email
+from utils.sales_rollup import schedule_rollup
+from utils import dashboard_metrics
+from utils.sale_costs import capture_cost
 from sqlalchemy import text, func
 from datetime import datetime
 import json
@@ -65,6 +68,7 @@ def new_sale():
                 warehouse_id=int(request.form['warehouse_id']),
                 user_id=user.id,
                 payment_method=request.form['payment_method'],
+                payment_status='pending' if request.form['payment_method'] == 'credit' else 'paid',
                 notes=request.form.get('notes')
             )
             
@@ -90,6 +94,7 @@ def new_sale():
                     discount_amount=discount_amount,
                     total=total_line
                 )
+                capture_cost(detail, product.cost)
                 
                 db.session.add(detail)
                 
@@ -100,8 +105,10 @@ def new_sale():
                 ).first()
                 
                 if inventory:
+                    was_low = dashboard_metrics.is_low_stock(inventory)
                     inventory.quantity -= float(item['quantity'])
                     inventory.last_updated = datetime.utcnow()
+                    dashboard_metrics.track_low_stock(inventory, was_low)
                 
                 # Handle serial numbers
                 if product.track_serial and 'serial_numbers' in item:
@@ -122,7 +129,10 @@ def new_sale():
             sale.tax_amount = (subtotal - sale.discount_amount) * tax_rate
             sale.total = subtotal - sale.discount_amount + sale.tax_amount
             
+            dashboard_metrics.publish_sale(sale)
             db.session.commit()
+            # Daily rollups, sales counters and the sales/inventory versions follow in the background
+            schedule_rollup(current_app._get_current_object())
             
             flash('Venta registrada exitosamente', 'success')
             
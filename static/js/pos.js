@@ -8,6 +8,11 @@ class POSSystem {
         this.warehouse_id = null;
         this.searchTimeout = null;
         this.lastSale = null;
+        this.catalogVersion = null;
+        this.catalogSince = null;
+        this.searchResults = [];
+        this.events = null;
+        this.catalogPoll = null;
         
         this.init();
     }
@@ -18,6 +23,10 @@ class POSSystem {
         this.setupKeyboardShortcuts();
         this.focusSearchInput();
         
+        // Keep cart prices and stock in sync with changes pushed by the server
+        this.refreshCatalog();
+        this.connectEvents();
+        
         console.log('POS System initialized');
     }
     
@@ -212,6 +221,7 @@ class POSSystem {
     displaySearchResults(products) {
         const resultsContainer = $('#search_results');
         resultsContainer.empty();
+        this.searchResults = products || [];
         
         if (!products || products.length === 0) {
             resultsContainer.html('<div class="text-center p-3 text-muted">No se encontraron productos</div>');
@@ -234,7 +244,7 @@ class POSSystem {
                             <h6 class="mb-1">${product.name}</h6>
                             <small class="text-muted">
                                 SKU: ${product.sku} | 
-                                Stock: <span class="badge bg-${product.quantity > 0 ? 'success' : 'danger'}">${product.quantity}</span>
+                                Stock: <span class="badge stock-badge bg-${product.quantity > 0 ? 'success' : 'danger'}" data-product-id="${product.id}">${product.quantity}</span>
                             </small>
                             ${product.barcode ? `<br><small class="text-muted">Código: ${product.barcode}</small>` : ''}
                         </div>
@@ -333,9 +343,111 @@ class POSSystem {
         }
     }
     
+    connectEvents() {
+        if (!window.EventSource) {
+            this.startCatalogPolling();
+            return;
+        }
+        
+        const params = this.warehouse_id ? `?warehouse_id=${encodeURIComponent(this.warehouse_id)}` : '';
+        this.events = new EventSource(`/events/stream${params}`);
+        
+        this.events.addEventListener('stock', (e) => {
+            this.updateStock(JSON.parse(e.data));
+        });
+        
+        this.events.addEventListener('data_version', (e) => {
+            if (JSON.parse(e.data).domain === 'catalog') {
+                this.refreshCatalog();
+            }
+        });
+        
+        this.events.addEventListener('open', () => {
+            // Back from a disconnect: stop polling and pick up the changes that were missed
+            if (this.catalogPoll) {
+                this.stopCatalogPolling();
+                this.refreshCatalog();
+            }
+        });
+        
+        // The browser reconnects by itself; poll meanwhile
+        this.events.addEventListener('error', () => this.startCatalogPolling());
+    }
+    
+    startCatalogPolling() {
+        if (!this.catalogPoll) {
+            this.catalogPoll = setInterval(() => this.refreshCatalog(), 60000);
+        }
+    }
+    
+    stopCatalogPolling() {
+        clearInterval(this.catalogPoll);
+        this.catalogPoll = null;
+    }
+    
+    updateStock(stock) {
+        if (this.warehouse_id && String(stock.warehouse_id) !== String(this.warehouse_id)) return;
+        
+        const quantity = parseFloat(stock.quantity);
+        
+        this.searchResults.forEach(product => {
+            if (product.id === stock.product_id) {
+                product.quantity = quantity;
+            }
+        });
+        $(`#search_results .stock-badge[data-product-id="${stock.product_id}"]`)
+            .text(quantity)
+            .toggleClass('bg-success', quantity > 0)
+            .toggleClass('bg-danger', quantity <= 0);
+        
+        let updated = false;
+        this.cart.forEach(item => {
+            if (item.product_id === stock.product_id) {
+                item.stock = quantity;
+                updated = true;
+            }
+        });
+        if (updated) {
+            this.updateCartDisplay();
+        }
+    }
+    
+    refreshCatalog() {
+        $.get('/pos/catalog_changes', {
+            version: this.catalogVersion,
+            since: this.cart.length ? this.catalogSince : null,
+            ids: this.cart.map(item => item.product_id).join(',')
+        })
+        .done((data) => {
+            this.catalogVersion = data.version;
+            this.catalogSince = data.since;
+            
+            if (!data.products.length || !this.cart.length) return;
+            
+            const priceLevel = this.getCustomerPriceLevel();
+            let updated = false;
+            
+            data.products.forEach(product => {
+                this.cart.forEach(item => {
+                    if (item.product_id === product.id && !item.price_overridden) {
+                        item.unit_price = this.getProductPrice(product, priceLevel);
+                        updated = true;
+                    }
+                });
+            });
+            
+            if (updated) {
+                this.updateCartDisplay();
+                this.calculateTotals();
+                InventorySystem.showNotification('Precios actualizados en el carrito', 'info', 3000);
+            }
+        });
+    }
+    
     updatePrice(index, price) {
         if (index >= 0 && index < this.cart.length && price >= 0) {
             this.cart[index].unit_price = price;
+            this.cart[index].price_overridden = true;
             this.updateCartDisplay();
             this.calculateTotals();
         }
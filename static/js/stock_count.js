@@ -0,0 +1,100 @@
+// Physical stock count: scans are buffered and sent to the server in batches
+
+class StockCountScanner {
+    constructor(form) {
+        this.form = form;
+        this.scanUrl = form.data('scan-url');
+        this.queue = [];
+        this.sending = false;
+        this.sentUnits = 0;
+        this.batchSize = 200;
+        this.flushInterval = 2000;
+
+        this.init();
+    }
+
+    init() {
+        // Keyboard wedge scanners are detected by barcode.js
+        $(document).on('barcode:scanned', (e, data) => {
+            $('#count_code').val('');
+            this.addScan(data.barcode, 1);
+        });
+
+        // Manual entry (typed code + quantity)
+        this.form.on('submit', (e) => {
+            e.preventDefault();
+            const code = $('#count_code').val().trim();
+            const quantity = parseFloat($('#count_quantity').val()) || 1;
+            if (code) {
+                this.addScan(code, quantity);
+            }
+            $('#count_code').val('').focus();
+            $('#count_quantity').val(1);
+        });
+
+        setInterval(() => this.flush(), this.flushInterval);
+
+        // Do not lose buffered scans when leaving the page
+        $(window).on('beforeunload', () => {
+            if (this.queue.length) {
+                navigator.sendBeacon(this.scanUrl, new Blob(
+                    [JSON.stringify({ scans: this.queue })], { type: 'application/json' }
+                ));
+            }
+        });
+    }
+
+    addScan(code, quantity) {
+        this.queue.push({ code: code, quantity: quantity });
+        this.updateCounters();
+        if (this.queue.length >= this.batchSize) {
+            this.flush();
+        }
+    }
+
+    flush() {
+        if (this.sending || !this.queue.length) return;
+
+        const batch = this.queue.splice(0, this.queue.length);
+        this.sending = true;
+
+        $.ajax({
+            url: this.scanUrl,
+            method: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({ scans: batch })
+        })
+        .done((response) => {
+            if (response.success) {
+                this.sentUnits += response.accepted;
+                if (response.unknown.length) {
+                    $('#count_unknown').append(
+                        response.unknown.map(code => `<div>Código no encontrado: ${$('<span>').text(code).html()}</div>`).join('')
+                    );
+                }
+            } else {
+                InventorySystem.showNotification(response.message, 'error');
+            }
+        })
+        .fail(() => {
+            // Keep the batch for the next attempt
+            this.queue = batch.concat(this.queue);
+            InventorySystem.showNotification('Error enviando escaneos, se reintentará', 'warning');
+        })
+        .always(() => {
+            this.sending = false;
+            this.updateCounters();
+        });
+    }
+
+    updateCounters() {
+        $('#count_pending').text(this.queue.length);
+        $('#count_sent').text(this.sentUnits.toLocaleString());
+    }
+}
+
+$(document).ready(function() {
+    if ($('#count_scan_form').length) {
+        window.stockCountScanner = new StockCountScanner($('#count_scan_form'));
+    }
+});
@@ -0,0 +1,162 @@
+from datetime import datetime, date, timedelta
+from sqlalchemy import text, delete, select
+from models import ProductClassification, Inventory, Product
+from app import db
+from utils.cache import bump_data_version
+
+WINDOW_DAYS = 365
+A_SHARE = 0.80  # Products covering the first 80% of the warehouse total
+B_SHARE = 0.95  # Next 15%; the rest (and products without sales) are C
+INSERT_BATCH = 2000
+
+CLASSES = ('A', 'B', 'C')
+
+classifications = ProductClassification.__table__
+
+
+def _sales_totals(start):
+    """Revenue and cost of sales per product and warehouse since start"""
+    query = text("""
+        SELECT sd.product_id, s.warehouse_id,
+               SUM(sd.total) AS revenue, SUM(sd.quantity * sd.unit_cost) AS cost
+        FROM sale_details sd
+        JOIN sales s ON s.id = sd.sale_id
+        JOIN products p ON p.id = sd.product_id
+        WHERE s.created_at >= :start AND p.is_service = :is_service
+        GROUP BY sd.product_id, s.warehouse_id
+    """)
+    return db.session.execute(query, {'start': start, 'is_service': False})
+
+
+def _pareto_classes(np, groups, values):
+    """
+    Cumulative share and A/B/C class of each value within its group
+
+    Values are ranked from highest to lowest inside each group; an item is A
+    while the share accumulated before it is under A_SHARE, B under B_SHARE,
+    C otherwise. Zero and negative values are always C.
+    """
+    order = np.lexsort((-values, groups))
+    sorted_groups = groups[order]
+    positive = np.maximum(values[order], 0)
+
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    group_totals = np.repeat(np.add.reduceat(positive, starts), sizes)
+
+    cumulative = np.cumsum(positive)
+    cumulative -= np.repeat(cumulative[starts] - positive[starts], sizes)
+    share = np.zeros(len(order))
+    np.divide(cumulative, group_totals, out=share, where=group_totals > 0)
+    share_before = share - np.divide(positive, group_totals, out=np.zeros(len(order)), where=group_totals > 0)
+
+    classes = np.where(positive <= 0, 'C',
+                       np.where(share_before < A_SHARE, 'A',
+                                np.where(share_before < B_SHARE, 'B', 'C')))
+
+    # Back to the input order
+    result_share = np.empty(len(order))
+    result_class = np.empty(len(order), dtype='<U1')
+    result_share[order] = share
+    result_class[order] = classes
+    return result_share, result_class
+
+
+def compute_abc_classification(window_days=WINDOW_DAYS):
+    """
+    Classify every stocked product of each warehouse by revenue and by margin
+
+    Revenue and margin come from one aggregate query over the sale details of
+    the last window_days; ranking and cumulative shares are computed with
+    numpy per warehouse. Products with inventory but no sales are class C.
+    The classification table is replaced in a single transaction.
+
+    Returns:
+        dict: rows classified, count per revenue class and computed_at
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise ValueError('La clasificación ABC requiere el paquete numpy')
+
+    start = datetime.combine(date.today(), datetime.min.time()) - timedelta(days=window_days)
+
+    totals = {}
+    for row in _sales_totals(start):
+        revenue = float(row.revenue or 0)
+        totals[(row.product_id, row.warehouse_id)] = (revenue, revenue - float(row.cost or 0))
+
+    stocked = db.session.execute(
+        select(Inventory.product_id, Inventory.warehouse_id)
+        .join(Product, Product.id == Inventory.product_id)
+        .where(Product.is_active == True, Product.is_service == False)
+    ).all()
+    for product_id, warehouse_id in stocked:
+        totals.setdefault((product_id, warehouse_id), (0.0, 0.0))
+
+    computed_at = datetime.utcnow()
+    result = {'rows': 0, 'classes': dict.fromkeys(CLASSES, 0), 'computed_at': computed_at}
+
+    try:
+        db.session.execute(delete(classifications))
+
+        if totals:
+            keys = list(totals)
+            warehouses = np.array([warehouse_id for _, warehouse_id in keys])
+            revenue = np.array([totals[key][0] for key in keys])
+            margin = np.array([totals[key][1] for key in keys])
+
+            revenue_share, revenue_class = _pareto_classes(np, warehouses, revenue)
+            margin_share, margin_class = _pareto_classes(np, warehouses, margin)
+
+            records = [{
+                'product_id': product_id,
+                'warehouse_id': warehouse_id,
+                'revenue': round(float(revenue[i]), 2),
+                'margin': round(float(margin[i]), 2),
+                'revenue_share': round(float(revenue_share[i]), 4),
+                'margin_share': round(float(margin_share[i]), 4),
+                'revenue_class': str(revenue_class[i]),
+                'margin_class': str(margin_class[i]),
+                'computed_at': computed_at,
+            } for i, (product_id, warehouse_id) in enumerate(keys)]
+
+            for offset in range(0, len(records), INSERT_BATCH):
+                db.session.execute(classifications.insert(), records[offset:offset + INSERT_BATCH])
+
+            bump_data_version('classification')
+
+            result['rows'] = len(records)
+            for abc_class in CLASSES:
+                result['classes'][abc_class] = int(np.count_nonzero(revenue_class == abc_class))
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return result
+
+
+def product_ids_in_class(abc_class, warehouse_id=None, by='revenue'):
+    """Subquery of product ids with the given class (in a warehouse, or in any warehouse)"""
+    column = classifications.c.margin_class if by == 'margin' else classifications.c.revenue_class
+    query = select(classifications.c.product_id).where(column == abc_class)
+    if warehouse_id:
+        query = query.where(classifications.c.warehouse_id == warehouse_id)
+    return query
+
+
+def classes_for_products(product_ids, warehouse_id=None):
+    """product_id -> revenue class in the warehouse, or the best class across warehouses"""
+    if not product_ids:
+        return {}
+    query = select(classifications.c.product_id, classifications.c.revenue_class)\
+        .where(classifications.c.product_id.in_(product_ids))
+    if warehouse_id:
+        query = query.where(classifications.c.warehouse_id == warehouse_id)
+
+    result = {}
+    for product_id, abc_class in db.session.execute(query):
+        result[product_id] = min(result.get(product_id, abc_class), abc_class)
+    return result
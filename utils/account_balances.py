@@ -0,0 +1,251 @@
+from datetime import datetime, date
+from decimal import Decimal
+from sqlalchemy import text, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from models import AccountBalance, AccountingPeriod, JournalEntryDetail, ThirdPartyBalance
+from app import db
+from utils.cache import bump_data_version
+
+balances = AccountBalance.__table__
+third_party_balances = ThirdPartyBalance.__table__
+
+# Balances of one period: the closing balances of the last closed period
+# before it (if any) plus the posted entries after that period up to its end.
+# Movement before the period goes to the opening balance, the rest are its
+# debits and credits; without a closed period the scan starts at the first entry.
+PERIOD_BALANCES_SQL = """
+    INSERT INTO account_balances
+        (account_id, period_id, opening_balance, debit_total, credit_total, closing_balance, last_updated)
+    SELECT account_id, :period_id, SUM(opening), SUM(debit), SUM(credit),
+           SUM(opening) + SUM(debit) - SUM(credit), :now
+    FROM (
+        SELECT account_id, closing_balance AS opening, 0 AS debit, 0 AS credit
+        FROM account_balances
+        WHERE period_id = :base_period_id
+        UNION ALL
+        SELECT d.account_id,
+               CASE WHEN e.entry_date < :start
+                    THEN COALESCE(d.debit_amount, 0) - COALESCE(d.credit_amount, 0) ELSE 0 END,
+               CASE WHEN e.entry_date >= :start THEN COALESCE(d.debit_amount, 0) ELSE 0 END,
+               CASE WHEN e.entry_date >= :start THEN COALESCE(d.credit_amount, 0) ELSE 0 END
+        FROM journal_entry_details d
+        JOIN journal_entries e ON e.id = d.journal_entry_id
+        WHERE e.status = 'POSTED' AND e.entry_date > :base_end AND e.entry_date <= :end
+    ) movements
+    GROUP BY account_id
+"""
+
+# Balance of every account and third party from all the posted lines that name one
+THIRD_PARTY_BALANCES_SQL = """
+    INSERT INTO third_party_balances
+        (account_id, third_party_id, debit_total, credit_total, balance, last_updated)
+    SELECT d.account_id, d.third_party_id,
+           SUM(COALESCE(d.debit_amount, 0)), SUM(COALESCE(d.credit_amount, 0)),
+           SUM(COALESCE(d.debit_amount, 0) - COALESCE(d.credit_amount, 0)), :now
+    FROM journal_entry_details d
+    JOIN journal_entries e ON e.id = d.journal_entry_id
+    WHERE e.status = 'POSTED' AND d.third_party_id IS NOT NULL
+    GROUP BY d.account_id, d.third_party_id
+"""
+
+
+def _insert():
+    return postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+
+
+def _upsert(rows):
+    """Add the deltas of each row to the stored balance, creating missing rows"""
+    if not rows:
+        return
+    stmt = _insert()(balances).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['account_id', 'period_id'],
+        set_={
+            'opening_balance': balances.c.opening_balance + stmt.excluded.opening_balance,
+            'debit_total': balances.c.debit_total + stmt.excluded.debit_total,
+            'credit_total': balances.c.credit_total + stmt.excluded.credit_total,
+            'closing_balance': balances.c.closing_balance + stmt.excluded.closing_balance,
+            'last_updated': stmt.excluded.last_updated,
+        }
+    )
+    db.session.execute(stmt)
+
+
+def _upsert_third_parties(rows):
+    """Add the deltas of each row to the stored third-party balance, creating missing rows"""
+    if not rows:
+        return
+    stmt = _insert()(third_party_balances).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['account_id', 'third_party_id'],
+        set_={
+            'debit_total': third_party_balances.c.debit_total + stmt.excluded.debit_total,
+            'credit_total': third_party_balances.c.credit_total + stmt.excluded.credit_total,
+            'balance': third_party_balances.c.balance + stmt.excluded.balance,
+            'last_updated': stmt.excluded.last_updated,
+        }
+    )
+    db.session.execute(stmt)
+
+
+def _movements(entry):
+    """account_id -> (debit, credit) of a journal entry"""
+    rows = db.session.query(
+        JournalEntryDetail.account_id,
+        db.func.sum(JournalEntryDetail.debit_amount),
+        db.func.sum(JournalEntryDetail.credit_amount)
+    ).filter(JournalEntryDetail.journal_entry_id == entry.id)\
+     .group_by(JournalEntryDetail.account_id).all()
+    return {account_id: (debit or Decimal('0'), credit or Decimal('0')) for account_id, debit, credit in rows}
+
+
+def apply_movements(movements, sign=1):
+    """
+    Add (sign=1) or take out (sign=-1) movements from the account balances
+
+    movements maps (entry_date, account_id) to (debit, credit). The periods
+    containing each date get the debits and credits; every later period gets
+    the net movement in its opening balance. All rows go in one upsert,
+    inside the caller's transaction; periods containing the dates must be open.
+    """
+    if not movements:
+        return
+    dates = {entry_date for entry_date, _ in movements}
+    periods = AccountingPeriod.query.filter(AccountingPeriod.end_date >= min(dates)).all()
+    for period in periods:
+        if period.is_closed and any(period.start_date <= day <= period.end_date for day in dates):
+            raise ValueError(f'El período {period.name} está cerrado')
+
+    now = datetime.utcnow()
+    rows = {}
+    for (entry_date, account_id), (debit, credit) in movements.items():
+        debit, credit = sign * debit, sign * credit
+        for period in periods:
+            if period.end_date < entry_date:
+                continue
+            inside = period.start_date <= entry_date
+            row = rows.get((account_id, period.id))
+            if row is None:
+                row = rows[(account_id, period.id)] = {
+                    'account_id': account_id, 'period_id': period.id,
+                    'opening_balance': Decimal('0'), 'debit_total': Decimal('0'),
+                    'credit_total': Decimal('0'), 'closing_balance': Decimal('0'),
+                    'last_updated': now,
+                }
+            if inside:
+                row['debit_total'] += debit
+                row['credit_total'] += credit
+            else:
+                row['opening_balance'] += debit - credit
+            row['closing_balance'] += debit - credit
+    _upsert(list(rows.values()))
+    bump_data_version('accounting')
+
+
+def apply_third_party_movements(movements, sign=1):
+    """
+    Add (sign=1) or take out (sign=-1) movements from the third-party balances
+
+    movements maps (account_id, third_party_id) to (debit, credit); all rows
+    go in one upsert, inside the caller's transaction.
+    """
+    now = datetime.utcnow()
+    _upsert_third_parties([{
+        'account_id': account_id, 'third_party_id': third_party_id,
+        'debit_total': sign * debit, 'credit_total': sign * credit,
+        'balance': sign * (debit - credit), 'last_updated': now,
+    } for (account_id, third_party_id), (debit, credit) in movements.items() if third_party_id])
+
+
+def _third_party_movements(entry):
+    """(account_id, third_party_id) -> (debit, credit) of the lines of an entry that name a third party"""
+    rows = db.session.query(
+        JournalEntryDetail.account_id,
+        JournalEntryDetail.third_party_id,
+        db.func.sum(JournalEntryDetail.debit_amount),
+        db.func.sum(JournalEntryDetail.credit_amount)
+    ).filter(JournalEntryDetail.journal_entry_id == entry.id,
+             JournalEntryDetail.third_party_id.isnot(None))\
+     .group_by(JournalEntryDetail.account_id, JournalEntryDetail.third_party_id).all()
+    return {(account_id, third_party_id): (debit or Decimal('0'), credit or Decimal('0'))
+            for account_id, third_party_id, debit, credit in rows}
+
+
+def apply_entry(entry, sign=1):
+    """Add (sign=1) or take out (sign=-1) one entry's movements from the account and third-party balances"""
+    apply_movements({(entry.entry_date, account_id): movement
+                     for account_id, movement in _movements(entry).items()}, sign)
+    apply_third_party_movements(_third_party_movements(entry), sign)
+
+
+def post_entry(entry):
+    """Post a draft entry and add it to the balances, inside the caller's transaction"""
+    if entry.status != 'DRAFT':
+        raise ValueError(f'El asiento {entry.entry_number} no está en borrador')
+    if not entry.details:
+        raise ValueError(f'El asiento {entry.entry_number} no tiene movimientos')
+    if (entry.total_debit or 0) != (entry.total_credit or 0):
+        raise ValueError(f'El asiento {entry.entry_number} no está balanceado')
+
+    entry.status = 'POSTED'
+    entry.posted_at = datetime.utcnow()
+    apply_entry(entry)
+
+
+def reverse_entry(entry):
+    """Reverse a posted entry and take it out of the balances, inside the caller's transaction"""
+    if entry.status != 'POSTED':
+        raise ValueError('Solo se pueden anular asientos contabilizados')
+
+    entry.status = 'REVERSED'
+    apply_entry(entry, sign=-1)
+
+
+def base_period(period):
+    """The last closed period ending before this one starts, whose closing balances carry forward"""
+    return AccountingPeriod.query.filter(
+        AccountingPeriod.is_closed == True,
+        AccountingPeriod.end_date < period.start_date
+    ).order_by(AccountingPeriod.end_date.desc(), AccountingPeriod.start_date).first()
+
+
+def rebuild_period_balances(period):
+    """Recompute the balances of one period from the stored openings and posted entries (caller commits)"""
+    base = base_period(period)
+    db.session.execute(delete(balances).where(balances.c.period_id == period.id))
+    db.session.execute(text(PERIOD_BALANCES_SQL), {
+        'period_id': period.id, 'start': period.start_date, 'end': period.end_date,
+        'base_period_id': base.id if base else None,
+        'base_end': base.end_date if base else date.min,
+        'now': datetime.utcnow()
+    })
+
+
+def rebuild_third_party_balances():
+    """Recompute every third-party balance from the posted journal entries (caller commits)"""
+    db.session.execute(delete(third_party_balances))
+    db.session.execute(text(THIRD_PARTY_BALANCES_SQL), {'now': datetime.utcnow()})
+
+
+def rebuild_account_balances():
+    """
+    Recompute every account balance from the posted journal entries
+
+    One aggregate per period in date order, so each period starts from the
+    rebuilt closing balances of the last closed period, and one for the
+    third-party balances; a single transaction.
+
+    Returns:
+        int: number of periods rebuilt
+    """
+    periods = AccountingPeriod.query.order_by(AccountingPeriod.start_date).all()
+    try:
+        for period in periods:
+            rebuild_period_balances(period)
+        rebuild_third_party_balances()
+        bump_data_version('accounting')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(periods)
@@ -0,0 +1,137 @@
+import threading
+from types import SimpleNamespace
+from decimal import Decimal
+from sqlalchemy import update, bindparam
+from models import ChartOfAccounts
+from app import db
+from utils.cache import get_data_version, bump_data_version
+
+BALANCE_FIELDS = ('opening_balance', 'debit_total', 'credit_total', 'closing_balance')
+
+accounts_table = ChartOfAccounts.__table__
+
+_tree = {'version': None, 'tree': None}
+_tree_lock = threading.Lock()
+
+
+def path_ids(path):
+    """Ids of a materialized path, root first"""
+    return tuple(int(part) for part in (path or '').strip('/').split('/') if part)
+
+
+def assign_path(account):
+    """
+    Set the materialized path of a flushed account from its parent's
+
+    Call on account creation, inside the caller's transaction; the in-memory
+    tree is refreshed on the next read through the 'chart' data version.
+    """
+    parent_path = '/'
+    if account.parent_id:
+        parent = account.parent or ChartOfAccounts.query.get(account.parent_id)
+        if parent.path is None:
+            assign_path(parent)
+        parent_path = parent.path
+    account.path = f'{parent_path}{account.id}/'
+    bump_data_version('chart')
+
+
+def _paths_from_parents(parents):
+    """account_id -> materialized path, from an account_id -> parent_id map"""
+    paths = {}
+
+    def path_of(account_id, seen=()):
+        if account_id not in paths:
+            parent_id = parents.get(account_id)
+            if parent_id is None or parent_id in seen or parent_id not in parents:
+                paths[account_id] = f'/{account_id}/'
+            else:
+                paths[account_id] = f'{path_of(parent_id, seen + (account_id,))}{account_id}/'
+        return paths[account_id]
+
+    for account_id in parents:
+        path_of(account_id)
+    return paths
+
+
+def rebuild_paths():
+    """Recompute every materialized path from parent_id (caller commits)"""
+    parents = dict(db.session.query(ChartOfAccounts.id, ChartOfAccounts.parent_id).all())
+    rows = [{'account_id': account_id, 'new_path': path}
+            for account_id, path in _paths_from_parents(parents).items()]
+    if rows:
+        db.session.execute(
+            update(accounts_table).where(accounts_table.c.id == bindparam('account_id'))
+            .values(path=bindparam('new_path')),
+            rows
+        )
+    bump_data_version('chart')
+    return len(rows)
+
+
+def _build_tree():
+    rows = db.session.query(
+        ChartOfAccounts.id, ChartOfAccounts.code, ChartOfAccounts.name,
+        ChartOfAccounts.account_type, ChartOfAccounts.normal_balance,
+        ChartOfAccounts.level, ChartOfAccounts.is_detail_account,
+        ChartOfAccounts.is_active, ChartOfAccounts.parent_id, ChartOfAccounts.path
+    ).order_by(ChartOfAccounts.code).all()
+
+    # Accounts created before paths were kept fall back to walking parent_id
+    fallback = {}
+    if any(row.path is None for row in rows):
+        fallback = _paths_from_parents({row.id: row.parent_id for row in rows})
+
+    accounts = {}
+    for row in rows:
+        ids = path_ids(row.path or fallback.get(row.id))
+        accounts[row.id] = SimpleNamespace(
+            id=row.id, code=row.code, name=row.name, account_type=row.account_type,
+            normal_balance=row.normal_balance, level=row.level,
+            is_detail_account=row.is_detail_account, is_active=row.is_active,
+            parent_id=row.parent_id, ancestors=ids[:-1], depth=len(ids)
+        )
+    return SimpleNamespace(accounts=accounts, ordered=[accounts[row.id] for row in rows])
+
+
+def get_account_tree():
+    """
+    The chart of accounts in memory, ordered by code
+
+    Kept per process and rebuilt only when the 'chart' data version moves,
+    which costs one keyed lookup per call.
+    """
+    version = get_data_version('chart')
+    with _tree_lock:
+        if _tree['tree'] is None or _tree['version'] != version:
+            _tree['tree'] = _build_tree()
+            _tree['version'] = version
+        return _tree['tree']
+
+
+def rollup(tree, balances):
+    """
+    Totals of every account, from the balances of the accounts that hold them
+
+    One pass: each balance is added to its account and to all its ancestors.
+
+    Args:
+        tree: result of get_account_tree()
+        balances: rows with account_id and the BALANCE_FIELDS
+    Returns:
+        dict: account_id -> {field: Decimal}
+    """
+    totals = {}
+    for row in balances:
+        account = tree.accounts.get(row.account_id)
+        if account is None:
+            continue
+        values = [getattr(row, field) or Decimal('0') for field in BALANCE_FIELDS]
+        for account_id in account.ancestors + (account.id,):
+            node = totals.get(account_id)
+            if node is None:
+                totals[account_id] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    node[i] += value
+    return {account_id: dict(zip(BALANCE_FIELDS, values)) for account_id, values in totals.items()}
@@ -1,6 +1,8 @@
-from app import cache
+from app import cache, db
 from functools import wraps
 from flask import request
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
 import hashlib
 
 def cache_key(*args, **kwargs):
@@ -88,3 +90,53 @@ def clear_sales_cache():
         invalidate_cache_pattern('sales_*')
     except:
         pass
+
+def get_data_version(domain):
+    """Current version of a data domain (catalog, sales, inventory...)"""
+    from models import DataVersion
+    version = db.session.query(DataVersion.version).filter_by(domain=domain).scalar()
+    return version or 0
+
+def get_data_versions(domains):
+    """Current versions of several data domains in one query"""
+    from models import DataVersion
+    rows = db.session.query(DataVersion.domain, DataVersion.version)\
+        .filter(DataVersion.domain.in_(list(domains))).all()
+    versions = dict.fromkeys(domains, 0)
+    versions.update({domain: version or 0 for domain, version in rows})
+    return versions
+
+def report_cache_key(report, params, domains):
+    """
+    Cache key of a report result
+
+    Built from the normalized parameters (empty values dropped, sorted) and the
+    current version of every domain the report reads, so a write that bumps a
+    version makes the old entries unreachable.
+    """
+    versions = get_data_versions(domains)
+    normalized = {k: v for k, v in params.items() if v not in (None, '')}
+    return f"report:{report}:{cache_key(*(f'{d}@{versions[d]}' for d in sorted(versions)), **normalized)}"
+
+def cached_report(report, params, domains, builder, timeout=600):
+    """Return the cached result of builder() for these parameters and data versions"""
+    key = report_cache_key(report, params, domains)
+    result = cache.get(key)
+    if result is None:
+        result = builder()
+        cache.set(key, result, timeout=timeout)
+    return result
+
+def bump_data_version(domain):
+    """Increment a data domain version inside the caller's transaction"""
+    from models import DataVersion
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(DataVersion.__table__).values(domain=domain, version=1, updated_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['domain'],
+        set_={'version': DataVersion.__table__.c.version + 1, 'updated_at': stmt.excluded.updated_at}
+    )
+    db.session.execute(stmt)
+
+    from utils.events import publish
+    publish('data_version', domain=domain)
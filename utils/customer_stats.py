@@ -0,0 +1,161 @@
+from datetime import datetime
+from sqlalchemy import text, update, func, bindparam
+from models import Customer, CustomerStats
+from app import db
+
+SCORE_BATCH = 2000
+
+RFM_SEGMENTS = {
+    'champions': 'Campeones',
+    'loyal': 'Leales',
+    'potential': 'Potenciales',
+    'new': 'Nuevos',
+    'at_risk': 'En riesgo',
+    'hibernating': 'Inactivos',
+    'lost': 'Perdidos',
+}
+
+# Additive upsert of the sales matching {sales}; run by the sales rollup with the other daily tables
+CUSTOMER_STATS_SQL = """
+    INSERT INTO customer_stats (customer_id, orders_count, total_spent, avg_ticket,
+                                first_order_at, last_order_at, rfm_segment)
+    SELECT s.customer_id, COUNT(*), COALESCE(SUM(s.total), 0), COALESCE(AVG(s.total), 0),
+           MIN(s.created_at), MAX(s.created_at), 'new'
+    FROM sales s
+    WHERE {sales} AND s.customer_id IS NOT NULL
+    GROUP BY s.customer_id
+    ON CONFLICT (customer_id) DO UPDATE SET
+        orders_count = customer_stats.orders_count + excluded.orders_count,
+        total_spent = customer_stats.total_spent + excluded.total_spent,
+        avg_ticket = (customer_stats.total_spent + excluded.total_spent)
+                     / (customer_stats.orders_count + excluded.orders_count),
+        first_order_at = CASE WHEN customer_stats.first_order_at IS NULL
+                              OR excluded.first_order_at < customer_stats.first_order_at
+                         THEN excluded.first_order_at ELSE customer_stats.first_order_at END,
+        last_order_at = CASE WHEN customer_stats.last_order_at IS NULL
+                             OR excluded.last_order_at > customer_stats.last_order_at
+                        THEN excluded.last_order_at ELSE customer_stats.last_order_at END
+"""
+
+# Percentile rank keeps ties together (every one-order customer gets the same frequency score)
+RANKS_SQL = """
+    SELECT customer_id,
+           PERCENT_RANK() OVER (ORDER BY last_order_at) AS recency,
+           PERCENT_RANK() OVER (ORDER BY orders_count) AS frequency,
+           PERCENT_RANK() OVER (ORDER BY total_spent) AS monetary
+    FROM customer_stats
+    WHERE orders_count > 0
+"""
+
+SORT_COLUMNS = {
+    'name': Customer.full_name,
+    'orders': CustomerStats.orders_count,
+    'spent': CustomerStats.total_spent,
+    'avg_ticket': CustomerStats.avg_ticket,
+    'last_order': CustomerStats.last_order_at,
+}
+
+
+def _score(rank):
+    return min(int(rank * 5), 4) + 1
+
+
+def rfm_segment(recency, frequency):
+    """Segment from the recency and frequency scores"""
+    if recency >= 4 and frequency >= 4:
+        return 'champions'
+    if recency >= 3 and frequency >= 3:
+        return 'loyal'
+    if recency >= 4 and frequency <= 1:
+        return 'new'
+    if recency >= 3:
+        return 'potential'
+    if frequency >= 3:
+        return 'at_risk'
+    if recency == 2:
+        return 'hibernating'
+    return 'lost'
+
+
+def score_customers():
+    """
+    Recompute recency/frequency/monetary quintiles and segments for every customer with orders
+
+    Recency changes with time even without new sales, so this runs as a
+    periodic job; the per-sale update only keeps the totals current.
+    """
+    stats = CustomerStats.__table__
+    statement = update(stats).where(stats.c.customer_id == bindparam('b_customer_id')).values(
+        recency_score=bindparam('b_recency'),
+        frequency_score=bindparam('b_frequency'),
+        monetary_score=bindparam('b_monetary'),
+        rfm_segment=bindparam('b_segment'),
+        scored_at=bindparam('b_scored_at')
+    )
+    scored_at = datetime.utcnow()
+    scored = 0
+
+    try:
+        rows = db.session.execute(text(RANKS_SQL)).all()
+        for start in range(0, len(rows), SCORE_BATCH):
+            batch = []
+            for row in rows[start:start + SCORE_BATCH]:
+                recency, frequency = _score(row.recency), _score(row.frequency)
+                batch.append({
+                    'b_customer_id': row.customer_id,
+                    'b_recency': recency,
+                    'b_frequency': frequency,
+                    'b_monetary': _score(row.monetary),
+                    'b_segment': rfm_segment(recency, frequency),
+                    'b_scored_at': scored_at,
+                })
+            db.session.execute(statement, batch)
+            scored += len(batch)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return scored
+
+
+def rebuild_customer_stats():
+    """Recompute the totals of every customer from the sales already rolled up"""
+    from utils.sales_rollup import hold_rollup_lock  # sales_rollup imports CUSTOMER_STATS_SQL from here
+
+    try:
+        hold_rollup_lock()
+        db.session.execute(text("DELETE FROM customer_stats"))
+        # Sales still pending are added by the next rollup catch-up
+        db.session.execute(text(CUSTOMER_STATS_SQL.format(sales='s.rolled_up = :rolled_up')), {'rolled_up': True})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return score_customers()
+
+
+def customer_stats_query(customer_type='client', segment=None, sort='spent', direction='desc'):
+    """Customers with their stats, filtered and sorted on indexed columns; ready for paginate_query"""
+    query = db.session.query(
+        Customer.id,
+        Customer.full_name.label('name'),
+        Customer.email,
+        Customer.phone,
+        func.coalesce(CustomerStats.orders_count, 0).label('total_orders'),
+        func.coalesce(CustomerStats.total_spent, 0).label('total_spent'),
+        func.coalesce(CustomerStats.avg_ticket, 0).label('avg_ticket'),
+        CustomerStats.last_order_at.label('last_order_date'),
+        CustomerStats.recency_score,
+        CustomerStats.frequency_score,
+        CustomerStats.monetary_score,
+        CustomerStats.rfm_segment
+    ).outerjoin(CustomerStats, CustomerStats.customer_id == Customer.id)\
+     .filter(Customer.type == customer_type, Customer.is_active == True)
+
+    if segment:
+        query = query.filter(CustomerStats.rfm_segment == segment)
+
+    column = SORT_COLUMNS.get(sort, CustomerStats.total_spent)
+    order = column.asc() if direction == 'asc' else column.desc()
+    return query.order_by(order.nullslast(), Customer.id)
@@ -0,0 +1,183 @@
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import func, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from models import DashboardMetric, SalesDailyTotal, Product, Customer, Inventory
+from app import db
+from utils import events
+
+SALES_METRICS = ('sales_total', 'sales_count')
+COUNT_METRICS = {
+    'products': lambda: db.session.query(func.count(Product.id)).filter(Product.is_active == True),
+    'customers': lambda: db.session.query(func.count(Customer.id)).filter(
+        Customer.is_active == True, Customer.type == 'client'),
+    'suppliers': lambda: db.session.query(func.count(Customer.id)).filter(
+        Customer.is_active == True, Customer.type == 'supplier'),
+}
+
+metrics = DashboardMetric.__table__
+
+
+def _day(value):
+    return value.strftime('%Y-%m-%d')
+
+
+def _month(value):
+    return value.strftime('%Y-%m')
+
+
+def _upsert(rows, accumulate=True):
+    """Insert metric rows, adding to (or replacing) the stored value on conflict"""
+    if not rows:
+        return
+    now = datetime.utcnow()
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(metrics).values([dict(row, updated_at=now) for row in rows])
+    value = metrics.c.value + stmt.excluded.value if accumulate else stmt.excluded.value
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['metric', 'period', 'warehouse_id'],
+        set_={'value': value, 'updated_at': stmt.excluded.updated_at}
+    )
+    db.session.execute(stmt)
+
+
+def increment(metric, amount=1, period='', warehouse_id=0):
+    """Add amount to a counter inside the caller's transaction"""
+    _upsert([{'metric': metric, 'period': period, 'warehouse_id': warehouse_id, 'value': amount}])
+
+
+def publish_sale(sale):
+    """
+    Announce a new sale to live clients inside the caller's transaction
+
+    The sales counters themselves are reloaded from the daily rollups after
+    each catch-up batch (refresh_sales), so a ticket does not update shared
+    counter rows.
+    """
+    db.session.flush()
+    created_at = sale.created_at or datetime.utcnow()
+    events.publish('sale', sale_id=sale.id, invoice_number=sale.invoice_number,
+                   warehouse_id=sale.warehouse_id, total=sale.total or 0,
+                   customer=sale.customer.full_name if sale.customer else None,
+                   created_at=created_at.isoformat())
+
+
+def customer_metric(customer):
+    """Counter a customer belongs to while active"""
+    return 'suppliers' if customer.type == 'supplier' else 'customers'
+
+
+def is_low_stock(inventory):
+    """Same condition as the dashboard low-stock list"""
+    min_stock = inventory.min_stock or 0
+    return min_stock > 0 and (inventory.quantity or 0) <= min_stock
+
+
+def track_low_stock(inventory, was_low):
+    """
+    Move the warehouse low-stock counter when an inventory row crosses its minimum
+
+    Also publishes the new stock level, and the crossing itself, to live clients.
+    """
+    low = is_low_stock(inventory)
+    delta = int(low) - int(bool(was_low))
+    events.publish('stock', product_id=inventory.product_id, warehouse_id=inventory.warehouse_id,
+                   quantity=inventory.quantity or 0, min_stock=inventory.min_stock or 0)
+    if delta:
+        increment('low_stock', delta, '', inventory.warehouse_id)
+        product = inventory.product or Product.query.get(inventory.product_id)
+        events.publish('low_stock', low=low, product_id=inventory.product_id,
+                       warehouse_id=inventory.warehouse_id,
+                       name=product.name if product else '', sku=product.sku if product else '',
+                       quantity=inventory.quantity or 0, min_stock=inventory.min_stock or 0)
+
+
+def refresh_counts():
+    """Recount active products, customers and suppliers (after bulk imports)"""
+    _upsert([{'metric': metric, 'period': '', 'warehouse_id': 0, 'value': query().scalar() or 0}
+             for metric, query in COUNT_METRICS.items()], accumulate=False)
+
+
+def refresh_low_stock():
+    """Recount low-stock rows per warehouse (after bulk inventory updates)"""
+    counts = db.session.query(Inventory.warehouse_id, func.count(Inventory.id)).filter(
+        Inventory.min_stock > 0, Inventory.quantity <= Inventory.min_stock
+    ).group_by(Inventory.warehouse_id).all()
+    db.session.execute(delete(metrics).where(metrics.c.metric == 'low_stock'))
+    _upsert([{'metric': 'low_stock', 'period': '', 'warehouse_id': warehouse_id, 'value': count}
+             for warehouse_id, count in counts], accumulate=False)
+
+
+def refresh_sales(today=None):
+    """
+    Reload today's and this month's sales counters from the daily rollups
+
+    Run after every rollup catch-up batch; also drops
+    the counters of past days and months, which the dashboard no longer reads.
+    """
+    today = today or datetime.now().date()
+    month_start = today.replace(day=1)
+
+    db.session.execute(delete(metrics).where(metrics.c.metric.in_(SALES_METRICS)))
+
+    rows = []
+    for period, start in ((_day(today), today), (_month(today), month_start)):
+        totals = db.session.query(
+            SalesDailyTotal.warehouse_id,
+            func.sum(SalesDailyTotal.total),
+            func.sum(SalesDailyTotal.sales_count)
+        ).filter(SalesDailyTotal.day >= start, SalesDailyTotal.day <= today)\
+         .group_by(SalesDailyTotal.warehouse_id).all()
+        for warehouse_id, total, count in totals:
+            rows.append({'metric': 'sales_total', 'period': period, 'warehouse_id': warehouse_id,
+                         'value': total or 0})
+            rows.append({'metric': 'sales_count', 'period': period, 'warehouse_id': warehouse_id,
+                         'value': count or 0})
+    _upsert(rows, accumulate=False)
+
+
+def rebuild_metrics():
+    """Recompute every dashboard counter from the source tables"""
+    try:
+        refresh_counts()
+        refresh_low_stock()
+        refresh_sales()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def dashboard_metrics(today=None):
+    """
+    Every counter of the dashboard in one read
+
+    Returns:
+        dict: totals for the template plus per-warehouse sales and low stock
+    """
+    today = today or datetime.now().date()
+    day, month = _day(today), _month(today)
+    rows = db.session.query(metrics.c.metric, metrics.c.period, metrics.c.warehouse_id, metrics.c.value)\
+        .filter(metrics.c.period.in_(['', day, month])).all()
+
+    result = {
+        'total_products': 0, 'total_customers': 0, 'total_suppliers': 0,
+        'today_sales': Decimal('0'), 'today_count': 0,
+        'month_sales': Decimal('0'), 'month_count': 0,
+        'low_stock_count': 0,
+        'warehouses': {},
+    }
+    for metric, period, warehouse_id, value in rows:
+        value = Decimal(str(value or 0))
+        if metric in COUNT_METRICS:
+            result[f'total_{metric}'] = int(value)
+        elif metric == 'low_stock':
+            result['low_stock_count'] += int(value)
+            result['warehouses'].setdefault(warehouse_id, {})['low_stock'] = int(value)
+        elif metric in SALES_METRICS:
+            prefix = 'today' if period == day else 'month'
+            key = f'{prefix}_sales' if metric == 'sales_total' else f'{prefix}_count'
+            value = value if metric == 'sales_total' else int(value)
+            result[key] += value
+            result['warehouses'].setdefault(warehouse_id, {})[key] = value
+    return result
@@ -0,0 +1,186 @@
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from decimal import Decimal
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from app import db
+
+CHANNEL = 'sm2_events'
+SUBSCRIBER_QUEUE_SIZE = 200
+KEEPALIVE_SECONDS = 15
+STREAM_SECONDS = 300  # Streams end after this and the browser reconnects, freeing the worker thread
+PENDING_KEY = 'pending_events'
+NOTIFY_MAX_BYTES = 7900  # PostgreSQL rejects NOTIFY payloads of 8000 bytes or more
+
+
+class Broker:
+    """In-process fan-out of events to the SSE streams open in this worker"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, max_subscribers=None):
+        """New subscription, or None when this worker already holds max_subscribers streams"""
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if max_subscribers is not None and len(self._subscribers) >= max_subscribers:
+                return None
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def dispatch(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(payload)
+            except queue.Full:
+                # A stalled client misses events; it resyncs when it reconnects
+                pass
+
+
+broker = Broker()
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _json_default(value):
+    return float(value) if isinstance(value, Decimal) else str(value)
+
+
+def _use_notify():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def publish(event_type, **data):
+    """
+    Publish an event when the current transaction commits
+
+    Events are held on the session. On PostgreSQL they go out right before
+    commit as a single NOTIFY per transaction (a sale and all its stock
+    changes together), which the database only delivers on commit, to every
+    worker listening on CHANNEL. Elsewhere they are dispatched in this
+    process after commit. Rolled back transactions publish nothing.
+    """
+    payload = json.dumps({'type': event_type, 'data': data}, default=_json_default)
+    db.session.info.setdefault(PENDING_KEY, []).append(payload)
+
+
+def _notify_batches(payloads):
+    """JSON arrays of payloads, each small enough for one NOTIFY"""
+    batch, size = [], 2
+    for payload in payloads:
+        length = len(payload.encode('utf-8')) + 1
+        if batch and size + length > NOTIFY_MAX_BYTES:
+            yield '[' + ','.join(batch) + ']'
+            batch, size = [], 2
+        batch.append(payload)
+        size += length
+    if batch:
+        yield '[' + ','.join(batch) + ']'
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify_pending(session):
+    if not session.info.get(PENDING_KEY) or not _use_notify():
+        return
+    for batch in _notify_batches(session.info.pop(PENDING_KEY)):
+        session.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': CHANNEL, 'payload': batch})
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_pending(session):
+    for payload in session.info.pop(PENDING_KEY, []):
+        broker.dispatch(payload)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def _listen(app):
+    """LISTEN on a dedicated connection and hand every notification to the local broker"""
+    while True:
+        try:
+            with app.app_context():
+                raw = db.engine.raw_connection()
+            raw.detach()  # LISTEN state must not go back to the pool
+            connection = raw.driver_connection
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+
+            while True:
+                if select.select([connection], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    # One notification carries every event of a transaction
+                    for message in json.loads(connection.notifies.pop(0).payload):
+                        broker.dispatch(json.dumps(message))
+        except Exception:
+            logging.exception('Event listener disconnected, retrying')
+            time.sleep(5)
+
+
+def streaming_available(environ):
+    """
+    Whether this worker can hold a stream open without blocking other requests
+
+    A sync gunicorn worker serves one request at a time, so a stream would
+    take it over; threaded (gthread) and gevent workers can hold several.
+    """
+    if environ.get('wsgi.multithread'):
+        return True
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def ensure_listener(app):
+    """Start this worker's LISTEN thread the first time a stream opens (PostgreSQL only)"""
+    global _listener
+    if not _use_notify():
+        return
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=_listen, args=(app,), daemon=True, name='event-listener')
+            _listener.start()
+
+
+def sse_stream(subscriber, accept=None):
+    """
+    Server-sent events from a broker subscription
+
+    accept filters the events of this stream; comments are sent as keepalive
+    so proxies keep the connection open. The subscription is dropped when
+    the client disconnects or after STREAM_SECONDS.
+    """
+    try:
+        yield 'retry: 3000\n\n'
+        deadline = time.monotonic() + STREAM_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                payload = subscriber.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            message = json.loads(payload)
+            if accept and not accept(message):
+                continue
+            yield f"event: {message['type']}\ndata: {json.dumps(message['data'])}\n\n"
+    finally:
+        broker.unsubscribe(subscriber)
@@ -0,0 +1,115 @@
+import csv
+import gzip
+import io
+import zlib
+from flask import Response, request, stream_with_context
+from app import db
+
+STREAM_CHUNK_ROWS = 1000
+
+
+def stream_rows(query, params=None, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Yield lists of rows from a server-side cursor
+
+    Runs on its own connection so the cursor stays open while the response
+    is being sent; on PostgreSQL stream_results uses a named cursor and only
+    chunk_rows rows are held in memory at a time.
+    """
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_rows)\
+            .execute(query, params or {})
+        for partition in result.partitions():
+            yield partition
+
+
+def csv_chunks(header, partitions, row_formatter):
+    """Encode the header and each partition of rows as one CSV chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(header)
+    for rows in partitions:
+        writer.writerows(row_formatter(row) for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    """Gzip a byte stream incrementally, flushing after every chunk so the download progresses"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def csv_response(filename, header, partitions, row_formatter):
+    """
+    Streaming CSV download
+
+    Rows are written chunk by chunk as they come from the cursor; the body is
+    gzip-encoded on the fly when the client accepts it.
+    """
+    chunks = csv_chunks(header, partitions, row_formatter)
+    headers = {'Content-Disposition': f'attachment; filename={filename}'}
+
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+
+    return Response(stream_with_context(chunks), mimetype='text/csv', headers=headers)
+
+
+# ===== Archivos de reporte (artefactos de los reportes en segundo plano) =====
+
+def write_csv_gz(path, header, rows):
+    """Write rows to a gzip CSV file as they are produced; returns the row count"""
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(path, title, header, rows):
+    """
+    Write rows to an XLSX file with a write-only workbook
+
+    openpyxl streams write-only rows to a temporary file instead of keeping
+    the cells in memory, so memory stays flat however many rows there are.
+    """
+    try:
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+    except ImportError:
+        raise ValueError('La exportación a XLSX requiere el paquete openpyxl')
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title[:31])
+    sheet.freeze_panes = 'A2'
+
+    header_cells = []
+    for name in header:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = Font(bold=True)
+        header_cells.append(cell)
+    sheet.append(header_cells)
+
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+
+    workbook.save(path)
+    return count
@@ -0,0 +1,207 @@
+from decimal import Decimal
+from sqlalchemy import text
+from models import AccountingPeriod
+from app import db, cache
+from utils.account_tree import get_account_tree
+from utils.period_close import CLOSING_ENTRY_PREFIX
+
+CENT = Decimal('0.01')
+
+# Section -> (label, sign that shows the section's normal balance as positive)
+STATEMENTS = {
+    'balance_sheet': {
+        'title': 'Estado de Situación Financiera',
+        'sections': {'ACTIVO': ('Activos', 1), 'PASIVO': ('Pasivos', -1), 'PATRIMONIO': ('Patrimonio', -1)},
+    },
+    'income_statement': {
+        'title': 'Estado de Resultados',
+        'sections': {'INGRESO': ('Ingresos', -1), 'COSTO': ('Costos', 1), 'GASTO': ('Gastos', 1)},
+    },
+}
+
+RESULT_SECTIONS = ('INGRESO', 'COSTO', 'GASTO')
+
+# Stored balances of several periods in one read
+BALANCES_SQL = """
+    SELECT period_id, account_id, closing_balance, debit_total, credit_total
+    FROM account_balances
+    WHERE period_id IN ({periods})
+"""
+
+# Lines of the period closing entries, taken back out of the period
+# movement so the income statement shows the period before it was closed
+CLOSING_LINES_SQL = """
+    SELECT p.id AS period_id, d.account_id,
+           SUM(COALESCE(d.debit_amount, 0) - COALESCE(d.credit_amount, 0)) AS amount
+    FROM journal_entry_details d
+    JOIN journal_entries e ON e.id = d.journal_entry_id
+    JOIN accounting_periods p ON e.entry_date BETWEEN p.start_date AND p.end_date
+    WHERE p.id IN ({periods}) AND e.status = 'POSTED' AND e.entry_number LIKE :closing_prefix
+    GROUP BY p.id, d.account_id
+"""
+
+
+def section_of(account_type):
+    """Statement section of an account type (INGRESOS and INGRESO are the same section)"""
+    return (account_type or '').upper().rstrip('S')
+
+
+def _amount(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def _signed(sign, values):
+    # Decimal keeps the sign of zero; "or" turns -0 back into 0
+    return [sign * value or Decimal('0') for value in values]
+
+
+def _cache_key(period):
+    return f'financial_statements:{period.id}:{period.closed_date.isoformat() if period.closed_date else ""}'
+
+
+def _compute_amounts(periods):
+    """
+    period_id -> {'balance': {account_id: closing balance}, 'movement': {account_id: period movement}}
+
+    One read of the stored balances of all the periods and one of their
+    closing entries; the movement leaves the closing entries out.
+    """
+    if not periods:
+        return {}
+    ids = ', '.join(str(period.id) for period in periods)
+    amounts = {period.id: {'balance': {}, 'movement': {}} for period in periods}
+
+    for row in db.session.execute(text(BALANCES_SQL.format(periods=ids))):
+        period = amounts[row.period_id]
+        period['balance'][row.account_id] = _amount(row.closing_balance)
+        period['movement'][row.account_id] = _amount(row.debit_total) - _amount(row.credit_total)
+
+    closing = db.session.execute(text(CLOSING_LINES_SQL.format(periods=ids)),
+                                 {'closing_prefix': f'{CLOSING_ENTRY_PREFIX}%'})
+    for row in closing:
+        movement = amounts[row.period_id]['movement']
+        movement[row.account_id] = movement.get(row.account_id, Decimal('0')) - _amount(row.amount)
+    return amounts
+
+
+def period_amounts(periods):
+    """
+    Account amounts of each period, closed periods from the cache
+
+    A closed period never changes, so its amounts are kept without expiry;
+    open periods and closed ones not cached yet are read together.
+    """
+    amounts = {}
+    missing = []
+    for period in periods:
+        cached = cache.get(_cache_key(period)) if period.is_closed else None
+        if cached is None:
+            missing.append(period)
+        else:
+            amounts[period.id] = cached
+
+    for period_id, computed in _compute_amounts(missing).items():
+        amounts[period_id] = computed
+    for period in missing:
+        if period.is_closed:
+            cache.set(_cache_key(period), amounts[period.id], timeout=0)
+    return amounts
+
+
+def generate(statement, periods, max_level=None):
+    """
+    A financial statement with one comparative column per period
+
+    Every account amount of every period is added to the account and its
+    ancestors in one pass over the amounts; the balance sheet shows the
+    unclosed result of the year inside equity so that it balances.
+
+    Returns:
+        dict: title, columns, sections (rows and totals per column) and summary lines
+    """
+    config = STATEMENTS[statement]
+    tree = get_account_tree()
+    amounts = period_amounts(periods)
+    columns = len(periods)
+    field = 'balance' if statement == 'balance_sheet' else 'movement'
+
+    rolled = {}
+    section_totals = {section: [Decimal('0')] * columns for section in config['sections']}
+    unclosed_result = [Decimal('0')] * columns
+    for index, period in enumerate(periods):
+        for account_id, value in amounts[period.id][field].items():
+            account = tree.accounts.get(account_id)
+            if account is None or not value:
+                continue
+            section = section_of(account.account_type)
+            if section in section_totals:
+                section_totals[section][index] += value
+            for node in account.ancestors + (account.id,):
+                rolled.setdefault(node, [Decimal('0')] * columns)[index] += value
+        if statement == 'balance_sheet':
+            # Result accounts still open add up to the result of the year
+            for account_id, value in amounts[period.id]['balance'].items():
+                account = tree.accounts.get(account_id)
+                if account is not None and section_of(account.account_type) in RESULT_SECTIONS:
+                    unclosed_result[index] += value
+
+    sections = []
+    for section, (label, sign) in config['sections'].items():
+        rows = []
+        for account in tree.ordered:
+            values = rolled.get(account.id)
+            if section_of(account.account_type) != section or not values or not any(values):
+                continue
+            if max_level and account.depth > max_level:
+                continue
+            rows.append({
+                'code': account.code, 'name': account.name, 'depth': account.depth,
+                'is_detail_account': account.is_detail_account,
+                'values': _signed(sign, values),
+            })
+        total = _signed(sign, section_totals[section])
+        if statement == 'balance_sheet' and section == 'PATRIMONIO':
+            result = _signed(-1, unclosed_result)
+            if any(result):
+                rows.append({'code': '', 'name': 'Resultado del ejercicio', 'depth': 1,
+                             'is_detail_account': True, 'values': result})
+                total = [value + extra for value, extra in zip(total, result)]
+        sections.append({'key': section, 'label': label, 'rows': rows, 'total': total})
+
+    totals = {section['key']: section['total'] for section in sections}
+    if statement == 'balance_sheet':
+        summary = [('Total Pasivo y Patrimonio',
+                    [liabilities + equity for liabilities, equity in zip(totals['PASIVO'], totals['PATRIMONIO'])])]
+    else:
+        summary = [
+            ('Utilidad Bruta', [income - cost for income, cost in zip(totals['INGRESO'], totals['COSTO'])]),
+            ('Utilidad (Pérdida) Neta', [income - cost - expense for income, cost, expense
+                                         in zip(totals['INGRESO'], totals['COSTO'], totals['GASTO'])]),
+        ]
+
+    return {
+        'title': config['title'],
+        'columns': [period.name for period in periods],
+        'sections': sections,
+        'summary': summary,
+    }
+
+
+def export_table(report):
+    """Header and flat rows of a generated statement, for the PDF and XLSX writers"""
+    header = ['Código', 'Cuenta'] + report['columns']
+    rows = []
+    for section in report['sections']:
+        rows.append(['', section['label'].upper()] + [''] * len(report['columns']))
+        for row in section['rows']:
+            rows.append([row['code'], '  ' * (row['depth'] - 1) + row['name']] + row['values'])
+        rows.append(['', f"Total {section['label']}"] + section['total'])
+    for label, values in report['summary']:
+        rows.append(['', label] + values)
+    return header, rows
+
+
+def default_periods(limit=2):
+    """The latest periods started, newest first"""
+    return AccountingPeriod.query.order_by(AccountingPeriod.start_date.desc(),
+                                           AccountingPeriod.end_date).limit(limit).all()
@@ -0,0 +1,294 @@
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from sqlalchemy import text
+from models import AccountingPeriod
+from app import db
+
+PAGE_SIZE = 200
+CENT = Decimal('0.01')
+
+# Account codes are compared bytewise (COLLATE "C" on PostgreSQL), as
+# parse_filters and the page cursor compare them in Python; a locale collation
+# such as en_US.UTF-8 orders '1.1.10' and '1.10' the other way round and the
+# pages would skip or repeat accounts.
+ACCOUNT_RANGE = """
+    a.code{collate} >= :code_from AND (a.code{collate} <= :code_to OR a.code LIKE :code_prefix)
+"""
+
+# Balance of each account in the range when the report starts: the stored
+# opening balance of the last period starting on or before that day, plus
+# the posted movement between the period start and the report start.
+OPENINGS_SQL = f"""
+    SELECT movements.account_id, SUM(movements.amount) AS opening
+    FROM (
+        SELECT b.account_id, b.opening_balance AS amount
+        FROM account_balances b
+        WHERE b.period_id = :base_period_id
+        UNION ALL
+        SELECT d.account_id, COALESCE(d.debit_amount, 0) - COALESCE(d.credit_amount, 0)
+        FROM journal_entry_details d
+        JOIN journal_entries e ON e.id = d.journal_entry_id
+        WHERE e.status = 'POSTED' AND e.entry_date >= :base_start AND e.entry_date < :start
+    ) movements
+    JOIN chart_of_accounts a ON a.id = movements.account_id
+    WHERE {ACCOUNT_RANGE}
+    GROUP BY movements.account_id
+"""
+
+MOVEMENT_COLUMNS = """
+    a.id AS account_id, a.code AS account_code, a.name AS account_name,
+    e.id AS entry_id, e.entry_number, e.entry_date, d.id AS detail_id,
+    COALESCE(NULLIF(d.description, ''), e.description) AS description, d.reference,
+    t.full_name AS third_party,
+    COALESCE(d.debit_amount, 0) AS debit, COALESCE(d.credit_amount, 0) AS credit
+"""
+
+MOVEMENT_TABLES = """
+    FROM journal_entry_details d
+    JOIN journal_entries e ON e.id = d.journal_entry_id
+    JOIN chart_of_accounts a ON a.id = d.account_id
+    LEFT JOIN customers t ON t.id = d.third_party_id
+"""
+
+RUNNING_MOVEMENT = """
+    SUM(debit - credit) OVER (
+        PARTITION BY account_id ORDER BY entry_date, entry_id, detail_id
+        ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+    ) AS movement
+"""
+
+# One page of one account: walked in entry date order on idx_journal_entry_date
+# and stopped at the limit, then the window runs over the rows returned only.
+# movement is their running net; the opening (or the balance carried from the
+# previous page) is added afterwards.
+ACCOUNT_PAGE_SQL = f"""
+    SELECT page.*, {RUNNING_MOVEMENT}
+    FROM (
+        SELECT {MOVEMENT_COLUMNS}
+        {MOVEMENT_TABLES}
+        WHERE e.status = 'POSTED' AND e.entry_date >= :start AND e.entry_date <= :end
+          AND d.account_id = :account_id
+          {{keyset}}
+        ORDER BY e.entry_date, e.id, d.id
+        LIMIT :limit
+    ) page
+    ORDER BY entry_date, entry_id, detail_id
+"""
+
+KEYSET = """
+      AND (e.entry_date > :after_date OR (e.entry_date = :after_date AND
+           (e.id > :after_entry OR (e.id = :after_entry AND d.id > :after_id))))
+"""
+
+# The whole ledger in one pass, for the streamed export
+LEDGER_SQL = f"""
+    SELECT movements.*, {RUNNING_MOVEMENT}
+    FROM (
+        SELECT {MOVEMENT_COLUMNS}
+        {MOVEMENT_TABLES}
+        WHERE e.status = 'POSTED' AND e.entry_date >= :start AND e.entry_date <= :end
+          AND {ACCOUNT_RANGE}
+    ) movements
+    ORDER BY account_code{{collate}}, entry_date, entry_id, detail_id
+"""
+
+EXPORT_HEADER = ['Código', 'Cuenta', 'Fecha', 'Asiento', 'Descripción', 'Tercero', 'Referencia',
+                 'Débito', 'Crédito', 'Saldo']
+
+
+def _parse_date(value, default):
+    if not value:
+        return default
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('Fecha no válida, use el formato AAAA-MM-DD')
+
+
+def parse_filters(args):
+    """
+    Normalized ledger filters from request arguments
+
+    Without accounts the whole chart is included; a single code includes the
+    account and every account below it.
+    """
+    today = date.today()
+    start = _parse_date(args.get('start_date'), today.replace(day=1))
+    end = _parse_date(args.get('end_date'), today)
+    if start > end:
+        raise ValueError('La fecha inicial no puede ser posterior a la final')
+
+    code_from = (args.get('code_from') or '').strip()
+    code_to = (args.get('code_to') or '').strip() or code_from
+    if not code_from:
+        code_from, code_to = '0', code_to or '9'
+    if code_from > code_to:
+        code_from, code_to = code_to, code_from
+    return {'start': start, 'end': end, 'code_from': code_from, 'code_to': code_to}
+
+
+def _sql(template, **parts):
+    """Statement with the bytewise code collation of the current database"""
+    collate = ' COLLATE "C"' if db.engine.dialect.name == 'postgresql' else ''  # SQLite compares bytewise already
+    return text(template.format(collate=collate, **parts))
+
+
+def _range_params(filters):
+    return {'code_from': filters['code_from'], 'code_to': filters['code_to'],
+            'code_prefix': f"{filters['code_to']}.%"}
+
+
+def opening_balances(filters):
+    """account_id -> balance before the start date, from the stored period openings"""
+    base = AccountingPeriod.query.filter(AccountingPeriod.start_date <= filters['start'])\
+        .order_by(AccountingPeriod.start_date.desc(), AccountingPeriod.end_date).first()
+    rows = db.session.execute(_sql(OPENINGS_SQL), dict(
+        _range_params(filters),
+        base_period_id=base.id if base else None,
+        base_start=base.start_date if base else date.min,
+        start=filters['start']
+    ))
+    return {row.account_id: _amount(row.opening) for row in rows}
+
+
+def _accounts_with_movements(filters):
+    """
+    (id, code) of the accounts in the range that may have movements between the dates
+
+    When periods cover the dates, the stored period totals say which accounts
+    moved; otherwise every account with any journal line is kept.
+    """
+    periods = AccountingPeriod.query.filter(
+        AccountingPeriod.start_date <= filters['end'],
+        AccountingPeriod.end_date >= filters['start']
+    ).order_by(AccountingPeriod.start_date).all()
+
+    covered_to = filters['start']
+    for period in periods:
+        if period.start_date > covered_to:
+            break
+        covered_to = max(covered_to, period.end_date + timedelta(days=1))
+
+    if periods and covered_to > filters['end']:
+        sql = f"""
+            SELECT DISTINCT a.id, a.code
+            FROM chart_of_accounts a
+            JOIN account_balances b ON b.account_id = a.id
+            WHERE b.period_id IN ({', '.join(str(period.id) for period in periods)})
+              AND (b.debit_total <> 0 OR b.credit_total <> 0)
+              AND {ACCOUNT_RANGE}
+            ORDER BY a.code{{collate}}
+        """
+    else:
+        sql = f"""
+            SELECT a.id, a.code
+            FROM chart_of_accounts a
+            WHERE EXISTS (SELECT 1 FROM journal_entry_details d WHERE d.account_id = a.id)
+              AND {ACCOUNT_RANGE}
+            ORDER BY a.code{{collate}}
+        """
+    return db.session.execute(_sql(sql), _range_params(filters)).fetchall()
+
+
+def encode_cursor(row, balance):
+    return f'{row["account_code"]}|{row["entry_date"].isoformat()}|{row["entry_id"]}|{row["detail_id"]}|{balance}'
+
+
+def decode_cursor(value):
+    try:
+        code, day, entry_id, detail_id, balance = value.rsplit('|', 4)
+        return {'code': code, 'after_date': datetime.strptime(day, '%Y-%m-%d').date(),
+                'after_entry': int(entry_id), 'after_id': int(detail_id), 'carry': Decimal(balance)}
+    except (ValueError, ArithmeticError):
+        raise ValueError('Página del libro mayor no válida')
+
+
+def _to_date(value):
+    # Date columns come back as strings from raw SQLite queries
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _amount(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def ledger_page(filters, after=None, page_size=PAGE_SIZE):
+    """
+    One page of the general ledger, continuing after a cursor
+
+    Accounts are read one after the other with keyset pagination on (date,
+    entry, line), so a page costs the same however deep it is, even on an
+    account with hundreds of thousands of movements; the running balance
+    carries over in the cursor.
+
+    Returns:
+        dict: rows (with the opening and running balance of their account)
+              and the cursor of the next page (None on the last one)
+    """
+    cursor = decode_cursor(after) if after else None
+    openings = opening_balances(filters)
+    params = {'start': filters['start'], 'end': filters['end']}
+
+    rows = []
+    for account_id, code in _accounts_with_movements(filters):
+        if cursor and code < cursor['code']:
+            continue
+        continued = bool(cursor) and code == cursor['code']
+        keyset = KEYSET if continued else ''
+        account_params = dict(params, account_id=account_id, limit=page_size + 1 - len(rows))
+        if continued:
+            account_params.update(after_date=cursor['after_date'], after_entry=cursor['after_entry'],
+                                  after_id=cursor['after_id'])
+        opening = cursor['carry'] if continued else openings.get(account_id, Decimal('0'))
+
+        for row in db.session.execute(_sql(ACCOUNT_PAGE_SQL, keyset=keyset), account_params):
+            rows.append({
+                'account_id': row.account_id, 'account_code': row.account_code,
+                'account_name': row.account_name, 'entry_id': row.entry_id,
+                'entry_number': row.entry_number, 'entry_date': _to_date(row.entry_date),
+                'detail_id': row.detail_id, 'description': row.description,
+                'reference': row.reference, 'third_party': row.third_party,
+                'opening': opening, 'continued': continued,
+                'debit': _amount(row.debit), 'credit': _amount(row.credit),
+                'balance': opening + _amount(row.movement),
+            })
+        if len(rows) > page_size:
+            break
+
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    return {
+        'rows': rows,
+        'next': encode_cursor(rows[-1], rows[-1]['balance']) if has_next else None,
+    }
+
+
+def export_rows(filters, partitions):
+    """
+    CSV rows of the whole ledger, from partitions of a server-side cursor
+
+    An opening line goes before the movements of each account.
+    """
+    openings = opening_balances(filters)
+    day_before = (filters['start'] - timedelta(days=1)).isoformat()
+    account_id = None
+    for rows in partitions:
+        lines = []
+        for row in rows:
+            opening = openings.get(row.account_id, Decimal('0'))
+            if row.account_id != account_id:
+                account_id = row.account_id
+                lines.append([row.account_code, row.account_name, day_before, '', 'Saldo anterior',
+                              '', '', '', '', opening])
+            lines.append([row.account_code, row.account_name, _to_date(row.entry_date).isoformat(),
+                          row.entry_number, row.description, row.third_party or '', row.reference or '',
+                          _amount(row.debit), _amount(row.credit), opening + _amount(row.movement)])
+        yield lines
+
+
+def export_query(filters):
+    """Statement and parameters of the full ledger, for stream_rows"""
+    return (_sql(LEDGER_SQL),
+            dict(_range_params(filters), start=filters['start'], end=filters['end']))
@@ -0,0 +1,364 @@
+from datetime import datetime, date
+from decimal import Decimal
+from sqlalchemy import text, insert, update, select, func, bindparam
+from models import (JournalEntry, JournalEntryDetail, ChartOfAccounts, AccountingPeriod,
+                    Sale, Purchase, Setting)
+from app import db
+from utils.account_balances import apply_movements, apply_third_party_movements
+
+BATCH_SIZE = 5000
+CENT = Decimal('0.01')
+POSTING_LOCK_KEY = 731002  # pg advisory lock held by the run posting a batch
+
+MODE_KEY = 'accounting_posting_mode'
+START_DATE_KEY = 'accounting_posting_start_date'
+MODES = {
+    'document': 'Un asiento por documento',
+    'daily': 'Un asiento diario por bodega',
+}
+
+# Mapping -> (label, default account code from the initial chart)
+MAPPINGS = {
+    'cash': ('Caja (ventas de contado y compras pagadas)', '1.1.01.001'),
+    'receivable': ('Clientes (ventas a crédito)', '1.1.02.001'),
+    'revenue': ('Ingresos por ventas', '4.1.01.001'),
+    'sales_tax': ('IVA generado', ''),
+    'cogs': ('Costo de ventas', '5.1.01.001'),
+    'inventory': ('Inventario', '1.1.03.001'),
+    'payable': ('Proveedores', '2.1.01.001'),
+    'purchase_tax': ('IVA descontable', ''),
+}
+
+SOURCES = {
+    'sales': Sale,
+    'purchases': Purchase,
+}
+
+SALES_SQL = """
+    SELECT s.id, s.invoice_number, s.created_at, s.warehouse_id, s.customer_id,
+           s.payment_method, s.total, s.tax_amount, COALESCE(c.cost, 0) AS cost
+    FROM sales s
+    LEFT JOIN (
+        SELECT sale_id, SUM(quantity * COALESCE(unit_cost, 0)) AS cost
+        FROM sale_details
+        WHERE sale_id IN :ids
+        GROUP BY sale_id
+    ) c ON c.sale_id = s.id
+    WHERE s.id IN :ids
+    ORDER BY s.id
+"""
+
+PURCHASES_SQL = """
+    SELECT p.id, p.invoice_number, p.created_at, p.warehouse_id, p.supplier_id,
+           p.payment_status, p.total, p.tax_amount
+    FROM purchases p
+    WHERE p.id IN :ids
+    ORDER BY p.id
+"""
+
+
+def _setting(key):
+    setting = Setting.query.filter_by(key=key).first()
+    return setting.value if setting else None
+
+
+def _save_setting(key, value, description):
+    setting = Setting.query.filter_by(key=key).first()
+    if not setting:
+        setting = Setting(key=key, category='accounting_integration', description=description)
+        db.session.add(setting)
+    setting.value = str(value)
+
+
+def mapping_key(name):
+    return f'accounting_account_{name}'
+
+
+def get_mode():
+    mode = _setting(MODE_KEY)
+    return mode if mode in MODES else 'document'
+
+
+def get_start_date():
+    """Documents dated before this are never posted (history kept in the previous system)"""
+    value = _setting(START_DATE_KEY)
+    return date.fromisoformat(value) if value else None
+
+
+def get_mapping_codes():
+    """mapping -> configured account code (or the default)"""
+    stored = dict(db.session.query(Setting.key, Setting.value).filter(
+        Setting.key.in_([mapping_key(name) for name in MAPPINGS])).all())
+    return {name: stored.get(mapping_key(name), default) or '' for name, (_, default) in MAPPINGS.items()}
+
+
+def save_configuration(mode, codes, start_date=None):
+    """Store the posting mode, start date and account codes (caller commits)"""
+    if mode not in MODES:
+        raise ValueError('Modo de contabilización no válido')
+    try:
+        start_date = date.fromisoformat(start_date).isoformat() if start_date else ''
+    except ValueError:
+        raise ValueError('Fecha de inicio no válida')
+    _save_setting(START_DATE_KEY, start_date, 'Fecha desde la que se contabilizan ventas y compras')
+    for name, code in codes.items():
+        if name in MAPPINGS:
+            _save_setting(mapping_key(name), code or '', f'Cuenta contable: {MAPPINGS[name][0]}')
+    _save_setting(MODE_KEY, mode, 'Contabilización automática de ventas y compras')
+
+
+def _mapping_accounts():
+    """mapping -> account id of the configured codes"""
+    codes = get_mapping_codes()
+    ids = dict(db.session.query(ChartOfAccounts.code, ChartOfAccounts.id).filter(
+        ChartOfAccounts.code.in_([code for code in codes.values() if code])).all())
+    return {name: ids.get(code) for name, code in codes.items()}
+
+
+def _pending_filters(model, start_date):
+    filters = [model.posted == False]
+    if start_date:
+        filters.append(model.created_at >= start_date)
+    return filters
+
+
+def pending_counts():
+    """Documents not posted yet, from the start date on"""
+    start_date = get_start_date()
+    return {source: db.session.query(func.count(model.id)).filter(*_pending_filters(model, start_date)).scalar()
+            for source, model in SOURCES.items()}
+
+
+def _to_date(value):
+    # Datetime columns come back as strings from raw SQLite queries
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _amount(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+class _Batch:
+    """Journal entries of one batch, grouped per document or per day and warehouse"""
+
+    def __init__(self, mode, accounts, periods):
+        self.mode = mode
+        self.accounts = accounts
+        self.periods = periods
+        self.entries = {}
+        self.skipped = []  # Documents dated in a closed period, left out of the batch
+
+    def _account(self, name):
+        account_id = self.accounts.get(name)
+        if not account_id:
+            raise ValueError(f'Configure la cuenta contable de "{MAPPINGS[name][0]}" '
+                             f'en la integración contable')
+        return account_id
+
+    def _period_id(self, entry_date):
+        # The shortest period containing the date (a month before its year)
+        for period in self.periods:
+            if period.start_date <= entry_date <= period.end_date:
+                return period.id
+        return None
+
+    def _is_closed(self, entry_date):
+        return any(period.is_closed and period.start_date <= entry_date <= period.end_date
+                   for period in self.periods)
+
+    def _skip(self, doc, entry_date):
+        """Leave out a document dated in a closed period; it is reported instead of failing the batch"""
+        if not self._is_closed(entry_date):
+            return False
+        self.skipped.append(doc.invoice_number)
+        return True
+
+    def entry(self, prefix, document, documents, doc, entry_date):
+        if self.mode == 'daily':
+            key = (prefix, entry_date, doc.warehouse_id)
+            number = f'{prefix}D-{doc.id:08d}'
+            reference = f'{entry_date.isoformat()} B{doc.warehouse_id}'
+            description = f'Resumen de {documents} del {entry_date.strftime("%d/%m/%Y")} (bodega {doc.warehouse_id})'
+        else:
+            key = (prefix, doc.id)
+            number = f'{prefix}-{doc.id:08d}'
+            reference = doc.invoice_number
+            description = f'{document} {doc.invoice_number}'
+
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {
+                'entry_number': number, 'entry_date': entry_date, 'reference': reference,
+                'description': description, 'period_id': self._period_id(entry_date),
+                'lines': {},
+            }
+        return entry
+
+    def add(self, entry, name, debit=Decimal('0'), credit=Decimal('0'), third_party_id=None):
+        if not debit and not credit:
+            return
+        key = (self._account(name), third_party_id, 'D' if debit else 'C')
+        line = entry['lines'].setdefault(key, [Decimal('0'), Decimal('0')])
+        line[0] += debit
+        line[1] += credit
+
+    def add_sale(self, sale):
+        entry_date = _to_date(sale.created_at)
+        if self._skip(sale, entry_date):
+            return
+        entry = self.entry('VTA', 'Venta', 'ventas', sale, entry_date)
+        total, tax, cost = _amount(sale.total), _amount(sale.tax_amount), _amount(sale.cost)
+        if sale.payment_method == 'credit':
+            self.add(entry, 'receivable', debit=total, third_party_id=sale.customer_id)
+        else:
+            self.add(entry, 'cash', debit=total)
+        self.add(entry, 'revenue', credit=total - tax)
+        self.add(entry, 'sales_tax', credit=tax)
+        self.add(entry, 'cogs', debit=cost)
+        self.add(entry, 'inventory', credit=cost)
+
+    def add_purchase(self, purchase):
+        entry_date = _to_date(purchase.created_at)
+        if self._skip(purchase, entry_date):
+            return
+        entry = self.entry('CMP', 'Compra', 'compras', purchase, entry_date)
+        total, tax = _amount(purchase.total), _amount(purchase.tax_amount)
+        self.add(entry, 'inventory', debit=total - tax)
+        self.add(entry, 'purchase_tax', debit=tax)
+        if purchase.payment_status == 'paid':
+            self.add(entry, 'cash', credit=total)
+        else:
+            self.add(entry, 'payable', credit=total, third_party_id=purchase.supplier_id)
+
+    def write(self):
+        """Bulk insert the entries and their details, posted, and update the account and third-party balances"""
+        entries = [entry for entry in self.entries.values() if entry['lines']]
+        if not entries:
+            return 0
+
+        now = datetime.utcnow()
+        rows = []
+        for entry in entries:
+            total_debit = sum(line[0] for line in entry['lines'].values())
+            total_credit = sum(line[1] for line in entry['lines'].values())
+            if total_debit != total_credit:
+                raise ValueError(f'El asiento {entry["entry_number"]} no está balanceado')
+            rows.append({
+                'entry_number': entry['entry_number'], 'entry_date': entry['entry_date'],
+                'reference': entry['reference'], 'description': entry['description'],
+                'period_id': entry['period_id'], 'status': 'POSTED',
+                'total_debit': total_debit, 'total_credit': total_credit,
+                'created_at': now, 'posted_at': now,
+            })
+
+        entries_table = JournalEntry.__table__
+        result = db.session.execute(
+            insert(entries_table).returning(entries_table.c.id, entries_table.c.entry_number), rows)
+        ids = {number: entry_id for entry_id, number in result}
+
+        details = []
+        movements = {}
+        third_parties = {}
+        for entry in entries:
+            for (account_id, third_party_id, _), (debit, credit) in entry['lines'].items():
+                details.append({
+                    'journal_entry_id': ids[entry['entry_number']], 'account_id': account_id,
+                    'third_party_id': third_party_id, 'debit_amount': debit, 'credit_amount': credit,
+                    'description': entry['description'], 'reference': entry['reference'],
+                })
+                movement = movements.setdefault((entry['entry_date'], account_id), [Decimal('0'), Decimal('0')])
+                movement[0] += debit
+                movement[1] += credit
+                if third_party_id:
+                    movement = third_parties.setdefault((account_id, third_party_id), [Decimal('0'), Decimal('0')])
+                    movement[0] += debit
+                    movement[1] += credit
+        db.session.execute(insert(JournalEntryDetail.__table__), details)
+
+        apply_movements({key: tuple(value) for key, value in movements.items()})
+        apply_third_party_movements({key: tuple(value) for key, value in third_parties.items()})
+        return len(entries)
+
+
+def _acquire_posting_lock():
+    """
+    Take the posting lock for the current transaction; False if another run holds it
+
+    Two runs picking the same pending documents would post them twice.
+    SQLite serializes writers already, so only PostgreSQL needs the lock.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return True
+    return bool(db.session.execute(text("SELECT pg_try_advisory_xact_lock(:key)"),
+                                   {'key': POSTING_LOCK_KEY}).scalar())
+
+
+def _post_source(source, mode, accounts, periods, start_date, batch_size):
+    model = SOURCES[source]
+    sql = text(SALES_SQL if source == 'sales' else PURCHASES_SQL).bindparams(bindparam('ids', expanding=True))
+    documents = entries = 0
+    skipped = []
+
+    while True:
+        try:
+            if not _acquire_posting_lock():
+                db.session.rollback()
+                break
+            ids = list(db.session.execute(
+                select(model.id).where(*_pending_filters(model, start_date)).order_by(model.id).limit(batch_size)
+            ).scalars())
+            if not ids:
+                db.session.rollback()
+                break
+
+            batch = _Batch(mode, accounts, periods)
+            rows = db.session.execute(sql, {'ids': ids}).fetchall()
+            for row in rows:
+                if source == 'sales':
+                    batch.add_sale(row)
+                else:
+                    batch.add_purchase(row)
+            entries += batch.write()
+            db.session.execute(update(model).where(model.id.in_(ids)).values(posted=True))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        documents += len(rows) - len(batch.skipped)
+        skipped += batch.skipped
+
+    return documents, entries, skipped
+
+
+def post_pending_documents(batch_size=BATCH_SIZE):
+    """
+    Post the journal entries of the sales and purchases not posted yet
+
+    Pending documents are picked by their posted flag rather than an id
+    watermark, so a document committed after others with higher ids is still
+    included. Each batch is read with one aggregate query, grouped into one
+    entry per document or one per day and warehouse (the configured mode),
+    bulk inserted already posted, and added to the account balances; the
+    entries and the posted flags commit together. Documents dated before the
+    configured start date are passed over, and those dated in a closed
+    period are flagged without an entry and returned so they can be entered
+    by hand. Stops early when another run is already posting.
+
+    Returns:
+        dict: documents and entries posted, and invoice numbers skipped, per source
+    """
+    mode = get_mode()
+    accounts = _mapping_accounts()
+    periods = sorted(AccountingPeriod.query.all(), key=lambda period: period.end_date - period.start_date)
+    start_date = get_start_date()
+
+    result = {}
+    for source in SOURCES:
+        documents, entries, skipped = _post_source(source, mode, accounts, periods, start_date, batch_size)
+        result[source] = {'documents': documents, 'entries': entries, 'skipped': skipped}
+    return result
@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from app import db
+
+# Kept below the engine pool size (5 + overflow) so concurrent pages do not starve each other
+FANOUT_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='query-fanout')
+        return _executor
+
+
+def _call_in_context(app, task):
+    # Each worker thread gets its own app context, so its own scoped session and pooled connection
+    with app.app_context():
+        try:
+            return task()
+        finally:
+            db.session.remove()
+
+
+def run_parallel(**tasks):
+    """
+    Run independent read-only queries concurrently and join the results
+
+    Each task is a callable without arguments; the result is a dict with the
+    same keys. Tasks run on separate sessions, so ORM objects they return are
+    detached: eager-load any relationship the caller needs. Waits for every
+    task before returning or raising the first task exception, so no query is
+    left running after the request ends.
+
+    Example:
+        results = run_parallel(summary=lambda: ..., warehouses=lambda: ...)
+    """
+    app = current_app._get_current_object()
+    executor = _get_executor()
+    futures = {name: executor.submit(_call_in_context, app, task) for name, task in tasks.items()}
+    wait(futures.values())
+    return {name: future.result() for name, future in futures.items()}
@@ -1,13 +1,14 @@
-from reportlab.lib.pagesizes import letter, A4
+from reportlab.lib.pagesizes import letter, A4, landscape
 from reportlab.lib import colors
 from reportlab.lib.units import inch, cm
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from flask import make_response
 from models import Setting
 import io
 from datetime import datetime
+from decimal import Decimal
 
 def get_company_info():
     """Get company information from settings"""
@@ -231,3 +232,126 @@ def generate_invoice_pdf(sale, download=False):
         return response
     
     return pdf_data
+
+
+# ===== Reportes tabulares grandes =====
+
+REPORT_FONT_SIZE = 7
+REPORT_ROW_HEIGHT = 11
+
+
+class _ChunkedStory(list):
+    """
+    Flowable list refilled from a generator while platypus consumes it
+
+    doc.build() checks len() before taking each flowable, so only the next
+    page of rows is ever built as flowables.
+    """
+
+    def __init__(self, flowables):
+        super().__init__()
+        self._flowables = flowables
+
+    def __len__(self):
+        if not super().__len__():
+            for flowable in self._flowables:
+                self.append(flowable)
+                break
+        return super().__len__()
+
+
+def _format_cell(value, max_chars):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%d/%m/%Y %H:%M')
+    if isinstance(value, bool):
+        return 'Sí' if value else 'No'
+    if isinstance(value, int):
+        return f"{value:,}"
+    if isinstance(value, (float, Decimal)):
+        return f"{value:,.2f}"
+    text = str(value)
+    return text if len(text) <= max_chars else text[:max_chars - 1] + '…'
+
+
+def write_report_pdf(path, title, header, rows, subtitle=None):
+    """
+    Write a tabular report to a PDF file, one table per page
+
+    Rows are consumed page by page from the iterable (usually a server-side
+    cursor) and each page becomes its own Table flowable, so the rows are
+    never all in memory; the title and page number are drawn on the canvas.
+    Returns the row count.
+    """
+    company_info = get_company_info()
+    doc = SimpleDocTemplate(path, pagesize=landscape(A4),
+                            rightMargin=1*cm, leftMargin=1*cm,
+                            topMargin=2*cm, bottomMargin=1.5*cm,
+                            title=title)
+
+    col_width = doc.width / len(header)
+    max_chars = max(int(col_width / (REPORT_FONT_SIZE * 0.5)), 4)
+    # Frame padding is 6pt top and bottom; one row per page is the header
+    rows_per_page = int((doc.height - 12) // REPORT_ROW_HEIGHT) - 1
+    numeric = set()
+    style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), REPORT_FONT_SIZE),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f2f2f2')]),
+        ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 3),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 3),
+        ('TOPPADDING', (0, 0), (-1, -1), 1),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 1),
+    ])
+    count = 0
+
+    def page_table(page_rows):
+        data = [list(header)]
+        for row in page_rows:
+            for index, value in enumerate(row):
+                if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+                    numeric.add(index)
+            data.append([_format_cell(value, max_chars) for value in row])
+        table = Table(data, colWidths=[col_width] * len(header),
+                      rowHeights=REPORT_ROW_HEIGHT, repeatRows=1)
+        table.setStyle(style)
+        for index in numeric:
+            table.setStyle(TableStyle([('ALIGN', (index, 1), (index, -1), 'RIGHT')]))
+        return table
+
+    def pages():
+        nonlocal count
+        page_rows = []
+        for row in rows:
+            page_rows.append(row)
+            if len(page_rows) == rows_per_page:
+                count += len(page_rows)
+                yield page_table(page_rows)
+                yield PageBreak()
+                page_rows = []
+        count += len(page_rows)
+        if page_rows or not count:
+            yield page_table(page_rows)
+
+    generated = datetime.now().strftime('%d/%m/%Y %H:%M')
+
+    def draw_page(canvas, document):
+        canvas.saveState()
+        top = document.pagesize[1] - 1*cm
+        canvas.setFont('Helvetica-Bold', 12)
+        canvas.drawString(document.leftMargin, top - 12, title)
+        canvas.setFont('Helvetica', 8)
+        canvas.drawString(document.leftMargin, top - 24,
+                          ' · '.join(part for part in (company_info['name'], subtitle, generated) if part))
+        canvas.drawRightString(document.pagesize[0] - document.rightMargin, 0.75*cm,
+                               f"Página {document.page}")
+        canvas.restoreState()
+
+    doc.build(_ChunkedStory(pages()), onFirstPage=draw_page, onLaterPages=draw_page)
+    return count
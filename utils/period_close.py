@@ -0,0 +1,180 @@
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import text, func
+from sqlalchemy.dialects import postgresql, sqlite
+from models import (AccountingPeriod, AccountBalance, ChartOfAccounts, JournalEntry,
+                    JournalEntryDetail, Setting)
+from app import db
+from utils.account_balances import apply_movements, balances
+from utils.cache import bump_data_version
+
+RESULT_ACCOUNT_KEY = 'accounting_account_period_result'
+RESULT_ACCOUNT_TYPES = ('INGRESO', 'INGRESOS', 'GASTO', 'GASTOS', 'COSTO', 'COSTOS')
+CLOSING_ENTRY_PREFIX = 'CIE-'
+
+# Stored closing balance from the stored opening and the period movement
+CLOSING_SQL = """
+    UPDATE account_balances
+    SET closing_balance = opening_balance + debit_total - credit_total, last_updated = :now
+    WHERE period_id = :period_id
+"""
+
+
+def closing_entry_number(period):
+    return f'{CLOSING_ENTRY_PREFIX}{period.id:06d}'
+
+
+def get_result_account_code():
+    setting = Setting.query.filter_by(key=RESULT_ACCOUNT_KEY).first()
+    return setting.value if setting else ''
+
+
+def _save_result_account_code(code):
+    setting = Setting.query.filter_by(key=RESULT_ACCOUNT_KEY).first()
+    if not setting:
+        setting = Setting(key=RESULT_ACCOUNT_KEY, category='accounting_integration',
+                          description='Cuenta de resultado del ejercicio para el cierre de períodos')
+        db.session.add(setting)
+    setting.value = code
+
+
+def next_period(period):
+    """The first period starting after this one ends, if created"""
+    return AccountingPeriod.query.filter(
+        AccountingPeriod.start_date > period.end_date
+    ).order_by(AccountingPeriod.start_date, AccountingPeriod.end_date.desc()).first()
+
+
+def _closing_entry(period, result_account):
+    """
+    Post the entry that takes the income-statement accounts to zero against the result account
+
+    Returns the entry, or None when those accounts have no balance.
+    """
+    rows = db.session.query(AccountBalance.account_id, AccountBalance.closing_balance)\
+        .join(ChartOfAccounts, ChartOfAccounts.id == AccountBalance.account_id)\
+        .filter(AccountBalance.period_id == period.id,
+                ChartOfAccounts.account_type.in_(RESULT_ACCOUNT_TYPES),
+                AccountBalance.closing_balance != 0).all()
+    if not rows:
+        return None
+
+    entry = JournalEntry(
+        entry_number=closing_entry_number(period),
+        entry_date=period.end_date,
+        reference=period.name,
+        description=f'Cierre de cuentas de resultado - {period.name}',
+        period_id=period.id,
+        status='POSTED',
+        posted_at=datetime.utcnow()
+    )
+    db.session.add(entry)
+    db.session.flush()
+
+    details = []
+    movements = {}
+    result = Decimal('0')
+    for account_id, balance in rows:
+        balance = Decimal(str(balance))
+        debit, credit = (Decimal('0'), balance) if balance > 0 else (-balance, Decimal('0'))
+        details.append({'account_id': account_id, 'debit_amount': debit, 'credit_amount': credit})
+        movements[(period.end_date, account_id)] = (debit, credit)
+        result += balance
+
+    # Profit (credit balance overall) is credited to the result account, a loss debited
+    debit, credit = (result, Decimal('0')) if result > 0 else (Decimal('0'), -result)
+    details.append({'account_id': result_account.id, 'debit_amount': debit, 'credit_amount': credit})
+    previous = movements.get((period.end_date, result_account.id), (Decimal('0'), Decimal('0')))
+    movements[(period.end_date, result_account.id)] = (previous[0] + debit, previous[1] + credit)
+
+    db.session.execute(JournalEntryDetail.__table__.insert(), [
+        dict(detail, journal_entry_id=entry.id, description=entry.description, reference=entry.reference)
+        for detail in details
+    ])
+    entry.total_debit = sum(detail['debit_amount'] for detail in details)
+    entry.total_credit = sum(detail['credit_amount'] for detail in details)
+
+    apply_movements(movements)
+    return entry
+
+
+def _carry_forward(period, following):
+    """Write the closing balances of a period as the opening balances of the next one"""
+    now = datetime.utcnow()
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    source = db.select(
+        balances.c.account_id,
+        db.literal(following.id),
+        balances.c.closing_balance,
+        db.literal(0),
+        db.literal(0),
+        balances.c.closing_balance,
+        db.literal(now)
+    ).where(balances.c.period_id == period.id)
+    stmt = insert(balances).from_select(
+        ['account_id', 'period_id', 'opening_balance', 'debit_total', 'credit_total',
+         'closing_balance', 'last_updated'], source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['account_id', 'period_id'],
+        set_={
+            'opening_balance': stmt.excluded.opening_balance,
+            'closing_balance': stmt.excluded.opening_balance + balances.c.debit_total - balances.c.credit_total,
+            'last_updated': stmt.excluded.last_updated,
+        }
+    )
+    db.session.execute(stmt)
+
+
+def close_period(period, result_account_code):
+    """
+    Close an accounting period in one transaction
+
+    Posts the closing entry of the income-statement accounts against the
+    result account, recomputes the stored closing balances of every account
+    in one statement, writes them as the opening balances of the next
+    period, and locks the period against further posting.
+
+    Returns:
+        JournalEntry: the closing entry, or None if there was nothing to close
+    """
+    if period.is_closed:
+        raise ValueError(f'El período {period.name} ya está cerrado')
+
+    earlier_open = AccountingPeriod.query.filter(
+        AccountingPeriod.is_closed == False,
+        AccountingPeriod.end_date < period.start_date
+    ).count()
+    if earlier_open:
+        raise ValueError('Cierre primero los períodos anteriores')
+
+    drafts = db.session.query(func.count(JournalEntry.id)).filter(
+        JournalEntry.status == 'DRAFT',
+        JournalEntry.entry_date >= period.start_date,
+        JournalEntry.entry_date <= period.end_date
+    ).scalar()
+    if drafts:
+        raise ValueError(f'Hay {drafts} asientos en borrador en el período; contabilícelos o elimínelos')
+
+    result_account = ChartOfAccounts.query.filter_by(code=result_account_code, is_active=True).first()
+    if not result_account:
+        raise ValueError('Seleccione la cuenta de resultado del ejercicio')
+
+    try:
+        _save_result_account_code(result_account.code)
+        entry = _closing_entry(period, result_account)
+
+        now = datetime.utcnow()
+        db.session.execute(text(CLOSING_SQL), {'period_id': period.id, 'now': now})
+        following = next_period(period)
+        if following:
+            _carry_forward(period, following)
+
+        period.is_closed = True
+        period.closed_date = now
+        bump_data_version('accounting')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return entry
@@ -0,0 +1,303 @@
+import json
+from datetime import datetime
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR, ROUND_HALF_UP
+from sqlalchemy import select, update, func, case, and_, or_, bindparam
+from models import Product, PriceRuleJob
+from utils.cache import bump_data_version
+from app import db
+
+PRICE_FIELDS = ('price1', 'price2', 'price3', 'price4')
+BASE_FIELDS = ('cost',) + PRICE_FIELDS
+FILTER_FIELDS = ('category_id', 'brand_id', 'group_id', 'line_id')
+ROUNDING_MODES = ('nearest', 'up', 'down')
+BATCH_SIZE = 2000
+SAMPLE_SIZE = 50
+
+products = Product.__table__
+
+
+def parse_rule(form):
+    """
+    Build a price rule from request form data
+
+    Expected fields: category_id, brand_id, group_id, line_id as filters;
+    <price>_base and <price>_percent for each of price1..price4;
+    round_step and round_mode for rounding.
+    """
+    rule = {
+        'description': form.get('description', '').strip(),
+        'filters': {},
+        'prices': {},
+        'rounding': {
+            'step': form.get('round_step') or '0',
+            'mode': form.get('round_mode') or 'nearest'
+        }
+    }
+
+    for field in FILTER_FIELDS:
+        if form.get(field):
+            rule['filters'][field] = int(form[field])
+
+    for field in PRICE_FIELDS:
+        base = form.get(f'{field}_base')
+        if base:
+            rule['prices'][field] = {'base': base, 'percent': form.get(f'{field}_percent') or '0'}
+
+    return validate_rule(rule)
+
+
+def validate_rule(rule):
+    """Normalize numeric values and reject malformed rules"""
+    if not rule['prices']:
+        raise ValueError('Debe definir al menos una fórmula de precio')
+
+    for field, formula in rule['prices'].items():
+        if field not in PRICE_FIELDS:
+            raise ValueError(f'Precio inválido: {field}')
+        if formula['base'] not in BASE_FIELDS:
+            raise ValueError(f'Base inválida para {field}: {formula["base"]}')
+        formula['percent'] = str(Decimal(str(formula['percent'])))
+        if Decimal(formula['percent']) <= -100:
+            raise ValueError(f'El porcentaje de {field} debe ser mayor a -100')
+
+    rounding = rule['rounding']
+    rounding['step'] = str(Decimal(str(rounding['step'])))
+    if Decimal(rounding['step']) < 0:
+        raise ValueError('El redondeo no puede ser negativo')
+    if rounding['mode'] not in ROUNDING_MODES:
+        raise ValueError(f'Modo de redondeo inválido: {rounding["mode"]}')
+
+    # A price based on itself uses its current value; any other loop such as
+    # price1 <- price2 <- price1 cannot be resolved
+    for field in rule['prices']:
+        seen = set()
+        current = field
+        while current in rule['prices'] and rule['prices'][current]['base'] != current:
+            if current in seen:
+                raise ValueError(f'Referencia circular en la fórmula de {field}')
+            seen.add(current)
+            current = rule['prices'][current]['base']
+
+    return rule
+
+
+def _filter_clause(filters):
+    clauses = [products.c.is_active == True]
+    for field in FILTER_FIELDS:
+        value = filters.get(field)
+        if value:
+            column = products.c[field]
+            clauses.append(column.in_(value) if isinstance(value, (list, tuple)) else column == value)
+    return and_(*clauses)
+
+
+def _is_set_based(rule):
+    """Nearest rounding can be expressed with ROUND() in a single UPDATE"""
+    return rule['rounding']['mode'] == 'nearest'
+
+
+def _sql_expressions(rule):
+    """SQL expressions for the new value of every targeted price"""
+    step = Decimal(rule['rounding']['step'])
+    expressions = {}
+
+    def resolve(field, current=False):
+        if field in expressions and not current:
+            return expressions[field]
+        if field not in rule['prices'] or current:
+            return func.coalesce(products.c[field], 0)
+
+        formula = rule['prices'][field]
+        factor = 1 + Decimal(formula['percent']) / 100
+        expr = resolve(formula['base'], current=formula['base'] == field) * factor
+        if step > 0:
+            expr = func.round(expr / step) * step
+        else:
+            expr = func.round(expr, 2)
+        expressions[field] = expr
+        return expr
+
+    for field in rule['prices']:
+        resolve(field)
+    return expressions
+
+
+def _changed_clause(expressions):
+    return or_(*[func.coalesce(products.c[field], 0) != expr for field, expr in expressions.items()])
+
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+
+def _round_value(value, step, mode):
+    rounding = {'up': ROUND_CEILING, 'down': ROUND_FLOOR}.get(mode, ROUND_HALF_UP)
+    if step > 0:
+        return (value / step).to_integral_value(rounding=rounding) * step
+    # Without a step the direction still applies at cent precision
+    return value.quantize(Decimal('0.01'), rounding=rounding)
+
+
+def compute_prices(row, rule):
+    """New prices for one product row (mapping with cost and price1..price4)"""
+    step = Decimal(rule['rounding']['step'])
+    mode = rule['rounding']['mode']
+    computed = {}
+
+    def resolve(field, current=False):
+        if field in computed and not current:
+            return computed[field]
+        if field not in rule['prices'] or current:
+            return Decimal(row[field] or 0)
+
+        formula = rule['prices'][field]
+        factor = 1 + Decimal(formula['percent']) / 100
+        base = resolve(formula['base'], current=formula['base'] == field)
+        computed[field] = _round_value(base * factor, step, mode)
+        return computed[field]
+
+    for field in rule['prices']:
+        resolve(field)
+    return computed
+
+
+def _empty_summary(rule):
+    return {
+        'matched': 0,
+        'changed': 0,
+        'set_based': _is_set_based(rule),
+        'totals': {field: {'old': Decimal('0'), 'new': Decimal('0')} for field in rule['prices']},
+        'sample': []
+    }
+
+
+def _iter_batches(rule):
+    """Keyset-paginated raw rows (id, sku, name, cost, prices) matching the rule filters"""
+    columns = [products.c.id, products.c.sku, products.c.name] + [products.c[f] for f in BASE_FIELDS]
+    where = _filter_clause(rule['filters'])
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(*columns).where(where, products.c.id > last_id)
+            .order_by(products.c.id).limit(BATCH_SIZE)
+        ).mappings().all()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1]['id']
+
+
+def _preview_set_based(rule):
+    expressions = _sql_expressions(rule)
+    where = _filter_clause(rule['filters'])
+    summary = _empty_summary(rule)
+
+    aggregates = [func.count()]
+    for field, expr in expressions.items():
+        aggregates += [func.coalesce(func.sum(products.c[field]), 0), func.coalesce(func.sum(expr), 0)]
+    any_change = case((_changed_clause(expressions), 1), else_=0)
+    aggregates.append(func.coalesce(func.sum(any_change), 0))
+
+    row = db.session.execute(select(*aggregates).where(where)).one()
+    summary['matched'] = row[0]
+    for index, field in enumerate(expressions):
+        summary['totals'][field]['old'] = _money(row[1 + index * 2])
+        summary['totals'][field]['new'] = _money(row[2 + index * 2])
+    summary['changed'] = row[-1]
+
+    sample_columns = [products.c.id, products.c.sku, products.c.name]
+    for field, expr in expressions.items():
+        sample_columns += [products.c[field].label(f'{field}_old'), expr.label(f'{field}_new')]
+    for sample in db.session.execute(
+        select(*sample_columns).where(where).order_by(products.c.id).limit(SAMPLE_SIZE)
+    ).mappings():
+        summary['sample'].append(_sample_row(sample, expressions))
+
+    return summary
+
+
+def _sample_row(row, fields):
+    return {
+        'id': row['id'],
+        'sku': row['sku'],
+        'name': row['name'],
+        'prices': {field: {'old': _money(row[f'{field}_old']),
+                           'new': _money(row[f'{field}_new'])} for field in fields}
+    }
+
+
+def _run_batches(rule, apply_changes):
+    """Compute new prices in Python, batch by batch, optionally writing them"""
+    summary = _empty_summary(rule)
+    values = {field: bindparam(f'b_{field}') for field in rule['prices']}
+    values['updated_at'] = bindparam('b_updated_at')
+    statement = update(products).where(products.c.id == bindparam('b_id')).values(values)
+    now = datetime.utcnow()
+
+    for rows in _iter_batches(rule):
+        changes = []
+        for row in rows:
+            new_prices = compute_prices(row, rule)
+            summary['matched'] += 1
+            for field, new_value in new_prices.items():
+                summary['totals'][field]['old'] += Decimal(row[field] or 0)
+                summary['totals'][field]['new'] += new_value
+            if any(Decimal(row[field] or 0) != value for field, value in new_prices.items()):
+                summary['changed'] += 1
+                changes.append({'b_id': row['id'], 'b_updated_at': now,
+                                **{f'b_{field}': value for field, value in new_prices.items()}})
+            if len(summary['sample']) < SAMPLE_SIZE:
+                summary['sample'].append(_sample_row(
+                    {'id': row['id'], 'sku': row['sku'], 'name': row['name'],
+                     **{f'{f}_old': row[f] for f in new_prices},
+                     **{f'{f}_new': v for f, v in new_prices.items()}},
+                    new_prices
+                ))
+        if apply_changes and changes:
+            db.session.execute(statement, changes)
+
+    return summary
+
+
+def preview_price_rule(rule):
+    """Dry run: diff summary of the rule without touching any row"""
+    if _is_set_based(rule):
+        return _preview_set_based(rule)
+    return _run_batches(rule, apply_changes=False)
+
+
+def apply_price_rule(rule, user_id=None):
+    """
+    Apply a price rule in one transaction
+
+    Nearest rounding runs as a single UPDATE; up/down rounding is computed
+    in keyset batches and written with executemany. The catalog version is
+    bumped so POS terminals pick up the new prices.
+    """
+    try:
+        if _is_set_based(rule):
+            expressions = _sql_expressions(rule)
+            values = dict(expressions)
+            values['updated_at'] = datetime.utcnow()
+            result = db.session.execute(
+                update(products)
+                .where(_filter_clause(rule['filters']), _changed_clause(expressions))
+                .values(values)
+            )
+            affected = result.rowcount
+        else:
+            affected = _run_batches(rule, apply_changes=True)['changed']
+
+        job = PriceRuleJob(
+            description=rule.get('description') or None,
+            rule=json.dumps(rule),
+            affected_rows=affected,
+            user_id=user_id
+        )
+        db.session.add(job)
+        bump_data_version('catalog')
+        db.session.commit()
+        return job
+    except Exception:
+        db.session.rollback()
+        raise
@@ -0,0 +1,350 @@
+import csv
+import io
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import select, or_, func, update, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Product, Inventory, Category, Brand, ProductGroup, ProductLine, Warehouse, fold_search_text
+from utils.cache import bump_data_version
+from utils import dashboard_metrics
+from app import db
+
+CHUNK_SIZE = 1000
+
+# Accepted column headers (Spanish and English) mapped to product fields
+COLUMN_ALIASES = {
+    'sku': 'sku', 'codigo': 'sku', 'código': 'sku',
+    'barcode': 'barcode', 'codigo_barras': 'barcode', 'código_barras': 'barcode', 'ean': 'barcode',
+    'name': 'name', 'nombre': 'name',
+    'description': 'description', 'descripcion': 'description', 'descripción': 'description',
+    'unit_measure': 'unit_measure', 'unidad': 'unit_measure', 'unidad_medida': 'unit_measure',
+    'cost': 'cost', 'costo': 'cost',
+    'price1': 'price1', 'precio1': 'price1',
+    'price2': 'price2', 'precio2': 'price2',
+    'price3': 'price3', 'precio3': 'price3',
+    'price4': 'price4', 'precio4': 'price4',
+    'category': 'category', 'categoria': 'category', 'categoría': 'category',
+    'brand': 'brand', 'marca': 'brand',
+    'group': 'group', 'grupo': 'group',
+    'line': 'line', 'linea': 'line', 'línea': 'line',
+    'is_service': 'is_service', 'servicio': 'is_service',
+    'track_serial': 'track_serial', 'serial': 'track_serial',
+}
+
+PRICE_FIELDS = ('cost', 'price1', 'price2', 'price3', 'price4')
+LOOKUP_FIELDS = {
+    'category': ('category_id', Category),
+    'brand': ('brand_id', Brand),
+    'group': ('group_id', ProductGroup),
+    'line': ('line_id', ProductLine),
+}
+LOOKUP_LABELS = {'category': 'la categoría', 'brand': 'la marca', 'group': 'el grupo', 'line': 'la línea'}
+# Columns updated when the SKU already exists, only from cells the file fills in
+# (a blank or missing column is None and keeps the stored value); is_active is
+# left alone so an import never reactivates a product
+UPDATE_COLUMNS = ('barcode', 'name', 'description', 'unit_measure', 'cost',
+                  'price1', 'price2', 'price3', 'price4',
+                  'category_id', 'brand_id', 'group_id', 'line_id',
+                  'is_service', 'track_serial', 'search_text')
+# Values of new products for the cells the file leaves blank
+NEW_PRODUCT_DEFAULTS = {'unit_measure': 'unidad', 'cost': Decimal('0'), 'price1': Decimal('0'),
+                        'price2': Decimal('0'), 'price3': Decimal('0'), 'price4': Decimal('0'),
+                        'is_service': False, 'track_serial': False}
+
+TRUE_VALUES = {'1', 'true', 'si', 'sí', 'yes', 'x'}
+
+
+def _normalize_header(header):
+    key = (header or '').strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(key)
+
+
+def read_rows(stream, filename):
+    """Yield (row_number, dict) pairs from an uploaded CSV or XLSX file"""
+    if filename.lower().endswith('.xlsx'):
+        yield from _read_xlsx(stream)
+    else:
+        yield from _read_csv(stream)
+
+
+def _read_csv(stream):
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    sample = text_stream.read(4096)
+    text_stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    reader = csv.reader(text_stream, dialect)
+    headers = [_normalize_header(h) for h in next(reader, [])]
+    for row_number, values in enumerate(reader, start=2):
+        if not any(values):
+            continue
+        yield row_number, {h: v for h, v in zip(headers, values) if h}
+
+
+def _read_xlsx(stream):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError('La importación de archivos XLSX requiere el paquete openpyxl')
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = [_normalize_header(str(h) if h is not None else '') for h in next(rows, ())]
+        for row_number, values in enumerate(rows, start=2):
+            if not any(v not in (None, '') for v in values):
+                continue
+            yield row_number, {h: ('' if v is None else str(v)) for h, v in zip(headers, values) if h}
+    finally:
+        workbook.close()
+
+
+def _load_lookup_maps():
+    """Load name -> id maps for categories, brands, groups and lines"""
+    maps = {}
+    for field, (_, model) in LOOKUP_FIELDS.items():
+        rows = db.session.execute(select(model.id, model.name)).all()
+        maps[field] = {row.name.strip().lower(): row.id for row in rows if row.name}
+    return maps
+
+
+def _resolve_lookup(maps, field, name, create_missing):
+    key = name.strip().lower()
+    lookup_id = maps[field].get(key)
+    if lookup_id is None and create_missing:
+        model = LOOKUP_FIELDS[field][1]
+        record = model(name=name.strip())
+        db.session.add(record)
+        db.session.flush()
+        lookup_id = maps[field][key] = record.id
+    return lookup_id
+
+
+def _parse_decimal(value):
+    value = (value or '').strip().replace('$', '').replace(' ', '')
+    if not value:
+        return None
+    # Accept Colombian formatting (1.234,56) as well as 1234.56
+    if ',' in value and '.' in value:
+        value = value.replace('.', '').replace(',', '.')
+    elif ',' in value:
+        value = value.replace(',', '.')
+    amount = Decimal(value)
+    if amount < 0:
+        raise InvalidOperation
+    return amount
+
+
+def _parse_flag(value):
+    value = (value or '').strip().lower()
+    return value in TRUE_VALUES if value else None
+
+
+def _validate_row(row, maps, create_missing):
+    """
+    Convert a raw row into product column values, raising ValueError on bad data
+
+    Blank or missing cells come back as None; _write_chunk fills in the
+    defaults of new products and the upsert keeps the stored value otherwise.
+    """
+    sku = (row.get('sku') or '').strip()
+    name = (row.get('name') or '').strip()
+    if not sku:
+        raise ValueError('SKU requerido')
+    if len(sku) > 50:
+        raise ValueError('SKU excede 50 caracteres')
+    if not name:
+        raise ValueError('Nombre requerido')
+
+    values = {
+        'sku': sku,
+        'barcode': (row.get('barcode') or '').strip() or None,
+        'name': name[:200],
+        'description': (row.get('description') or '').strip() or None,
+        'unit_measure': (row.get('unit_measure') or '').strip() or None,
+        'is_service': _parse_flag(row.get('is_service')),
+        'track_serial': _parse_flag(row.get('track_serial')),
+        'is_active': True,
+    }
+
+    for field in PRICE_FIELDS:
+        try:
+            values[field] = _parse_decimal(row.get(field))
+        except InvalidOperation:
+            raise ValueError(f'Valor inválido en {field}: {row.get(field)}')
+
+    for field, (column, _) in LOOKUP_FIELDS.items():
+        name_value = (row.get(field) or '').strip()
+        if not name_value:
+            values[column] = None
+            continue
+        lookup_id = _resolve_lookup(maps, field, name_value, create_missing)
+        if lookup_id is None:
+            raise ValueError(f'No existe {LOOKUP_LABELS[field]} {name_value}')
+        values[column] = lookup_id
+
+    return values
+
+
+def _dialect_insert(table):
+    dialect = db.engine.dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    return insert(table)
+
+
+def _insert_statement():
+    # A SKU created meanwhile by someone else is updated like an existing one
+    stmt = _dialect_insert(Product.__table__)
+    return stmt.on_conflict_do_update(
+        index_elements=['sku'],
+        set_={column: func.coalesce(stmt.excluded[column], Product.__table__.c[column])
+              for column in UPDATE_COLUMNS + ('updated_at',)}
+    )
+
+
+def _update_statement():
+    # A plain UPDATE rather than the upsert: blank cells must not reach the
+    # INSERT row, where NOT NULL columns are checked before the conflict
+    products = Product.__table__
+    return update(products).where(products.c.sku == bindparam('match_sku')).values({
+        column: func.coalesce(bindparam(f'new_{column}', type_=products.c[column].type), products.c[column])
+        for column in UPDATE_COLUMNS
+    })
+
+
+def _inventory_statement():
+    return _dialect_insert(Inventory.__table__).on_conflict_do_nothing(
+        index_elements=['product_id', 'warehouse_id']
+    )
+
+
+def _write_chunk(chunk, warehouse_ids, result):
+    """Upsert one validated chunk of (row_number, values) pairs"""
+    skus = [values['sku'] for _, values in chunk]
+    barcodes = [values['barcode'] for _, values in chunk if values['barcode']]
+
+    existing = db.session.execute(
+        select(Product.sku, Product.barcode).where(
+            or_(Product.sku.in_(skus), Product.barcode.in_(barcodes))
+        )
+    ).all()
+    chunk_skus = set(skus)
+    existing_barcodes = {row.sku: row.barcode for row in existing if row.sku in chunk_skus}
+    barcode_owner = {row.barcode: row.sku for row in existing if row.barcode}
+
+    rows = []
+    for row_number, values in chunk:
+        owner = barcode_owner.get(values['barcode'])
+        if owner and owner != values['sku']:
+            result['errors'].append({
+                'row': row_number,
+                'sku': values['sku'],
+                'error': f"Código de barras {values['barcode']} asignado al SKU {owner}"
+            })
+            continue
+        if values['sku'] in existing_barcodes:
+            barcode = values['barcode'] or existing_barcodes[values['sku']]
+        else:
+            barcode = values['barcode']
+            values.update({field: default for field, default in NEW_PRODUCT_DEFAULTS.items()
+                           if values[field] is None})
+        values['search_text'] = fold_search_text(values['name'], values['sku'], barcode)
+        rows.append(values)
+
+    if not rows:
+        return
+
+    new_rows = [values for values in rows if values['sku'] not in existing_barcodes]
+    new_skus = [values['sku'] for values in new_rows]
+    updates = [dict({f'new_{column}': values[column] for column in UPDATE_COLUMNS}, match_sku=values['sku'])
+               for values in rows if values['sku'] in existing_barcodes]
+    if new_rows:
+        db.session.execute(_insert_statement(), new_rows)
+    if updates:
+        db.session.execute(_update_statement(), updates)
+
+    if new_skus and warehouse_ids:
+        product_ids = db.session.execute(
+            select(Product.id).where(Product.sku.in_(new_skus))
+        ).scalars().all()
+        db.session.execute(_inventory_statement(), [
+            {'product_id': product_id, 'warehouse_id': warehouse_id, 'quantity': 0,
+             'min_stock': 0, 'max_stock': 0}
+            for product_id in product_ids for warehouse_id in warehouse_ids
+        ])
+
+    result['inserted'] += len(new_skus)
+    result['updated'] += len(rows) - len(new_skus)
+
+
+def import_products(rows, create_missing=False, chunk_size=CHUNK_SIZE):
+    """
+    Upsert products by SKU from an iterable of (row_number, dict) pairs
+
+    Rows are validated and written in chunks, each chunk in its own transaction,
+    so a bad row never blocks the rest of the file.
+
+    Returns:
+        dict: counts of processed, inserted and updated rows plus per-row errors
+    """
+    result = {'processed': 0, 'inserted': 0, 'updated': 0, 'errors': []}
+    maps = _load_lookup_maps()
+    warehouse_ids = db.session.execute(
+        select(Warehouse.id).where(Warehouse.is_active == True)
+    ).scalars().all()
+
+    chunk = []
+    seen_skus = set()
+    seen_barcodes = set()
+
+    def flush():
+        try:
+            _write_chunk(chunk, warehouse_ids, result)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            # Lookups created in the failed transaction no longer exist
+            maps.update(_load_lookup_maps())
+            for row_number, values in chunk:
+                result['errors'].append({'row': row_number, 'sku': values['sku'], 'error': str(e)})
+        chunk.clear()
+
+    for row_number, row in rows:
+        result['processed'] += 1
+        sku = (row.get('sku') or '').strip()
+        if sku and sku in seen_skus:
+            result['errors'].append({'row': row_number, 'sku': sku, 'error': 'SKU duplicado en el archivo'})
+            continue
+        seen_skus.add(sku)
+
+        try:
+            values = _validate_row(row, maps, create_missing)
+        except ValueError as e:
+            result['errors'].append({'row': row_number, 'sku': row.get('sku', ''), 'error': str(e)})
+            continue
+
+        if values['barcode'] and values['barcode'] in seen_barcodes:
+            result['errors'].append({'row': row_number, 'sku': values['sku'], 'error': 'Código de barras duplicado en el archivo'})
+            continue
+        if values['barcode']:
+            seen_barcodes.add(values['barcode'])
+
+        chunk.append((row_number, values))
+        if len(chunk) >= chunk_size:
+            flush()
+
+    if chunk:
+        flush()
+
+    if result['inserted'] or result['updated']:
+        bump_data_version('catalog')
+        if result['inserted']:
+            bump_data_version('inventory')  # New products get inventory rows
+            dashboard_metrics.refresh_counts()
+            dashboard_metrics.refresh_low_stock()
+        db.session.commit()
+
+    result['errors'].sort(key=lambda error: error['row'])
+    return result
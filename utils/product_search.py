@@ -0,0 +1,236 @@
+import logging
+from sqlalchemy import text, select, update, bindparam, func
+from models import Product, fold_search_text
+from app import db
+
+logger = logging.getLogger(__name__)
+
+MAX_CANDIDATES = 500
+BACKFILL_BATCH = 2000
+
+# Which index backs the search on this database: 'trigram', 'fts5' or 'like'
+_backend = None
+
+SQLITE_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+           search_text, content='products', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+           INSERT INTO products_fts(rowid, search_text) VALUES (new.id, new.search_text);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+           INSERT INTO products_fts(products_fts, rowid, search_text) VALUES ('delete', old.id, old.search_text);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF search_text ON products BEGIN
+           INSERT INTO products_fts(products_fts, rowid, search_text) VALUES ('delete', old.id, old.search_text);
+           INSERT INTO products_fts(rowid, search_text) VALUES (new.id, new.search_text);
+       END""",
+]
+
+POSTGRES_TRGM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX IF NOT EXISTS idx_product_search_trgm
+           ON products USING gin (search_text gin_trgm_ops)""",
+]
+
+
+def ensure_search_indexes():
+    """Create the search index for the current database and backfill search_text"""
+    global _backend
+    dialect = db.engine.dialect.name
+
+    try:
+        # Rows written before search_text existed; filled before the FTS triggers see them
+        backfilled = backfill_search_text()
+
+        if dialect == 'postgresql':
+            for ddl in POSTGRES_TRGM_DDL:
+                db.session.execute(text(ddl))
+            _backend = 'trigram'
+        elif dialect == 'sqlite':
+            created = not db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+            )).first()
+            for ddl in SQLITE_FTS_DDL:
+                db.session.execute(text(ddl))
+            _backend = 'fts5'
+            if created or backfilled:
+                db.session.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+        else:
+            _backend = 'like'
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f'Product search index unavailable, using LIKE: {str(e)}')
+        _backend = 'like'
+
+
+def backfill_search_text(only_missing=True):
+    """Fill products.search_text in batches; returns the number of rows updated"""
+    products = Product.__table__
+    statement = update(products).where(products.c.id == bindparam('b_id')).values(
+        search_text=bindparam('b_search_text')
+    )
+    total = 0
+    last_id = 0
+
+    while True:
+        query = select(products.c.id, products.c.name, products.c.sku, products.c.barcode)\
+            .where(products.c.id > last_id).order_by(products.c.id).limit(BACKFILL_BATCH)
+        if only_missing:
+            query = query.where(products.c.search_text.is_(None))
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+
+        db.session.execute(statement, [
+            {'b_id': row.id, 'b_search_text': fold_search_text(row.name, row.sku, row.barcode)}
+            for row in rows
+        ])
+        db.session.commit()
+        total += len(rows)
+        last_id = rows[-1].id
+
+    return total
+
+
+def rebuild_search_index():
+    """Recompute search_text for every product and rebuild the FTS5 index"""
+    total = backfill_search_text(only_missing=False)
+    if _backend_name() == 'fts5':
+        db.session.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+        db.session.commit()
+    return total
+
+
+def _backend_name():
+    if _backend is None:
+        ensure_search_indexes()
+    return _backend
+
+
+def _sku_prefix_range(term):
+    """Bounds for a SKU prefix scan that any btree index on sku can serve"""
+    return term, term[:-1] + chr(ord(term[-1]) + 1)
+
+
+def _search_clauses(term, words, backend):
+    """
+    Filter and ordering for a search term on the given backend
+
+    SKU prefix matches rank first, then name/SKU/barcode matches by trigram
+    similarity (PostgreSQL) or bm25 (SQLite FTS5).
+    """
+    sku_low, sku_high = _sku_prefix_range(term)
+    sku_prefix = db.and_(Product.sku >= sku_low, Product.sku < sku_high)
+    word_match = db.and_(*[Product.search_text.like(f'%{word}%') for word in words])
+
+    if backend == 'trigram':
+        folded = ' '.join(words)
+        score = (db.case((Product.sku == term, 2), else_=0)
+                 + db.case((sku_prefix, 1), else_=0)
+                 + func.similarity(Product.search_text, folded))
+        condition = db.or_(sku_prefix, word_match, Product.search_text.op('%')(folded))
+        return condition, [score.desc(), Product.name]
+
+    if backend == 'fts5':
+        # Every word as a quoted prefix token: "cami"* "roj"*
+        match = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+        fts_ids = text(
+            "SELECT rowid FROM products_fts WHERE products_fts MATCH :fts_match"
+        ).bindparams(fts_match=match).columns(rowid=db.Integer)
+        # Correlated so the query keeps Product as its only entity (filter_by still works)
+        bm25 = text(
+            "(SELECT bm25(products_fts) FROM products_fts "
+            "WHERE products_fts MATCH :fts_match AND products_fts.rowid = products.id)"
+        ).bindparams(fts_match=match)
+        condition = db.or_(sku_prefix, Product.id.in_(fts_ids))
+        return condition, [db.case((sku_prefix, 0), else_=1), bm25, Product.name]
+
+    return db.or_(sku_prefix, word_match), [Product.name]
+
+
+def apply_product_search(query, term, backend=None):
+    """
+    Restrict a query over Product to a search term, best match first
+
+    Filtering, ranking and any LIMIT/OFFSET added by the caller all run in
+    the database, so other filters and pagination see every match. Accents
+    and case are folded, so "camion" finds "Camión".
+    """
+    term = (term or '').strip()
+    words = fold_search_text(term).split()
+    if not words:
+        return query
+
+    condition, order_by = _search_clauses(term, words, backend or _backend_name())
+    return query.filter(condition).order_by(*order_by)
+
+
+def ranked_product_ids(term, limit=MAX_CANDIDATES):
+    """Active product ids matching a search term, best match first"""
+    if not fold_search_text((term or '').strip()).split():
+        return []
+
+    query = db.session.query(Product.id).filter(Product.is_active == True)
+    try:
+        return [row.id for row in apply_product_search(query, term).limit(limit)]
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f'Product search fell back to LIKE: {str(e)}')
+    return [row.id for row in apply_product_search(query, term, backend='like').limit(limit)]
+
+
+def find_exact_product(term):
+    """Active product whose barcode or SKU equals the scanned term"""
+    term = (term or '').strip()
+    if not term:
+        return None
+    return Product.query.filter(
+        Product.is_active == True,
+        db.or_(Product.barcode == term, Product.sku == term)
+    ).order_by(db.case((Product.barcode == term, 0), else_=1)).first()
+
+
+def search_products(term, warehouse_id=None, limit=20):
+    """
+    Ranked product rows with stock for AJAX search endpoints
+
+    Quantity is the stock in warehouse_id, or the total across warehouses
+    when no warehouse is given.
+    """
+    ids = ranked_product_ids(term, limit=limit)
+    if not ids:
+        return []
+
+    query = text("""
+        SELECT p.id, p.sku, p.name, p.barcode, p.price1, p.price2, p.price3, p.price4,
+               COALESCE(SUM(i.quantity), 0) AS quantity, p.track_serial
+        FROM products p
+        LEFT JOIN inventory i ON p.id = i.product_id
+             AND (:warehouse_id IS NULL OR i.warehouse_id = :warehouse_id)
+        WHERE p.id IN :ids
+        GROUP BY p.id, p.sku, p.name, p.barcode, p.price1, p.price2, p.price3, p.price4, p.track_serial
+    """).bindparams(bindparam('ids', expanding=True))
+
+    rows = {row.id: row for row in db.session.execute(query, {'ids': ids, 'warehouse_id': warehouse_id})}
+    return [rows[product_id] for product_id in ids if product_id in rows]
+
+
+def product_to_dict(row, exact_match=None):
+    """JSON payload shared by inventory, sales and POS search endpoints"""
+    data = {
+        'id': row.id,
+        'sku': row.sku,
+        'name': row.name,
+        'barcode': row.barcode,
+        'price1': float(row.price1 or 0),
+        'price2': float(row.price2 or 0),
+        'price3': float(row.price3 or 0),
+        'price4': float(row.price4 or 0),
+        'quantity': float(row.quantity or 0),
+        'track_serial': row.track_serial
+    }
+    if exact_match is not None:
+        data['exact_match'] = exact_match
+    return data
@@ -0,0 +1,141 @@
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from sqlalchemy import text
+from models import ChartOfAccounts
+from app import db
+from utils.journal_posting import get_mapping_codes
+
+CENT = Decimal('0.01')
+
+BUCKETS = {
+    'current': 'Por vencer',
+    'days_0_30': '0-30 días',
+    'days_31_60': '31-60 días',
+    'days_61_90': '61-90 días',
+    'days_over_90': 'Más de 90 días',
+}
+
+# Days past the due date (sale date + customer credit days) on the cut-off date
+OVERDUE_DAYS = {
+    'postgresql': "(CAST(:as_of AS DATE) - CAST(s.created_at AS DATE)) - COALESCE(c.credit_days, 0)",
+    'sqlite': "CAST(julianday(:as_of) - julianday(date(s.created_at)) AS INTEGER) - COALESCE(c.credit_days, 0)",
+}
+
+# Open items are the credit sales not yet paid, read on idx_sale_open_items.
+# Sales keep no paid amount, so a partially paid invoice counts for its full
+# total; the ledger balance of the receivable account (maintained third-party
+# balances) is the amount actually owed.
+OPEN_ITEMS_SQL = """
+    SELECT s.customer_id, c.full_name, c.document_number, c.phone, c.credit_days, c.credit_limit,
+           s.payment_status, COALESCE(s.total, 0) AS amount, {overdue} AS overdue
+    FROM sales s
+    JOIN customers c ON c.id = s.customer_id
+    WHERE s.payment_method = 'credit' AND s.payment_status IN ('pending', 'partial')
+      AND s.created_at < :as_of_end
+      {search}
+"""
+
+BUCKET_COLUMNS = """
+    COUNT(*) AS open_items,
+    SUM(CASE WHEN items.payment_status = 'partial' THEN 1 ELSE 0 END) AS partial_items,
+    SUM(CASE WHEN items.overdue < 0 THEN items.amount ELSE 0 END) AS current,
+    SUM(CASE WHEN items.overdue BETWEEN 0 AND 30 THEN items.amount ELSE 0 END) AS days_0_30,
+    SUM(CASE WHEN items.overdue BETWEEN 31 AND 60 THEN items.amount ELSE 0 END) AS days_31_60,
+    SUM(CASE WHEN items.overdue BETWEEN 61 AND 90 THEN items.amount ELSE 0 END) AS days_61_90,
+    SUM(CASE WHEN items.overdue > 90 THEN items.amount ELSE 0 END) AS days_over_90,
+    SUM(items.amount) AS total
+"""
+
+SEARCH_FILTER = "AND (LOWER(c.full_name) LIKE :search OR LOWER(c.document_number) LIKE :search)"
+
+# Bucketed per customer in one grouped pass, largest first; customers is the
+# number of customers matching before LIMIT/OFFSET cut the page
+AGING_SQL = f"""
+    SELECT items.customer_id, items.full_name, items.document_number, items.phone,
+           items.credit_days, items.credit_limit, {BUCKET_COLUMNS},
+           MAX(items.overdue) AS max_overdue,
+           MAX(ledger.balance) AS ledger_balance,
+           COUNT(*) OVER () AS customers
+    FROM ({OPEN_ITEMS_SQL}) items
+    LEFT JOIN third_party_balances ledger
+           ON ledger.third_party_id = items.customer_id AND ledger.account_id = :receivable_account_id
+    GROUP BY items.customer_id, items.full_name, items.document_number, items.phone,
+             items.credit_days, items.credit_limit
+    ORDER BY total DESC, items.customer_id
+    {{limit}}
+"""
+
+AGING_TOTALS_SQL = f"""
+    SELECT {BUCKET_COLUMNS}
+    FROM ({OPEN_ITEMS_SQL}) items
+"""
+
+
+def _amount(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def _receivable_account_id():
+    code = get_mapping_codes().get('receivable')
+    account = ChartOfAccounts.query.filter_by(code=code).first() if code else None
+    return account.id if account else None
+
+
+def _params(as_of):
+    return {
+        'as_of': as_of,
+        'as_of_end': datetime.combine(as_of + timedelta(days=1), datetime.min.time()),
+    }
+
+
+def _sql(template, search, limit=''):
+    overdue = OVERDUE_DAYS.get(db.engine.dialect.name, OVERDUE_DAYS['sqlite'])
+    return text(template.format(overdue=overdue, search=SEARCH_FILTER if search else '', limit=limit))
+
+
+def aging_report(as_of=None, search=None, page=None, per_page=None):
+    """
+    Open receivables per customer in aging buckets on a cut-off date
+
+    The customer search and the page are applied in SQL; without a page
+    every customer is returned (exports).
+
+    Returns:
+        dict: rows (one per customer, largest balance first) and the number
+              of customers matching
+    """
+    as_of = as_of or date.today()
+    params = dict(_params(as_of), receivable_account_id=_receivable_account_id())
+    if search:
+        params['search'] = f'%{search.lower()}%'
+    limit = ''
+    if page:
+        limit = 'LIMIT :limit OFFSET :offset'
+        params.update(limit=per_page, offset=(page - 1) * per_page)
+
+    rows = []
+    customers = 0
+    for row in db.session.execute(_sql(AGING_SQL, search, limit), params):
+        customers = row.customers
+        item = {
+            'customer_id': row.customer_id, 'name': row.full_name or 'Sin nombre',
+            'document_number': row.document_number or '', 'phone': row.phone or '',
+            'credit_days': row.credit_days or 0, 'credit_limit': _amount(row.credit_limit),
+            'open_items': row.open_items, 'partial_items': row.partial_items or 0,
+            'max_overdue': max(row.max_overdue or 0, 0),
+            'ledger_balance': _amount(row.ledger_balance) if row.ledger_balance is not None else None,
+        }
+        for field in list(BUCKETS) + ['total']:
+            item[field] = _amount(getattr(row, field))
+        rows.append(item)
+
+    return {'rows': rows, 'customers': customers}
+
+
+def aging_totals(as_of=None):
+    """Invoice totals per aging bucket over every customer"""
+    row = db.session.execute(_sql(AGING_TOTALS_SQL, None), _params(as_of or date.today())).one()
+    totals = {field: _amount(getattr(row, field)) for field in list(BUCKETS) + ['total']}
+    totals['open_items'] = row.open_items
+    totals['partial_items'] = row.partial_items or 0
+    return totals
@@ -0,0 +1,171 @@
+import math
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from sqlalchemy import text, select, delete
+from sqlalchemy.orm import joinedload
+from models import ReorderSuggestion, Inventory, Product
+from app import db
+
+WINDOW_DAYS = 90
+LEAD_TIME_DAYS = 7
+REVIEW_DAYS = 14
+SERVICE_Z = 1.65  # ~95% nivel de servicio
+INSERT_BATCH = 2000
+
+suggestions = ReorderSuggestion.__table__
+
+
+def _to_date(value):
+    # DATE() returns a date on PostgreSQL and a 'YYYY-MM-DD' string on SQLite
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _daily_demand_rows(start, end):
+    """Units sold per product, warehouse and day, aggregated in the database"""
+    query = text("""
+        SELECT sd.product_id, s.warehouse_id, DATE(s.created_at) AS day, SUM(sd.quantity) AS quantity
+        FROM sale_details sd
+        JOIN sales s ON s.id = sd.sale_id
+        JOIN products p ON p.id = sd.product_id
+        WHERE s.created_at >= :start AND s.created_at < :end
+        AND p.is_service = :is_service
+        GROUP BY sd.product_id, s.warehouse_id, DATE(s.created_at)
+    """)
+    return db.session.execute(query, {'start': start, 'end': end, 'is_service': False})
+
+
+def _last_supplier_map():
+    """product_id -> supplier of the most recent purchase of that product"""
+    query = text("""
+        SELECT last.product_id, pu.supplier_id
+        FROM (SELECT product_id, MAX(purchase_id) AS purchase_id
+              FROM purchase_details GROUP BY product_id) last
+        JOIN purchases pu ON pu.id = last.purchase_id
+    """)
+    return {row.product_id: row.supplier_id for row in db.session.execute(query)}
+
+
+def compute_reorder_suggestions(window_days=WINDOW_DAYS, lead_time_days=LEAD_TIME_DAYS,
+                                review_days=REVIEW_DAYS, service_z=SERVICE_Z):
+    """
+    Recompute reorder suggestions from sales velocity
+
+    Builds a (product, warehouse) x day demand matrix for the last window_days
+    complete days and derives, per row:
+        reorder point = demand during lead time + z * std * sqrt(lead time)
+        suggested qty = order-up-to level (reorder point + review period demand)
+                        minus stock on hand, when stock is at or below the reorder point
+
+    The suggestions table is replaced in a single transaction.
+
+    Returns:
+        dict: rows computed, rows with a purchase suggestion and computed_at
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise ValueError('El cálculo de sugerencias de compra requiere el paquete numpy')
+
+    end = datetime.combine(date.today(), datetime.min.time())
+    start = end - timedelta(days=window_days)
+    start_day = start.date()
+
+    products, warehouses, days, quantities = [], [], [], []
+    for row in _daily_demand_rows(start, end):
+        products.append(row.product_id)
+        warehouses.append(row.warehouse_id)
+        days.append((_to_date(row.day) - start_day).days)
+        quantities.append(float(row.quantity or 0))
+
+    computed_at = datetime.utcnow()
+    result = {'rows': 0, 'suggested': 0, 'computed_at': computed_at}
+
+    try:
+        db.session.execute(delete(suggestions))
+
+        if products:
+            keys = np.column_stack((np.array(products), np.array(warehouses)))
+            pairs, row_index = np.unique(keys, axis=0, return_inverse=True)
+            row_index = row_index.reshape(-1)
+
+            demand = np.zeros((len(pairs), window_days))
+            np.add.at(demand, (row_index, np.array(days)), np.array(quantities))
+
+            mean = demand.mean(axis=1)
+            std = demand.std(axis=1, ddof=1) if window_days > 1 else np.zeros(len(pairs))
+
+            stock_map = {
+                (row.product_id, row.warehouse_id): float(row.quantity or 0)
+                for row in db.session.execute(
+                    select(Inventory.product_id, Inventory.warehouse_id, Inventory.quantity)
+                )
+            }
+            on_hand = np.array([stock_map.get((int(p), int(w)), 0.0) for p, w in pairs])
+
+            reorder_point = mean * lead_time_days + service_z * std * math.sqrt(lead_time_days)
+            order_up_to = reorder_point + mean * review_days
+            suggested = np.where(on_hand <= reorder_point,
+                                 np.ceil(np.maximum(order_up_to - on_hand, 0)), 0)
+            cover = np.full(len(pairs), np.nan)
+            np.divide(np.maximum(on_hand, 0), mean, out=cover, where=mean > 0)
+
+            supplier_map = _last_supplier_map()
+            cost_map = dict(db.session.execute(select(Product.id, Product.cost)).all())
+
+            records = []
+            for i, (product_id, warehouse_id) in enumerate(pairs):
+                product_id, warehouse_id = int(product_id), int(warehouse_id)
+                records.append({
+                    'product_id': product_id,
+                    'warehouse_id': warehouse_id,
+                    'supplier_id': supplier_map.get(product_id),
+                    'avg_daily_demand': round(float(mean[i]), 4),
+                    'demand_std': round(float(std[i]), 4),
+                    'quantity_on_hand': round(float(on_hand[i]), 3),
+                    'days_of_cover': None if np.isnan(cover[i]) else round(float(cover[i]), 1),
+                    'reorder_point': round(float(reorder_point[i]), 3),
+                    'suggested_quantity': float(suggested[i]),
+                    'unit_cost': cost_map.get(product_id) or Decimal('0'),
+                    'computed_at': computed_at,
+                })
+
+            for offset in range(0, len(records), INSERT_BATCH):
+                db.session.execute(suggestions.insert(), records[offset:offset + INSERT_BATCH])
+
+            result['rows'] = len(records)
+            result['suggested'] = int(np.count_nonzero(suggested))
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return result
+
+
+def suggestions_by_supplier(warehouse_id=None, supplier_id=None):
+    """
+    Pending purchase suggestions grouped by supplier for the purchasing screen
+
+    Returns:
+        list: dicts with supplier, items and estimated total, largest total first
+    """
+    query = ReorderSuggestion.query.options(
+        joinedload(ReorderSuggestion.product),
+        joinedload(ReorderSuggestion.warehouse),
+        joinedload(ReorderSuggestion.supplier)
+    ).filter(ReorderSuggestion.suggested_quantity > 0)
+    if warehouse_id:
+        query = query.filter(ReorderSuggestion.warehouse_id == warehouse_id)
+    if supplier_id:
+        query = query.filter(ReorderSuggestion.supplier_id == supplier_id)
+
+    groups = {}
+    for item in query.order_by(ReorderSuggestion.days_of_cover).all():
+        group = groups.setdefault(item.supplier_id, {'supplier': item.supplier, 'items': [], 'total': Decimal('0')})
+        group['items'].append(item)
+        group['total'] += Decimal(item.suggested_quantity or 0) * Decimal(item.unit_cost or 0)
+
+    return sorted(groups.values(), key=lambda group: group['total'], reverse=True)
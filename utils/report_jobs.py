@@ -0,0 +1,399 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import text, func, update
+from models import ReportJob, Sale, Product, Customer
+from app import db
+from utils.cache import get_data_versions
+from utils.abc_classification import CLASSES as ABC_CLASSES
+from utils.export import stream_rows, write_csv_gz, write_xlsx
+from utils.pdf_generator import write_report_pdf
+
+WINDOW_SIZE = 20000  # Sale ids aggregated per step; progress is reported after each one
+STALE_AFTER = timedelta(hours=1)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def artifact_dir():
+    return current_app.config['REPORT_ARTIFACT_DIR']
+
+
+FORMATS = {
+    # The CSV keeps just the header row so it loads as plain data; the other formats print the title
+    'csv': {'label': 'CSV', 'extension': 'csv.gz', 'mimetype': 'application/gzip',
+            'writer': lambda path, title, header, rows: write_csv_gz(path, header, rows)},
+    'xlsx': {'label': 'Excel', 'extension': 'xlsx', 'writer': write_xlsx,
+             'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    'pdf': {'label': 'PDF', 'extension': 'pdf', 'mimetype': 'application/pdf', 'writer': write_report_pdf},
+}
+
+INVENTORY_SQL = """
+    SELECT p.id, p.sku, p.name, p.cost, p.price1,
+           c.name as category_name, b.name as brand_name,
+           w.name as warehouse_name, pc.revenue_class as abc_class,
+           i.quantity, i.min_stock, i.max_stock,
+           (i.quantity * p.cost) as inventory_value
+    FROM products p
+    LEFT JOIN categories c ON p.category_id = c.id
+    LEFT JOIN brands b ON p.brand_id = b.id
+    JOIN inventory i ON p.id = i.product_id
+    JOIN warehouses w ON i.warehouse_id = w.id
+    LEFT JOIN product_classifications pc ON pc.product_id = i.product_id AND pc.warehouse_id = i.warehouse_id
+    WHERE p.is_active = true
+    AND (:warehouse_id IS NULL OR i.warehouse_id = :warehouse_id)
+    AND (:category_id IS NULL OR p.category_id = :category_id)
+    AND (:abc_class IS NULL OR pc.revenue_class = :abc_class)
+    AND (:show_zero OR i.quantity > 0)
+    ORDER BY p.name
+"""
+
+
+# ===== Report definitions =====
+
+def _profit_params(params):
+    end_date = params.get('end_date') or datetime.now().strftime('%Y-%m-%d')
+    start_date = params.get('start_date') or (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    # Validate the format so the parameters hash the same however they were typed
+    datetime.strptime(start_date, '%Y-%m-%d')
+    datetime.strptime(end_date, '%Y-%m-%d')
+    return {'start_date': start_date, 'end_date': end_date}
+
+
+def _profit_rows(params, progress):
+    """Same figures as profit_report, aggregated in sale id windows"""
+    period = {'start_date': params['start_date'], 'end_date': params['end_date'] + ' 23:59:59'}
+    low, high = db.session.query(func.min(Sale.id), func.max(Sale.id)).filter(
+        Sale.created_at >= period['start_date'], Sale.created_at <= period['end_date']
+    ).one()
+
+    totals = {}
+    window_query = text("""
+        SELECT sd.product_id, SUM(sd.quantity) AS quantity, SUM(sd.total) AS revenue,
+               SUM(sd.quantity * sd.unit_cost) AS cost
+        FROM sale_details sd
+        JOIN sales s ON s.id = sd.sale_id
+        WHERE s.id >= :low AND s.id < :high
+        AND s.created_at >= :start_date AND s.created_at <= :end_date
+        GROUP BY sd.product_id
+    """)
+    for window_low, window_high in _windows(low, high, progress):
+        for row in db.session.execute(window_query, {**period, 'low': window_low, 'high': window_high}):
+            entry = totals.setdefault(row.product_id, [0.0, 0.0, 0.0])
+            entry[0] += float(row.quantity or 0)
+            entry[1] += float(row.revenue or 0)
+            entry[2] += float(row.cost or 0)
+
+    products = _load_by_id(Product, [Product.id, Product.name, Product.sku], list(totals))
+    rows = []
+    for product_id, (quantity, revenue, total_cost) in totals.items():
+        product = products.get(product_id)
+        if not product or quantity <= 0:
+            continue
+        gross_profit = revenue - total_cost
+        rows.append([
+            product.name, product.sku, quantity, round(total_cost / quantity, 2), round(revenue / quantity, 2),
+            round(revenue, 2), round(total_cost, 2), round(gross_profit, 2),
+            round(gross_profit / revenue * 100, 2) if revenue > 0 else 0
+        ])
+    rows.sort(key=lambda row: row[7], reverse=True)
+    return rows
+
+
+def _inventory_params(params):
+    def optional_id(name):
+        value = params.get(name)
+        return int(value) if value not in (None, '', 'None') else None
+
+    abc_class = params.get('abc_class')
+    return {
+        'warehouse_id': optional_id('warehouse_id'),
+        'category_id': optional_id('category_id'),
+        'abc_class': abc_class if abc_class in ABC_CLASSES else None,
+        'show_zero': params.get('show_zero') in (True, 'True', 'true', '1', 'on'),
+    }
+
+
+def _inventory_rows(params, progress):
+    """Same rows as inventory_report, read from a server-side cursor as they are written"""
+    query_params = {key: params[key] for key in ('warehouse_id', 'category_id', 'abc_class', 'show_zero')}
+    total = db.session.execute(text(f"SELECT COUNT(*) FROM ({INVENTORY_SQL}) t"), query_params).scalar()
+    # The count must not keep a transaction open while the cursor is read on its own connection
+    db.session.commit()
+
+    # SQLite locks out writers while a read cursor is open: progress only at the end there
+    live_progress = db.engine.dialect.name != 'sqlite'
+
+    done = 0
+    for partition in stream_rows(text(INVENTORY_SQL), query_params):
+        for row in partition:
+            yield [row.sku, row.name, row.category_name, row.brand_name, row.warehouse_name,
+                   row.abc_class, row.quantity, row.min_stock, row.max_stock,
+                   row.cost, row.price1, row.inventory_value]
+        done += len(partition)
+        if live_progress:
+            progress(min(int(done * 95 / total), 95) if total else 95)
+
+
+def _customer_params(params):
+    customer_type = params.get('type') or 'client'
+    if customer_type not in ('client', 'supplier'):
+        raise ValueError('Tipo de tercero no válido')
+    return {'type': customer_type}
+
+
+def _customer_rows(params, progress):
+    """Same figures as customer_report, aggregated in sale id windows"""
+    low, high = db.session.query(func.min(Sale.id), func.max(Sale.id)).one()
+
+    totals = {}
+    window_query = text("""
+        SELECT customer_id, COUNT(*) AS orders, SUM(total) AS spent, MAX(created_at) AS last_order
+        FROM sales
+        WHERE id >= :low AND id < :high AND customer_id IS NOT NULL
+        GROUP BY customer_id
+    """)
+    for window_low, window_high in _windows(low, high, progress):
+        for row in db.session.execute(window_query, {'low': window_low, 'high': window_high}):
+            entry = totals.setdefault(row.customer_id, [0, 0.0, None])
+            entry[0] += row.orders
+            entry[1] += float(row.spent or 0)
+            entry[2] = max(entry[2], row.last_order) if entry[2] is not None else row.last_order
+
+    customers = db.session.query(
+        Customer.id, Customer.full_name, Customer.email, Customer.phone
+    ).filter(Customer.type == params['type'], Customer.is_active == True).all()
+
+    rows = []
+    for customer in customers:
+        orders, spent, last_order = totals.get(customer.id, (0, 0.0, None))
+        if isinstance(last_order, datetime):
+            last_order = last_order.strftime('%Y-%m-%d %H:%M:%S')
+        rows.append([customer.full_name, customer.email, customer.phone, orders, round(spent, 2),
+                     str(last_order)[:19] if last_order else ''])
+    rows.sort(key=lambda row: row[4], reverse=True)
+    return rows
+
+
+REPORTS = {
+    'profit': {
+        'title': 'Rentabilidad por Producto',
+        'domains': ('sales', 'catalog'),
+        'params': _profit_params,
+        'rows': _profit_rows,
+        'header': ['Producto', 'SKU', 'Cantidad Vendida', 'Costo Promedio', 'Precio Promedio',
+                   'Ingresos Totales', 'Costo Total', 'Ganancia Bruta', 'Margen (%)'],
+    },
+    'inventory': {
+        'title': 'Inventario',
+        'domains': ('inventory', 'catalog', 'classification'),
+        'params': _inventory_params,
+        'rows': _inventory_rows,
+        'header': ['SKU', 'Producto', 'Categoría', 'Marca', 'Bodega', 'ABC', 'Cantidad', 'Stock Mín.',
+                   'Stock Máx.', 'Costo', 'Precio', 'Valor Total'],
+    },
+    'customers': {
+        'title': 'Clientes',
+        'domains': ('sales', 'customers'),
+        'params': _customer_params,
+        'rows': _customer_rows,
+        'header': ['Nombre', 'Email', 'Teléfono', 'Total Órdenes', 'Total Gastado', 'Última Orden'],
+    },
+}
+
+
+def _windows(low, high, progress):
+    """Split the sale id range [low, high] into windows, reporting progress as they are consumed"""
+    if low is None:
+        return
+    steps = (high - low) // WINDOW_SIZE + 1
+    for step in range(steps):
+        window_low = low + step * WINDOW_SIZE
+        yield window_low, min(window_low + WINDOW_SIZE, high + 1)
+        progress(int((step + 1) * 90 / steps))
+
+
+def _load_by_id(model, columns, ids, chunk_size=1000):
+    rows = {}
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        for row in db.session.query(*columns).filter(model.id.in_(chunk)):
+            rows[row.id] = row
+    return rows
+
+
+# ===== Queue =====
+
+def job_cache_key(report_type, params):
+    """Hash of the report, its normalized parameters and the versions of the data it reads"""
+    versions = get_data_versions(REPORTS[report_type]['domains'])
+    payload = json.dumps({'report': report_type, 'params': params, 'versions': versions}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def submit_job(report_type, raw_params, user_id=None):
+    """
+    Queue a report, or return the user's job that already has (or is building) the same result
+
+    When another user's job already stored the same result, the caller gets
+    a finished job of their own pointing at that artifact.
+
+    Raises:
+        ValueError: unknown report or invalid parameters
+    """
+    if report_type not in REPORTS:
+        raise ValueError('Tipo de reporte no válido')
+    output_format = raw_params.get('format') or 'csv'
+    if output_format not in FORMATS:
+        raise ValueError('Formato de reporte no válido')
+    params = dict(REPORTS[report_type]['params'](raw_params), format=output_format)
+    key = job_cache_key(report_type, params)
+
+    existing = ReportJob.query.filter(
+        ReportJob.cache_key == key, ReportJob.user_id == user_id,
+        ReportJob.status.in_(['queued', 'running', 'done'])
+    ).order_by(ReportJob.id.desc()).first()
+    if existing and (existing.status != 'done' or os.path.exists(existing.artifact_path or '')):
+        return existing
+
+    # Same report on the same data versions, built for someone else
+    shared = ReportJob.query.filter(ReportJob.cache_key == key, ReportJob.status == 'done')\
+        .order_by(ReportJob.id.desc()).first()
+    if shared and os.path.exists(shared.artifact_path or ''):
+        now = datetime.utcnow()
+        job = ReportJob(report_type=report_type, params=json.dumps(params), cache_key=key, user_id=user_id,
+                        status='done', progress=100, row_count=shared.row_count,
+                        artifact_path=shared.artifact_path, artifact_size=shared.artifact_size,
+                        started_at=now, finished_at=now)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    job = ReportJob(report_type=report_type, params=json.dumps(params), cache_key=key, user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+
+    _get_executor().submit(_run_in_context, current_app._get_current_object(), job.id)
+    return job
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config.get('REPORT_WORKERS', 2),
+                                           thread_name_prefix='report-job')
+        return _executor
+
+
+def _run_in_context(app, job_id):
+    with app.app_context():
+        try:
+            run_job(job_id)
+        finally:
+            db.session.remove()
+
+
+def _claim(job_id):
+    """Move a queued job to running; False if another worker got it first"""
+    claimed = db.session.execute(
+        update(ReportJob.__table__)
+        .where(ReportJob.__table__.c.id == job_id, ReportJob.__table__.c.status == 'queued')
+        .values(status='running', started_at=datetime.utcnow(), progress=0)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def _set_progress(job_id, value):
+    db.session.execute(
+        update(ReportJob.__table__).where(ReportJob.__table__.c.id == job_id).values(progress=value)
+    )
+    db.session.commit()
+
+
+def run_job(job_id):
+    """Build the artifact of a queued job (runs in a worker thread or the CLI worker)"""
+    if not _claim(job_id):
+        return
+
+    job = db.session.get(ReportJob, job_id)
+    report = REPORTS[job.report_type]
+    params = json.loads(job.params)
+    output = FORMATS[job_format(job)]
+    temp_path = None
+    try:
+        # Rows may be a generator over a cursor: the writer consumes them as it writes
+        rows = report['rows'](params, lambda value: _set_progress(job_id, value))
+
+        os.makedirs(artifact_dir(), exist_ok=True)
+        path = os.path.join(artifact_dir(), f"{job.cache_key}.{output['extension']}")
+        # Two users may build the same key at once; each writes its own temp file
+        temp_path = f'{path}.{job_id}.tmp'
+        row_count = output['writer'](temp_path, report['title'], report['header'], rows)
+        os.replace(temp_path, path)
+
+        job = db.session.get(ReportJob, job_id)
+        job.status = 'done'
+        job.progress = 100
+        job.row_count = row_count
+        job.artifact_path = path
+        job.artifact_size = os.path.getsize(path)
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.exception('Report job %s failed', job_id)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        job = db.session.get(ReportJob, job_id)
+        job.status = 'failed'
+        job.error = str(e)
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+
+def run_pending_jobs():
+    """
+    Run queued jobs in this process (CLI worker)
+
+    Jobs left queued by a web process that restarted are picked up here, and
+    jobs stuck in running for longer than STALE_AFTER are queued again.
+    """
+    db.session.execute(
+        update(ReportJob.__table__)
+        .where(ReportJob.__table__.c.status == 'running',
+               ReportJob.__table__.c.started_at < datetime.utcnow() - STALE_AFTER)
+        .values(status='queued')
+    )
+    db.session.commit()
+
+    processed = 0
+    while True:
+        job_id = db.session.query(ReportJob.id).filter_by(status='queued')\
+            .order_by(ReportJob.created_at).limit(1).scalar()
+        if job_id is None:
+            return processed
+        run_job(job_id)
+        processed += 1
+
+
+def job_format(job):
+    """Output format of a job; jobs queued before formats existed are CSV"""
+    return json.loads(job.params or '{}').get('format', 'csv')
+
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'progress': job.progress or 0,
+        'row_count': job.row_count or 0,
+        'error': job.error,
+    }
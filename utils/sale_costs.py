@@ -0,0 +1,73 @@
+from decimal import Decimal
+from sqlalchemy import text, func
+from models import SaleDetail, Product
+from app import db
+from utils.cache import bump_data_version
+
+BACKFILL_BATCH = 10000
+
+# Best estimate for lines sold before costs were captured: the last purchase
+# cost of the product on or before the sale date, else its current cost
+BACKFILL_COST_SQL = """
+    UPDATE sale_details SET unit_cost = COALESCE(
+        (SELECT pd.unit_cost
+         FROM purchase_details pd
+         JOIN purchases pu ON pu.id = pd.purchase_id
+         WHERE pd.product_id = sale_details.product_id
+         AND pu.created_at <= (SELECT s.created_at FROM sales s WHERE s.id = sale_details.sale_id)
+         ORDER BY pu.created_at DESC, pd.id DESC
+         LIMIT 1),
+        (SELECT p.cost FROM products p WHERE p.id = sale_details.product_id),
+        0)
+    WHERE id >= :low AND id < :high AND unit_cost IS NULL
+"""
+
+BACKFILL_MARGIN_SQL = """
+    UPDATE sale_details SET gross_margin = total - quantity * unit_cost
+    WHERE id >= :low AND id < :high AND gross_margin IS NULL AND unit_cost IS NOT NULL
+"""
+
+
+def current_costs(product_ids):
+    """product_id -> current cost, in one query for all the lines of a sale"""
+    if not product_ids:
+        return {}
+    rows = db.session.query(Product.id, Product.cost).filter(Product.id.in_(set(product_ids))).all()
+    return {product_id: cost or 0 for product_id, cost in rows}
+
+
+def capture_cost(detail, unit_cost):
+    """Store the cost at sale time and the line margin on a new sale detail"""
+    unit_cost = Decimal(str(unit_cost or 0))
+    detail.unit_cost = unit_cost
+    detail.gross_margin = Decimal(str(detail.total)) - Decimal(str(detail.quantity)) * unit_cost
+
+
+def backfill_sale_costs(batch_size=BACKFILL_BATCH):
+    """
+    Fill unit_cost and gross_margin on sale details recorded without them
+
+    Walks sale_details by id, one transaction per batch, so it can be stopped
+    and resumed. The daily rollups hold the cost already summed, so rebuild
+    them afterwards. Returns the number of lines updated.
+    """
+    low, high = db.session.query(func.min(SaleDetail.id), func.max(SaleDetail.id)).filter(
+        SaleDetail.unit_cost.is_(None)
+    ).one()
+    if low is None:
+        return 0
+
+    updated = 0
+    for start in range(low, high + 1, batch_size):
+        params = {'low': start, 'high': start + batch_size}
+        try:
+            result = db.session.execute(text(BACKFILL_COST_SQL), params)
+            db.session.execute(text(BACKFILL_MARGIN_SQL), params)
+            bump_data_version('sales')
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        updated += result.rowcount
+
+    return updated
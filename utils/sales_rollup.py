@@ -0,0 +1,302 @@
+import logging
+import threading
+import time
+from datetime import date
+from types import SimpleNamespace
+from decimal import Decimal
+from sqlalchemy import text, func, select, bindparam
+from models import Sale, SalesDailyTotal, SalesDailyProduct, Product
+from app import db
+from utils.cache import bump_data_version
+from utils import dashboard_metrics
+from utils.customer_stats import CUSTOMER_STATS_SQL
+
+CATCH_UP_BATCH = 5000
+ROLLUP_DELAY = 10  # Seconds a sale waits so the tickets around it share one batch
+ROLLUP_INTERVAL = 60  # Periodic pass for sales committed by other workers or outside the app
+ROLLUP_LOCK_KEY = 731001  # pg advisory lock held by the worker rolling up a batch
+
+_runner = None
+_runner_lock = threading.Lock()
+_wake = threading.Event()
+
+SEGMENT_LABELS = {
+    0: 'Sin cliente',
+    1: 'Público',
+    2: 'Mayorista',
+    3: 'Distribuidor',
+    4: 'Especial',
+}
+
+# Customer segment at sale time: anonymous sales apart, otherwise the customer's price level
+SEGMENT_SQL = "CASE WHEN s.customer_id IS NULL THEN 0 ELSE COALESCE(c.price_level, 1) END"
+
+ROLLUP_TOTALS_SQL = f"""
+    INSERT INTO sales_daily_totals (day, warehouse_id, customer_segment, sales_count,
+                                    subtotal, tax_amount, discount_amount, total)
+    SELECT DATE(s.created_at), s.warehouse_id, {SEGMENT_SQL}, COUNT(*),
+           COALESCE(SUM(s.subtotal), 0), COALESCE(SUM(s.tax_amount), 0),
+           COALESCE(SUM(s.discount_amount), 0), COALESCE(SUM(s.total), 0)
+    FROM sales s
+    LEFT JOIN customers c ON c.id = s.customer_id
+    WHERE s.id IN :ids
+    GROUP BY DATE(s.created_at), s.warehouse_id, {SEGMENT_SQL}
+    ON CONFLICT (day, warehouse_id, customer_segment) DO UPDATE SET
+        sales_count = sales_daily_totals.sales_count + excluded.sales_count,
+        subtotal = sales_daily_totals.subtotal + excluded.subtotal,
+        tax_amount = sales_daily_totals.tax_amount + excluded.tax_amount,
+        discount_amount = sales_daily_totals.discount_amount + excluded.discount_amount,
+        total = sales_daily_totals.total + excluded.total
+"""
+
+ROLLUP_PRODUCTS_SQL = f"""
+    INSERT INTO sales_daily_products (day, warehouse_id, product_id, customer_segment,
+                                      quantity, revenue, cost, lines_count)
+    SELECT DATE(s.created_at), s.warehouse_id, sd.product_id, {SEGMENT_SQL},
+           COALESCE(SUM(sd.quantity), 0), COALESCE(SUM(sd.total), 0),
+           COALESCE(SUM(sd.quantity * sd.unit_cost), 0), COUNT(*)
+    FROM sales s
+    JOIN sale_details sd ON sd.sale_id = s.id
+    LEFT JOIN customers c ON c.id = s.customer_id
+    WHERE s.id IN :ids
+    GROUP BY DATE(s.created_at), s.warehouse_id, sd.product_id, {SEGMENT_SQL}
+    ON CONFLICT (day, warehouse_id, product_id, customer_segment) DO UPDATE SET
+        quantity = sales_daily_products.quantity + excluded.quantity,
+        revenue = sales_daily_products.revenue + excluded.revenue,
+        cost = sales_daily_products.cost + excluded.cost,
+        lines_count = sales_daily_products.lines_count + excluded.lines_count
+"""
+
+MARK_ROLLED_UP_SQL = """
+    UPDATE sales SET rolled_up = :done
+    WHERE id IN :ids
+"""
+
+
+def _batch_statement(sql):
+    return text(sql).bindparams(bindparam('ids', expanding=True))
+
+
+def _rollup_sales(ids):
+    """
+    Add the given pending sales to the daily tables and customer stats
+
+    Every statement works on the same fixed ids. Under READ COMMITTED each
+    statement takes its own snapshot, so re-selecting a range of pending ids
+    could mark as rolled up a sale that committed after the totals were read.
+    """
+    params = {'ids': ids}
+    db.session.execute(_batch_statement(ROLLUP_TOTALS_SQL), params)
+    db.session.execute(_batch_statement(ROLLUP_PRODUCTS_SQL), params)
+    db.session.execute(_batch_statement(CUSTOMER_STATS_SQL.format(sales='s.id IN :ids')), params)
+    db.session.execute(_batch_statement(MARK_ROLLED_UP_SQL), {**params, 'done': True})
+
+
+def _acquire_rollup_lock():
+    """
+    Take the rollup lock for the current transaction; False if another worker holds it
+
+    Two workers rolling up the same pending sales would count them twice.
+    SQLite serializes writers already, so only PostgreSQL needs the lock.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return True
+    return bool(db.session.execute(text("SELECT pg_try_advisory_xact_lock(:key)"),
+                                   {'key': ROLLUP_LOCK_KEY}).scalar())
+
+
+def hold_rollup_lock():
+    """
+    Wait for the rollup lock and hold it until the current transaction ends
+
+    For rebuilds that reset rolled-up totals: a catch-up batch committing in
+    the middle would be counted both by itself and by the rebuild.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': ROLLUP_LOCK_KEY})
+
+
+def catch_up_rollups(batch_size=CATCH_UP_BATCH):
+    """
+    Roll up pending sales in batches, one transaction per batch
+
+    Sales are picked by their rolled_up flag rather than an id watermark, so
+    a sale committed after others with higher ids is still included. The
+    dashboard sales counters and the 'sales'/'inventory' data versions move
+    once per batch instead of once per ticket. Returns the number of sales
+    added; stops early when another worker is already catching up.
+    """
+    processed = 0
+
+    while True:
+        try:
+            if not _acquire_rollup_lock():
+                db.session.rollback()
+                break
+            ids = list(db.session.execute(
+                select(Sale.id).where(Sale.rolled_up == False).order_by(Sale.id).limit(batch_size)
+            ).scalars())
+            if not ids:
+                db.session.rollback()
+                break
+
+            _rollup_sales(ids)
+            dashboard_metrics.refresh_sales()
+            bump_data_version('sales')
+            bump_data_version('inventory')
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        processed += len(ids)
+
+    return processed
+
+
+def _run_catch_up(app):
+    while True:
+        if _wake.wait(ROLLUP_INTERVAL):
+            # Let the tickets of the next few seconds join the same batch
+            time.sleep(ROLLUP_DELAY)
+        _wake.clear()
+        try:
+            with app.app_context():
+                catch_up_rollups()
+        except Exception:
+            logging.exception('Sales rollup catch-up failed, retrying on the next pass')
+
+
+def schedule_rollup(app):
+    """
+    Ask this worker's rollup thread for a catch-up pass soon
+
+    Call after a sale commits. The sale transaction itself writes no shared
+    summary rows, so tills do not queue behind each other on them.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None or not _runner.is_alive():
+            _runner = threading.Thread(target=_run_catch_up, args=(app,), daemon=True, name='sales-rollup')
+            _runner.start()
+    _wake.set()
+
+
+def rebuild_rollups():
+    """Drop the daily rollups and customer stats and rebuild them from every sale"""
+    try:
+        hold_rollup_lock()
+        db.session.execute(text("DELETE FROM sales_daily_totals"))
+        db.session.execute(text("DELETE FROM sales_daily_products"))
+        db.session.execute(text("DELETE FROM customer_stats"))
+        db.session.execute(text("UPDATE sales SET rolled_up = :pending"), {'pending': False})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return catch_up_rollups()
+
+
+def _to_date(value):
+    # Date columns come back as strings from raw SQLite queries
+    if isinstance(value, date) or value is None:
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _filters(model, start_date, end_date, warehouse_id=None, segment=None):
+    filters = [model.day >= start_date, model.day <= end_date]
+    if warehouse_id:
+        filters.append(model.warehouse_id == warehouse_id)
+    if segment is not None:
+        filters.append(model.customer_segment == segment)
+    return filters
+
+
+def sales_summary(start_date, end_date, warehouse_id=None, segment=None):
+    """Sales count and amounts for a date range from the daily totals"""
+    row = db.session.query(
+        func.coalesce(func.sum(SalesDailyTotal.sales_count), 0),
+        func.coalesce(func.sum(SalesDailyTotal.subtotal), 0),
+        func.coalesce(func.sum(SalesDailyTotal.tax_amount), 0),
+        func.coalesce(func.sum(SalesDailyTotal.discount_amount), 0),
+        func.coalesce(func.sum(SalesDailyTotal.total), 0)
+    ).filter(*_filters(SalesDailyTotal, start_date, end_date, warehouse_id, segment)).one()
+
+    count = int(row[0] or 0)
+    total = Decimal(str(row[4] or 0))
+    return {
+        'total_transactions': count,
+        'total_subtotal': Decimal(str(row[1] or 0)),
+        'total_tax': Decimal(str(row[2] or 0)),
+        'total_discount': Decimal(str(row[3] or 0)),
+        'total_sales': total,
+        'avg_sale': total / count if count else Decimal('0'),
+    }
+
+
+def daily_sales(start_date, end_date, warehouse_id=None, segment=None):
+    """Per-day sales count and total for charts"""
+    rows = db.session.query(
+        SalesDailyTotal.day,
+        func.sum(SalesDailyTotal.sales_count),
+        func.sum(SalesDailyTotal.total)
+    ).filter(*_filters(SalesDailyTotal, start_date, end_date, warehouse_id, segment))\
+     .group_by(SalesDailyTotal.day).order_by(SalesDailyTotal.day).all()
+
+    return [{'sale_date': _to_date(day), 'sales_count': int(count or 0), 'daily_total': float(total or 0)}
+            for day, count, total in rows]
+
+
+def top_products(start_date, end_date, warehouse_id=None, segment=None, limit=10):
+    """Best-selling products by quantity for a date range"""
+    quantity = func.sum(SalesDailyProduct.quantity)
+    rows = db.session.query(
+        Product.name.label('product_name'),
+        Product.sku,
+        quantity.label('total_quantity'),
+        func.sum(SalesDailyProduct.revenue).label('total_revenue')
+    ).join(Product, Product.id == SalesDailyProduct.product_id)\
+     .filter(*_filters(SalesDailyProduct, start_date, end_date, warehouse_id, segment))\
+     .group_by(Product.id, Product.name, Product.sku)\
+     .order_by(quantity.desc()).limit(limit).all()
+    return rows
+
+
+def profit_by_product(start_date, end_date, warehouse_id=None):
+    """
+    Revenue, cost of sales and gross profit per product for a date range
+
+    Cost is the one captured on each sale line, so history does not move when
+    product costs change. Prices and costs are averaged per unit sold.
+    """
+    quantity = func.sum(SalesDailyProduct.quantity)
+    revenue = func.sum(SalesDailyProduct.revenue)
+    cost = func.sum(SalesDailyProduct.cost)
+    rows = db.session.query(
+        Product.name, Product.sku,
+        quantity.label('quantity'), revenue.label('revenue'), cost.label('cost')
+    ).join(Product, Product.id == SalesDailyProduct.product_id)\
+     .filter(*_filters(SalesDailyProduct, start_date, end_date, warehouse_id))\
+     .group_by(Product.id, Product.name, Product.sku)\
+     .having(quantity > 0)\
+     .order_by((revenue - cost).desc()).all()
+
+    result = []
+    for row in rows:
+        total_sold = float(row.quantity)
+        total_revenue = float(row.revenue or 0)
+        total_cost = float(row.cost or 0)
+        gross_profit = total_revenue - total_cost
+        result.append(SimpleNamespace(
+            name=row.name,
+            sku=row.sku,
+            total_sold=total_sold,
+            avg_cost=total_cost / total_sold,
+            avg_sell_price=total_revenue / total_sold,
+            total_revenue=total_revenue,
+            total_cost=total_cost,
+            gross_profit=gross_profit,
+            profit_margin=(gross_profit / total_revenue * 100) if total_revenue > 0 else 0
+        ))
+    return result
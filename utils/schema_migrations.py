@@ -0,0 +1,120 @@
+import logging
+from sqlalchemy import inspect, literal, text
+from app import db
+from models import Product, Sale, SaleDetail, Purchase, ChartOfAccounts, Setting
+
+logger = logging.getLogger(__name__)
+
+# Ordered steps for tables that already exist; db.create_all() only creates missing tables
+_migrations = []
+
+
+def migration(name):
+    """Register an idempotent schema step; steps run in registration order"""
+    def register(func):
+        _migrations.append((name, func))
+        return func
+    return register
+
+
+def column_exists(table_name, column_name):
+    return column_name in {column['name'] for column in inspect(db.engine).get_columns(table_name)}
+
+
+def add_column(model, column_name, default=None):
+    """
+    ALTER TABLE ... ADD COLUMN from the model definition
+
+    Returns True when the column was added, so the caller can backfill it.
+    """
+    table = model.__table__
+    if column_exists(table.name, column_name):
+        return False
+
+    dialect = db.engine.dialect
+    column = table.c[column_name]
+    ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=dialect)}'
+    if default is not None:
+        default_sql = literal(default, column.type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        ddl += f' DEFAULT {default_sql}'
+    db.session.execute(text(ddl))
+    db.session.commit()
+    logger.info(f'Added column {table.name}.{column.name}')
+    return True
+
+
+def add_index(model, index_name):
+    """CREATE INDEX for an index declared on the model, if it is missing"""
+    index = next(index for index in model.__table__.indexes if index.name == index_name)
+    index.create(bind=db.engine, checkfirst=True)
+
+
+def run_migrations():
+    """Apply pending schema steps; a failing step is logged and the rest still run"""
+    for name, func in _migrations:
+        try:
+            func()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'Schema migration {name} failed: {str(e)}')
+
+
+@migration('products.search_text')
+def add_product_search_text():
+    # Filled in batches by product_search.ensure_search_indexes()
+    add_column(Product, 'search_text')
+
+
+@migration('products.updated_at')
+def add_product_updated_at():
+    if add_column(Product, 'updated_at'):
+        db.session.execute(text('UPDATE products SET updated_at = created_at WHERE updated_at IS NULL'))
+        db.session.commit()
+    add_index(Product, 'idx_product_updated')
+
+
+@migration('sales.rolled_up')
+def add_sale_rolled_up():
+    # Existing sales start pending; the rollup catch-up adds them to the new daily tables
+    add_column(Sale, 'rolled_up', default=False)
+    add_index(Sale, 'idx_sale_rolled_up')
+
+
+@migration('sales.open_items_index')
+def add_sale_open_items_index():
+    add_index(Sale, 'idx_sale_open_items')
+
+
+@migration('sale_details.unit_cost')
+def add_sale_detail_costs():
+    added = add_column(SaleDetail, 'unit_cost')
+    added = add_column(SaleDetail, 'gross_margin') or added
+    add_index(SaleDetail, 'idx_sale_detail_sale')
+    add_index(SaleDetail, 'idx_sale_detail_product')
+    if added:
+        # Too slow for startup on a large history; the command also rebuilds the rollups
+        logger.warning('Sale lines have no cost at sale time yet; run: flask reports backfill-sale-costs')
+
+
+@migration('chart_of_accounts.path')
+def add_account_path():
+    if add_column(ChartOfAccounts, 'path'):
+        from utils.account_tree import rebuild_paths
+        rebuild_paths()
+        db.session.commit()
+    add_index(ChartOfAccounts, 'ix_chart_of_accounts_path')
+
+
+@migration('journal_posting.posted')
+def add_document_posted():
+    # Documents up to the old id watermarks were posted already
+    for model, watermark_key, index_name in (
+            (Sale, 'accounting_posting_last_sale_id', 'idx_sale_posted'),
+            (Purchase, 'accounting_posting_last_purchase_id', 'idx_purchase_posted')):
+        if add_column(model, 'posted', default=False):
+            watermark = Setting.query.filter_by(key=watermark_key).first()
+            if watermark and watermark.value:
+                db.session.execute(model.__table__.update().where(model.id <= int(watermark.value))
+                                   .values(posted=True))
+            db.session.commit()
+        add_index(model, index_name)
@@ -0,0 +1,423 @@
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import select, func, text
+from models import Sale, SaleDetail, Product, Inventory, Customer
+from app import db
+
+BATCH_SIZE = 5000
+# Sales created less than this ago are left for the next run, so transactions still in flight are not skipped
+SAFETY_LAG = timedelta(minutes=5)
+MANIFEST = '_manifest.json'
+STAGING = '_staging'
+PARTITIONED = ('sales', 'sale_details')
+
+sales = Sale.__table__
+sale_details = SaleDetail.__table__
+
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise ValueError('Los snapshots de análisis requieren el paquete pyarrow')
+    return pa, pc, ds
+
+
+def snapshot_dir():
+    return current_app.config['SNAPSHOT_DIR']
+
+
+def _schemas(pa):
+    money = pa.decimal128(14, 2)
+    quantity = pa.decimal128(14, 3)
+    return {
+        'sales': pa.schema([
+            ('id', pa.int64()), ('invoice_number', pa.string()), ('customer_id', pa.int64()),
+            ('warehouse_id', pa.int64()), ('user_id', pa.int64()),
+            ('subtotal', money), ('tax_amount', money), ('discount_amount', money), ('total', money),
+            ('payment_method', pa.string()), ('payment_status', pa.string()),
+            ('created_at', pa.timestamp('us')), ('month', pa.string()),
+        ]),
+        'sale_details': pa.schema([
+            ('id', pa.int64()), ('sale_id', pa.int64()), ('product_id', pa.int64()),
+            ('quantity', quantity), ('unit_price', money), ('discount_amount', money), ('total', money),
+            ('unit_cost', money), ('gross_margin', money), ('customer_id', pa.int64()), ('warehouse_id', pa.int64()),
+            ('created_at', pa.timestamp('us')), ('month', pa.string()),
+        ]),
+        'products': pa.schema([
+            ('id', pa.int64()), ('sku', pa.string()), ('name', pa.string()),
+            ('category_id', pa.int64()), ('brand_id', pa.int64()),
+            ('cost', money), ('price1', money), ('is_service', pa.bool_()), ('is_active', pa.bool_()),
+        ]),
+        'inventory': pa.schema([
+            ('product_id', pa.int64()), ('warehouse_id', pa.int64()),
+            ('quantity', quantity), ('min_stock', quantity), ('max_stock', quantity),
+        ]),
+        'customers': pa.schema([
+            ('id', pa.int64()), ('type', pa.string()), ('full_name', pa.string()),
+            ('email', pa.string()), ('phone', pa.string()), ('is_active', pa.bool_()),
+        ]),
+    }
+
+
+FULL_TABLES = {
+    'products': (Product.__table__, ['id', 'sku', 'name', 'category_id', 'brand_id', 'cost', 'price1',
+                                     'is_service', 'is_active']),
+    'inventory': (Inventory.__table__, ['product_id', 'warehouse_id', 'quantity', 'min_stock', 'max_stock']),
+    'customers': (Customer.__table__, ['id', 'type', 'full_name', 'email', 'phone', 'is_active']),
+}
+
+
+def _read_manifest():
+    path = os.path.join(snapshot_dir(), MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest):
+    path = os.path.join(snapshot_dir(), MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _batch(pa, rows, schema):
+    columns = {field.name: [row[field.name] for row in rows] for field in schema}
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def _window_clause(window):
+    """Sales created in (start, end]; runs before the time cutoff resume from the old id watermark"""
+    clauses = [sales.c.created_at <= window['end']]
+    if window.get('start'):
+        clauses.append(sales.c.created_at > window['start'])
+    elif window.get('last_id'):
+        clauses.append(sales.c.id > window['last_id'])
+    return clauses
+
+
+def _sales_batches(pa, schema, window):
+    """Sales in the export window, BATCH_SIZE at a time"""
+    columns = [sales.c[name] for name in schema.names if name != 'month']
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(*columns).where(sales.c.id > last_id, *_window_clause(window))
+            .order_by(sales.c.id).limit(BATCH_SIZE)
+        ).mappings().all()
+        if not rows:
+            break
+        yield _batch(pa, [dict(row, month=row['created_at'].strftime('%Y-%m')) for row in rows], schema)
+        last_id = rows[-1]['id']
+
+
+def _detail_batches(pa, schema, window):
+    """Sale details of the sales in the export window, denormalized with the sale date, warehouse and customer"""
+    columns = [sale_details.c[name] for name in ('id', 'sale_id', 'product_id', 'quantity', 'unit_price',
+                                                 'discount_amount', 'total', 'unit_cost', 'gross_margin')]
+    columns += [sales.c.customer_id, sales.c.warehouse_id, sales.c.created_at]
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(*columns).join(sales, sales.c.id == sale_details.c.sale_id)
+            .where(sale_details.c.id > last_id, *_window_clause(window))
+            .order_by(sale_details.c.id).limit(BATCH_SIZE)
+        ).mappings().all()
+        if not rows:
+            break
+        yield _batch(pa, [dict(row, month=row['created_at'].strftime('%Y-%m')) for row in rows], schema)
+        last_id = rows[-1]['id']
+
+
+def _run_id(filename):
+    # part-<run_id>-<batch>-<i>.parquet
+    parts = filename.split('-')
+    return parts[1] if len(parts) > 2 and parts[0] == 'part' else None
+
+
+def _part_files(name):
+    """(path, run_id) of every Parquet file of a partitioned dataset"""
+    root = os.path.join(snapshot_dir(), name)
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith('.parquet'):
+                yield os.path.join(directory, filename), _run_id(filename)
+
+
+def _committed_runs(manifest):
+    """Runs recorded in the manifest; snapshots written before runs were tracked count as committed"""
+    if 'runs' in manifest:
+        return set(manifest['runs'])
+    return {run_id for name in PARTITIONED for _, run_id in _part_files(name)}
+
+
+def _discard_uncommitted(committed):
+    """Drop the staging area and any file of a run that failed before its manifest update"""
+    shutil.rmtree(os.path.join(snapshot_dir(), STAGING), ignore_errors=True)
+    for name in PARTITIONED:
+        for path, run_id in list(_part_files(name)):
+            if run_id not in committed:
+                os.remove(path)
+
+
+def _write_partitioned(name, batches, schema, run_id):
+    """Write a run's files under the staging area; returns their paths relative to it"""
+    pa, pc, ds = _arrow()
+    partitioning = ds.partitioning(
+        pa.schema([('month', pa.string()), ('warehouse_id', pa.int64())]), flavor='hive'
+    )
+    staging = os.path.join(snapshot_dir(), STAGING, run_id)
+    # One write per batch: the batches are read from the session, which is
+    # bound to this thread, while write_dataset consumes iterators on its own threads
+    for number, batch in enumerate(batches):
+        ds.write_dataset(
+            batch,
+            os.path.join(staging, name),
+            schema=schema,
+            format='parquet',
+            partitioning=partitioning,
+            basename_template=f'part-{run_id}-{number}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore'
+        )
+
+
+def _publish_run(run_id):
+    """Move a staged run into the live datasets; readers ignore it until the manifest lists it"""
+    staging = os.path.join(snapshot_dir(), STAGING, run_id)
+    for directory, _, filenames in os.walk(staging):
+        target_dir = os.path.join(snapshot_dir(), os.path.relpath(directory, staging))
+        for filename in filenames:
+            os.makedirs(target_dir, exist_ok=True)
+            os.replace(os.path.join(directory, filename), os.path.join(target_dir, filename))
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def _committed_cutoff():
+    """
+    Latest sale created_at whose transaction is surely committed
+
+    Sales are stamped when inserted, before they commit. On PostgreSQL the
+    cutoff also stops at the start of the oldest transaction still open;
+    SAFETY_LAG covers the rest (other databases, clock skew).
+    """
+    cutoff = datetime.utcnow() - SAFETY_LAG
+    if db.engine.dialect.name == 'postgresql':
+        oldest = db.session.execute(text("""
+            SELECT MIN(xact_start AT TIME ZONE 'UTC') FROM pg_stat_activity
+            WHERE xact_start IS NOT NULL AND pid <> pg_backend_pid()
+        """)).scalar()
+        if oldest is not None:
+            cutoff = min(cutoff, oldest)
+    return cutoff
+
+
+def _write_full_table(name, schema):
+    """Rewrite a small mutable table next to the old copy and swap it in"""
+    pa, pc, ds = _arrow()
+    import pyarrow.parquet as pq
+
+    table, column_names = FULL_TABLES[name]
+    columns = [table.c[c] for c in column_names if c != 'id'] + [table.c.id]
+    target = os.path.join(snapshot_dir(), f'{name}.parquet')
+    temp_path = target + '.tmp'
+
+    with pq.ParquetWriter(temp_path, schema) as writer:
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                select(*columns).where(table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)
+            ).mappings().all()
+            if not rows:
+                break
+            writer.write_batch(_batch(pa, rows, schema))
+            last_id = rows[-1]['id']
+
+    os.replace(temp_path, target)
+
+
+def export_snapshots(full=False):
+    """
+    Write sales, sale details, products, inventory and customers to Parquet
+
+    Sales and sale details are appended incrementally (sales created since
+    the previous cutoff) and partitioned by month and warehouse. A run is
+    written to a staging area, moved in, and only counts once the manifest
+    lists it, so a run that fails halfway is discarded and simply redone.
+    Products, inventory and customers change in place, so they are
+    rewritten on every run.
+
+    Returns:
+        dict: sales window exported, number of sales and snapshot time
+    """
+    pa, pc, ds = _arrow()
+    schemas = _schemas(pa)
+    base = snapshot_dir()
+
+    if full and os.path.isdir(base):
+        shutil.rmtree(base)
+    os.makedirs(base, exist_ok=True)
+
+    manifest = _read_manifest()
+    committed = _committed_runs(manifest)
+    _discard_uncommitted(committed)
+
+    start = manifest.get('sales_cutoff')
+    window = {
+        'start': datetime.fromisoformat(start) if start else None,
+        'last_id': manifest.get('sales_last_id', 0),
+        'end': _committed_cutoff(),
+    }
+    if window['start'] and window['end'] < window['start']:
+        window['end'] = window['start']
+    count = db.session.query(func.count(Sale.id)).filter(*_window_clause(window)).scalar()
+    run_id = uuid.uuid4().hex[:12]
+
+    if count:
+        _write_partitioned('sales', _sales_batches(pa, schemas['sales'], window), schemas['sales'], run_id)
+        _write_partitioned('sale_details', _detail_batches(pa, schemas['sale_details'], window),
+                           schemas['sale_details'], run_id)
+        _publish_run(run_id)
+        committed.add(run_id)
+
+    for name in FULL_TABLES:
+        _write_full_table(name, schemas[name])
+
+    manifest.pop('sales_last_id', None)
+    manifest.update({
+        'sales_cutoff': window['end'].isoformat(),
+        'runs': sorted(committed),
+        'updated_at': datetime.utcnow().isoformat(),
+    })
+    _write_manifest(manifest)
+
+    return {'from': start, 'to': manifest['sales_cutoff'], 'sales': count, 'updated_at': manifest['updated_at']}
+
+
+def snapshot_info():
+    """Manifest of the current snapshot, or None if there is none"""
+    try:
+        return _read_manifest() or None
+    except (OSError, ValueError):
+        return None
+
+
+# ===== Análisis en proceso sobre los snapshots =====
+
+def _dataset(name):
+    pa, pc, ds = _arrow()
+    path = os.path.join(snapshot_dir(), f'{name}.parquet' if name in FULL_TABLES else name)
+    if not os.path.exists(path):
+        raise ValueError('No hay snapshot de análisis; ejecute flask reports snapshot')
+    if name in FULL_TABLES:
+        return ds.dataset(path, format='parquet')
+    partitioning = ds.partitioning(
+        pa.schema([('month', pa.string()), ('warehouse_id', pa.int64())]), flavor='hive'
+    )
+    # Only files of runs listed in the manifest; a run still being moved in is not visible
+    committed = _committed_runs(_read_manifest())
+    files = [file_path for file_path, run_id in _part_files(name) if run_id in committed]
+    # Explicit schema: files written before a column was added read it as null
+    return ds.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=path,
+                      schema=_schemas(pa)[name])
+
+
+def _period_filter(ds, start_date, end_date):
+    """Partition pruning by month plus the exact date range"""
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date + ' 23:59:59', '%Y-%m-%d %H:%M:%S')
+    return ((ds.field('month') >= start.strftime('%Y-%m')) & (ds.field('month') <= end.strftime('%Y-%m'))
+            & (ds.field('created_at') >= start) & (ds.field('created_at') <= end))
+
+
+def _products_by_id():
+    products = _dataset('products').to_table(columns=['id', 'sku', 'name', 'cost'])
+    return {row['id']: row for row in products.to_pylist()}
+
+
+def _product_totals(start_date, end_date, warehouse_id=None):
+    pa, pc, ds = _arrow()
+    condition = _period_filter(ds, start_date, end_date)
+    if warehouse_id:
+        condition = condition & (ds.field('warehouse_id') == warehouse_id)
+    details = _dataset('sale_details').to_table(
+        columns=['product_id', 'quantity', 'unit_price', 'total', 'gross_margin'],
+        filter=condition
+    )
+    return details.group_by('product_id').aggregate([
+        ('quantity', 'sum'), ('unit_price', 'mean'), ('total', 'sum'), ('gross_margin', 'sum')
+    ]).to_pylist()
+
+
+def profit_from_snapshot(start_date, end_date):
+    """Profit by product, same columns as the profit_report query"""
+    products = _products_by_id()
+    rows = []
+    for totals in _product_totals(start_date, end_date):
+        product = products.get(totals['product_id'])
+        total_sold = float(totals['quantity_sum'] or 0)
+        if not product or total_sold <= 0:
+            continue
+        total_revenue = float(totals['total_sum'] or 0)
+        gross_profit = float(totals['gross_margin_sum'] or 0)
+        total_cost = total_revenue - gross_profit
+        rows.append(SimpleNamespace(
+            name=product['name'],
+            sku=product['sku'],
+            total_sold=total_sold,
+            avg_cost=total_cost / total_sold,
+            avg_sell_price=total_revenue / total_sold,
+            total_revenue=total_revenue,
+            total_cost=total_cost,
+            gross_profit=gross_profit,
+            profit_margin=(gross_profit / total_revenue * 100) if total_revenue > 0 else 0
+        ))
+    rows.sort(key=lambda row: row.gross_profit, reverse=True)
+    return rows
+
+
+def top_products_from_snapshot(start_date, end_date, warehouse_id=None, limit=10):
+    """Best-selling products by quantity"""
+    products = _products_by_id()
+    totals = sorted(_product_totals(start_date, end_date, warehouse_id),
+                    key=lambda row: row['quantity_sum'] or 0, reverse=True)[:limit]
+    return [SimpleNamespace(
+        product_name=products.get(row['product_id'], {}).get('name'),
+        sku=products.get(row['product_id'], {}).get('sku'),
+        total_quantity=row['quantity_sum'],
+        total_revenue=row['total_sum'],
+    ) for row in totals]
+
+
+def customers_from_snapshot(customer_type='client'):
+    """Orders, total spent and last order per customer, same columns as customer_report"""
+    pa, pc, ds = _arrow()
+    customers = _dataset('customers').to_table(
+        filter=(ds.field('type') == customer_type) & (ds.field('is_active') == True)
+    )
+    totals = _dataset('sales').to_table(columns=['id', 'customer_id', 'total', 'created_at'],
+                                       filter=ds.field('customer_id').is_valid())
+    totals = totals.group_by('customer_id').aggregate([
+        ('id', 'count'), ('total', 'sum'), ('created_at', 'max')
+    ])
+    joined = customers.join(totals, keys='id', right_keys='customer_id', join_type='left outer')
+
+    rows = [SimpleNamespace(
+        id=row['id'],
+        name=row['full_name'],
+        email=row['email'],
+        phone=row['phone'],
+        total_orders=row['id_count'] or 0,
+        total_spent=row['total_sum'] or 0,
+        last_order_date=row['created_at_max'],
+    ) for row in joined.to_pylist()]
+    rows.sort(key=lambda row: row.total_spent, reverse=True)
+    return rows
@@ -0,0 +1,224 @@
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import text, select, func, case, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import StockCount, StockCountLine, Product, Inventory
+from utils.cache import bump_data_version
+from utils import dashboard_metrics
+from app import db
+
+RESOLVE_CHUNK = 1000
+
+lines = StockCountLine.__table__
+
+
+def aggregate_scans(scans):
+    """
+    Sum a batch of scans by code
+
+    Each scan is either a code string (one unit) or a dict with code and
+    quantity; negative quantities undo previous scans.
+    """
+    totals = Counter()
+    for scan in scans:
+        if isinstance(scan, dict):
+            code = str(scan.get('code') or '').strip()
+            try:
+                quantity = Decimal(str(scan.get('quantity', 1)))
+            except InvalidOperation:
+                raise ValueError(f'Cantidad inválida para {code}')
+        else:
+            code = str(scan or '').strip()
+            quantity = Decimal('1')
+        if code:
+            totals[code] += quantity
+    return totals
+
+
+def _resolve_codes(codes):
+    """code -> (product_id, cost) by barcode, falling back to SKU"""
+    resolved = {}
+    codes = list(codes)
+    for offset in range(0, len(codes), RESOLVE_CHUNK):
+        chunk = codes[offset:offset + RESOLVE_CHUNK]
+        rows = db.session.execute(
+            select(Product.id, Product.sku, Product.barcode, Product.cost).where(
+                Product.is_service == False,
+                or_(Product.barcode.in_(chunk), Product.sku.in_(chunk))
+            )
+        ).all()
+        for row in rows:
+            if row.sku in chunk and row.sku not in resolved:
+                resolved[row.sku] = (row.id, row.cost)
+        for row in rows:
+            if row.barcode and row.barcode in chunk:
+                resolved[row.barcode] = (row.id, row.cost)
+    return resolved
+
+
+def _upsert_lines_statement():
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(lines)
+    return stmt.on_conflict_do_update(
+        index_elements=['count_id', 'product_id'],
+        set_={
+            'counted_quantity': lines.c.counted_quantity + stmt.excluded.counted_quantity,
+            'scanned_at': stmt.excluded.scanned_at
+        }
+    )
+
+
+def record_scans(count, scans):
+    """
+    Add a batch of scans to an open count session
+
+    The batch is aggregated in memory, codes are resolved in one query and
+    the totals are upserted into the staging lines. System stock is captured
+    the first time a product is scanned.
+
+    Returns:
+        dict: accepted units, products touched and unknown codes
+    """
+    if count.status != 'open':
+        raise ValueError('El conteo no está abierto')
+
+    totals = aggregate_scans(scans)
+    resolved = _resolve_codes(totals.keys())
+
+    quantities = Counter()
+    costs = {}
+    unknown = []
+    for code, quantity in totals.items():
+        if code not in resolved:
+            unknown.append(code)
+            continue
+        product_id, cost = resolved[code]
+        quantities[product_id] += quantity
+        costs[product_id] = cost
+
+    if quantities:
+        stock = dict(db.session.execute(
+            select(Inventory.product_id, Inventory.quantity).where(
+                Inventory.warehouse_id == count.warehouse_id,
+                Inventory.product_id.in_(list(quantities))
+            )
+        ).all())
+        now = datetime.utcnow()
+        db.session.execute(_upsert_lines_statement(), [
+            {'count_id': count.id, 'product_id': product_id, 'counted_quantity': quantity,
+             'system_quantity': stock.get(product_id) or 0, 'unit_cost': costs[product_id] or 0,
+             'scanned_at': now}
+            for product_id, quantity in quantities.items()
+        ])
+
+    db.session.commit()
+    return {'accepted': float(sum(quantities.values())), 'products': len(quantities), 'unknown': unknown}
+
+
+def variance_query(count_id, only_differences=True):
+    """Per-product variances of a count session, largest value first"""
+    variance = (StockCountLine.counted_quantity - StockCountLine.system_quantity)
+    query = db.session.query(
+        StockCountLine.product_id,
+        Product.sku,
+        Product.name,
+        StockCountLine.system_quantity,
+        StockCountLine.counted_quantity,
+        variance.label('variance'),
+        (variance * StockCountLine.unit_cost).label('variance_value')
+    ).join(Product, Product.id == StockCountLine.product_id)\
+     .filter(StockCountLine.count_id == count_id)
+
+    if only_differences:
+        query = query.filter(variance != 0)
+
+    return query.order_by(func.abs(variance * StockCountLine.unit_cost).desc(), Product.name)
+
+
+def count_summary(count_id):
+    """Totals of a count session in a single aggregate query"""
+    variance = StockCountLine.counted_quantity - StockCountLine.system_quantity
+    value = variance * StockCountLine.unit_cost
+    row = db.session.query(
+        func.count(StockCountLine.id),
+        func.coalesce(func.sum(StockCountLine.counted_quantity), 0),
+        func.coalesce(func.sum(case((variance > 0, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((variance < 0, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((variance > 0, value), else_=0)), 0),
+        func.coalesce(func.sum(case((variance < 0, value), else_=0)), 0)
+    ).filter(StockCountLine.count_id == count_id).one()
+
+    return {
+        'products': row[0],
+        'units': row[1],
+        'surplus_items': row[2],
+        'shortage_items': row[3],
+        'surplus_value': row[4],
+        'shortage_value': row[5],
+        'net_value': Decimal(str(row[4] or 0)) + Decimal(str(row[5] or 0))
+    }
+
+
+def apply_count(count, user_id, zero_missing=False):
+    """
+    Post all variances of a count session as one stock adjustment
+
+    Inventory is moved by the variance (counted - system at first scan), so
+    sales registered while the count was running are not overwritten. With
+    zero_missing, products with stock in the warehouse that were never
+    scanned are counted as zero.
+    """
+    params = {'count_id': count.id, 'warehouse_id': count.warehouse_id, 'now': datetime.utcnow()}
+
+    try:
+        locked = db.session.execute(
+            select(StockCount.status).where(StockCount.id == count.id).with_for_update()
+        ).scalar()
+        if locked != 'open':
+            raise ValueError('El conteo no está abierto')
+
+        if zero_missing:
+            db.session.execute(text("""
+                INSERT INTO stock_count_lines (count_id, product_id, system_quantity, counted_quantity, unit_cost, scanned_at)
+                SELECT :count_id, i.product_id, i.quantity, 0, COALESCE(p.cost, 0), :now
+                FROM inventory i
+                JOIN products p ON p.id = i.product_id
+                WHERE i.warehouse_id = :warehouse_id AND i.quantity <> 0
+                AND NOT EXISTS (SELECT 1 FROM stock_count_lines l
+                                WHERE l.count_id = :count_id AND l.product_id = i.product_id)
+            """), params)
+
+        db.session.execute(text("""
+            UPDATE inventory
+            SET quantity = quantity + (SELECT l.counted_quantity - l.system_quantity
+                                       FROM stock_count_lines l
+                                       WHERE l.count_id = :count_id AND l.product_id = inventory.product_id),
+                last_updated = :now
+            WHERE warehouse_id = :warehouse_id
+            AND product_id IN (SELECT product_id FROM stock_count_lines
+                               WHERE count_id = :count_id AND counted_quantity <> system_quantity)
+        """), params)
+
+        db.session.execute(text("""
+            INSERT INTO inventory (product_id, warehouse_id, quantity, min_stock, max_stock, last_updated)
+            SELECT l.product_id, :warehouse_id, l.counted_quantity - l.system_quantity, 0, 0, :now
+            FROM stock_count_lines l
+            WHERE l.count_id = :count_id AND l.counted_quantity <> l.system_quantity
+            AND NOT EXISTS (SELECT 1 FROM inventory i
+                            WHERE i.product_id = l.product_id AND i.warehouse_id = :warehouse_id)
+        """), params)
+
+        summary = count_summary(count.id)
+        count.status = 'applied'
+        count.applied_at = params['now']
+        count.applied_by = user_id
+        count.adjusted_items = summary['surplus_items'] + summary['shortage_items']
+        count.adjustment_value = summary['net_value']
+        dashboard_metrics.refresh_low_stock()
+        bump_data_version('inventory')
+        db.session.commit()
+        return summary
+    except Exception:
+        db.session.rollback()
+        raise